@@ -6,12 +6,12 @@ from flask import Flask
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_socketio import SocketIO
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 
 from .config import Config
+from .routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 mail = Mail()
 socket_io = SocketIO()
@@ -52,11 +52,37 @@ def make_app(test_config: object = None) -> Flask:
     if not app.config['LOGGING']:
         Config.disable_configured_loggers()
 
+    from app.database import configure_engine_options, pool_monitor
+    configure_engine_options(app)
     db.init_app(app)
+    pool_monitor.init_app(app)
     migrate.init_app(app, db)
     mail.init_app(app)
-    socket_io.init_app(app)
+    from app.json_backend import json_backend
+    json_backend.init_app(app)
+    from app.message_queue import make_client_manager, make_invalidation_publisher, make_revocation_publisher
+    client_manager = make_client_manager(app.config['SOCKETIO_MESSAGE_QUEUE'], app.config['SOCKETIO_CHANNEL'])
+    # client_manager is always given, because the global socket_io keeps options from the previous init_app calls
+    socket_io.init_app(app, client_manager=client_manager, json=json_backend)
     csrf.init_app(app)
+    from app.cache import chat_cache, credentials_cache, recent_writers_cache, search_cache, set_invalidation_publisher, \
+        user_cache
+    set_invalidation_publisher(make_invalidation_publisher(client_manager))
+    from app.authentication.tokens import revoked_tokens
+    revoked_tokens.set_publisher(make_revocation_publisher(client_manager))
+    revoked_tokens.init_app(app)
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        from app.message_queue import start_listening
+        app.before_first_request(lambda: start_listening(socket_io.server))
+    chat_cache.init_app(app)
+    user_cache.init_app(app)
+    credentials_cache.init_app(app)
+    recent_writers_cache.init_app(app)
+    search_cache.init_app(app)
+    from app.chats.writer import message_writer
+    message_writer.init_app(app)
+    from app.chats.search_index import user_search_index
+    user_search_index.init_app(app)
 
     from app.views import view
     app.register_blueprint(view)
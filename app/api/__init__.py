@@ -1,10 +1,11 @@
 """Init flask-restful and a separate blueprint for it"""
 import logging
 
-from flask import Blueprint
+from flask import Blueprint, current_app, make_response
 from flask_restful import Api
 
 from app import csrf
+from app.json_backend import json_backend
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 api = Api(api_bp)
@@ -13,10 +14,23 @@ logger = logging.getLogger(__name__)
 logger.info('Api blueprint is being loaded')
 
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """Makes a json response like flask_restful does, but encodes it by the configured json backend. RESTFUL_JSON
+    setting is applied, and the output is indented in debug mode"""
+    settings = dict(current_app.config.get('RESTFUL_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    response = make_response(json_backend.dumps(data, **settings) + '\n', code)
+    response.headers.extend(headers or {})
+    return response
+
+
 from .auth import Register, Token, Update, ForgotPassword, ResetPassword
 from .resources.chats import ChatsList, ChatSingle
 from .resources.users import UsersList, UserSingle
-from .resources.messages import ChatMessagesList, ChatMessageSingle
+from .resources.messages import ChatMessagesList, ChatMessageSingle, ChatMessagesSearch, MessagesSearch, \
+    ChatMessagesEvents
 
 api.add_resource(Register, '/register', strict_slashes=False)
 api.add_resource(Token, '/token', strict_slashes=False)
@@ -28,6 +42,9 @@ api.add_resource(ChatsList, '/chats', strict_slashes=False)
 api.add_resource(ChatSingle, '/chats/<int:chat_id>', strict_slashes=False)
 api.add_resource(ChatMessagesList, '/chats/<int:chat_id>/messages', strict_slashes=False)
 api.add_resource(ChatMessageSingle, '/chats/<int:chat_id>/messages/<int:message_id>', strict_slashes=False)
+api.add_resource(ChatMessagesSearch, '/chats/<int:chat_id>/messages/search', strict_slashes=False)
+api.add_resource(ChatMessagesEvents, '/chats/<int:chat_id>/events', strict_slashes=False)
+api.add_resource(MessagesSearch, '/messages/search', strict_slashes=False)
 
 api.add_resource(UsersList, '/users', strict_slashes=False)
 api.add_resource(UserSingle, '/users/<int:user_id>', strict_slashes=False)
@@ -11,6 +11,7 @@ from itsdangerous import SignatureExpired, BadSignature
 from app import db
 from app.authentication.exceptions import ValidationError
 from app.authentication.models import User
+from app.authentication.tokens import revoked_tokens
 from app.authentication.validators import validate_length, validate_email, validate_password_length
 from .decorators import basic_or_bearer_authorization_required as authorization_required
 
@@ -58,6 +59,17 @@ class Token(Resource):
         expires_in = current_app.config['AUTHENTICATION_TOKEN_DEFAULT_EXPIRES_IN']
         return {'token': token, 'expires_in': expires_in}
 
+    @authorization_required
+    def delete(self):
+        """Revokes the bearer token, which authorizes this request, so it cannot be used anymore"""
+        claims = g.get('token_claims')
+        if not claims:
+            abort(400, message='Only a bearer token can be revoked')
+        if not claims.get('jti'):
+            abort(400, message='This token cannot be revoked, get a new one')
+        revoked_tokens.revoke(claims['jti'], claims['exp'])
+        return {'message': 'Token was successfully revoked'}, 200
+
 
 class ForgotPassword(Resource):
     def post(self):
@@ -110,7 +122,8 @@ class Update(Resource):
         parser.add_argument('username', type=str)
         parser.add_argument('name', type=str)
         args = parser.parse_args()
-        user = g.user
+        # g.user can be a TokenUser, which cannot be saved
+        user = User.get_user_by_id(g.user.user_id)
         username = args.get('username')
         name = args.get('name')
         username = None if username == user.username else username
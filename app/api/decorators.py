@@ -1,6 +1,9 @@
 """Decorators for api views. Here is only one decorator which requires authorization"""
+import hashlib
+import hmac
 from functools import wraps
 
+from flask import current_app
 from flask import g
 from flask import request
 from flask_restful import abort
@@ -8,15 +11,56 @@ from itsdangerous import BadSignature, SignatureExpired
 from sqlalchemy import or_
 
 from app.authentication.models import User
+from app.authentication.tokens import TokenUser, load_token, revoked_tokens
+from app.cache import credentials_cache
 from . import logger
 
 
+def _credentials_key(username_or_email: str, password: str, password_hash: str) -> str:
+    """Makes the cache key of credentials. It is a keyed hash, so the cache does not reveal passwords. The stored
+    password hash is a part of the key, so the cached credentials stop working in every worker as soon as the password
+    is changed"""
+    return hmac.new(current_app.config['SECRET_KEY'].encode(),
+                    f'{username_or_email}\0{password}\0{password_hash}'.encode(), hashlib.sha256).hexdigest()
+
+
+def are_credentials_cached(username_or_email: str, password: str, user: User) -> bool:
+    """
+    Checks if the credentials of the user have been verified recently, so the password does not need to be hashed.
+    :param username_or_email: login from the basic auth
+    :type username_or_email: str
+    :param password: password from the basic auth
+    :type password: str
+    :param user: the user found by the login, with the current password hash
+    :type user: User
+    :rtype: bool
+    """
+    return credentials_cache.get(_credentials_key(username_or_email, password, user.password_hash)) == user.user_id
+
+
+def cache_verified_credentials(username_or_email: str, password: str, user: User):
+    """
+    Remembers that the credentials belong to the user. Must be called only after the password has been verified.
+    :param username_or_email: login from the basic auth
+    :type username_or_email: str
+    :param password: verified password
+    :type password: str
+    :param user: the owner of the credentials
+    :type user: User
+    """
+    credentials_cache.set(_credentials_key(username_or_email, password, user.password_hash), user.user_id)
+
+
 def basic_or_bearer_authorization_required(func):
     """Restricts access only for users who represent their credentials username:password or their authentication token
     For now the decorator allows to use only two http authorization methods: basic, which is based on base64 encoding
-    and bearer, which works through json web tokens"""
+    and bearer, which works through json web tokens. For bearer tokens g.user is :class:`TokenUser` and the claims are
+    saved into g.token_claims. Verified basic credentials are cached for a short time, because
+    password hashing is deliberately slow"""
     @wraps(func)
     def wrapper(*args, **kwargs):
+        # the claims are set only by bearer authorization, g may be shared with a previous request of the app context
+        g.pop('token_claims', None)
         credentials = request.authorization
         if credentials:
             logger.info('User is trying to log in via basic auth')
@@ -26,10 +70,14 @@ def basic_or_bearer_authorization_required(func):
             if not user:
                 logger.info('User was not found by email or username')
                 abort(401, message='Wrong login! Maybe, you have not been registered')
+            elif are_credentials_cached(username_or_email, password, user):
+                setattr(g, 'user', user)
+                return func(*args, **kwargs)
             elif not user.verify_password(password):
                 logger.info("User put the wrong password")
                 abort(401, message='Wrong password! Try again')
             else:
+                cache_verified_credentials(username_or_email, password, user)
                 setattr(g, 'user', user)
                 return func(*args, **kwargs)
         else:
@@ -38,14 +86,18 @@ def basic_or_bearer_authorization_required(func):
                 logger.info('User is trying to log in via bearer auth')
                 auth_type, token = header.split()
                 if auth_type.lower() == 'bearer':
-                    user = None
+                    claims, header = None, None
                     try:
-                        user = User.get_user_by_authentication_token(token)
+                        claims, header = load_token(token)
                     except SignatureExpired:
                         abort(401, message='Your authentication token period has expired')
                     except BadSignature:
                         abort(401, message='Authentication token is not valid')
-                    setattr(g, 'user', user)
+                    if revoked_tokens.is_revoked(claims.get('jti')):
+                        abort(401, message='Authentication token has been revoked')
+                    # the user is loaded from the database only if a handler needs more than user_id and username
+                    setattr(g, 'user', TokenUser(claims))
+                    setattr(g, 'token_claims', dict(claims, exp=header.get('exp')))
                     return func(*args, **kwargs)
         logger.info('User did not use any authentication')
         abort(403, message='To access use Basic (base64) or Bearer (jwt) http authorization')
@@ -0,0 +1,197 @@
+"""Events of a chat for rest clients, who have no Socket.IO connection. The view listens to the Socket.IO room of the
+chat through :data:`app.message_queue.event_tap`, so it is woken up by the same emits as the participants in the room,
+and an idle client costs one waiting greenlet instead of a database query every few seconds. The events are given in
+two ways:
+    - server-sent events, if the client accepts text/event-stream. The response lasts while the client is authorized: a
+      comment is sent every API_EVENTS_KEEPALIVE seconds while nothing happens, and as often the token and the chat
+      are checked again, so the stream is closed when the token is revoked or expires, or the chat is deleted;
+    - long polling otherwise. The response is a json with the events, which is returned as soon as there are any, or
+      empty after API_LONG_POLL_TIMEOUT seconds.
+Events are print_message with a new message in the format of the messages list, edit_message with message_id and text,
+and delete_message with message_id. New messages are always read from the database after 'since' message id, the
+emits only tell that there may be new ones. So every message has its id, and a message which is emitted by a socket
+before it is saved (see app/chats/writer.py) is read again for a while until it appears.
+"""
+import queue
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from flask import Response, current_app, request, stream_with_context
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.engine import Row
+
+from app import db
+from app.api.serializers import Serializer
+from app.authentication.models import chats
+from app.authentication.tokens import revoked_tokens
+from app.chats.events import CHATS_NAMESPACE
+from app.chats.models import Message
+from app.chats.utils import get_chat_room_name
+from app.json_backend import json_backend
+from app.message_queue import event_tap
+
+# how often and how long messages which have been emitted but not found in the database are read again
+UNSAVED_MESSAGE_RETRY_INTERVAL = 0.25
+UNSAVED_MESSAGE_RETRY_TIME = 5
+# the events given as they were emitted, print_message is turned into messages read from the database
+FORWARDED_EVENTS = ('edit_message', 'delete_message')
+
+
+def accepts_event_stream() -> bool:
+    """Tells whether the client prefers server-sent events to json"""
+    return request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+
+
+class ChatEvents:
+    """
+    Listener of the chat room which turns the emitted events into the api events. It must be closed by :meth:`close`.
+    :param chat: row of chats table
+    :type chat: Row
+    :param since: id of the last message the client has, newer messages are given as print_message events
+    :type since: int
+    :param message_serializer: serializer of messages
+    :type message_serializer: Serializer
+    :param user_id: id of the listening participant
+    :type user_id: int
+    :param token_claims: claims of the authentication token with 'jti' and 'exp', None for basic authorization
+    :type token_claims: dict
+    """
+
+    def __init__(self, chat: Row, since: int, message_serializer: Serializer, user_id: int,
+                 token_claims: Optional[dict] = None):
+        self.chat_id = chat.chat_id
+        self.since = since
+        self.message_serializer = message_serializer
+        self.user_id = user_id
+        self.token_id = token_claims.get('jti') if token_claims else None
+        self.expires_at = token_claims.get('exp') if token_claims else None
+        self.room = get_chat_room_name(chat.user1_id, chat.user2_id)
+        self.listener = event_tap.listen(CHATS_NAMESPACE, self.room)
+        # messages are read until this time, the first time - at once
+        self.read_until = time.monotonic()
+        # ends the transaction of the request, so a waiting client does not keep its connection. Objects of the session,
+        # like g.user, stay attached and are loaded again on access
+        db.session.commit()
+
+    def close(self):
+        event_tap.stop_listening(CHATS_NAMESPACE, self.room, self.listener)
+
+    def token_time_left(self) -> float:
+        """Returns the seconds until the token expires, infinity for basic authorization"""
+        return self.expires_at - time.time() if self.expires_at is not None else float('inf')
+
+    def is_authorized(self) -> bool:
+        """Checks again that the token has been neither revoked nor expired, and the chat still exists with the user as
+        a participant. The chat is read by a short-lived connection like the messages"""
+        if self.token_id is not None and revoked_tokens.is_revoked(self.token_id):
+            return False
+        if self.token_time_left() <= 0:
+            return False
+        query = select(exists().where(and_(chats.c.chat_id == self.chat_id,
+                                           or_(chats.c.user1_id == self.user_id, chats.c.user2_id == self.user_id))))
+        with db.session().get_bind(Message.__mapper__).connect() as connection:
+            return connection.execute(query).scalar()
+
+    def _read_messages(self) -> List[Row]:
+        """Reads the messages after 'since' by a short-lived connection, so waiting clients do not keep it and the
+        session of the request is not touched"""
+        limit = current_app.config['API_PAGE_SIZE']
+        query = select(Message.message_id, Message.datetime_writing, Message.text, Message.sender_id,
+                       Message.receiver_id).where(Message.chat_id == self.chat_id, Message.message_id > self.since)
+        with db.session().get_bind(Message.__mapper__).connect() as connection:
+            messages = connection.execute(query.order_by(Message.message_id).limit(limit)).all()
+        if messages:
+            self.since = messages[-1].message_id
+            # the next page may be already saved
+            self.read_until = time.monotonic() if len(messages) == limit else None
+        elif self.read_until is not None and time.monotonic() >= self.read_until:
+            self.read_until = None
+        return messages
+
+    def wait(self, timeout: float) -> List[Tuple[str, dict]]:
+        """
+        Returns the next events as (name, data) pairs. Waits for them up to the timeout, and returns an empty list if
+        nothing has happened.
+        :param timeout: seconds to wait
+        :type timeout: float
+        :rtype: list
+        """
+        deadline = time.monotonic() + timeout
+        events = []
+        while True:
+            if self.read_until is not None:
+                events.extend(('print_message', self.message_serializer(message)) for message in self._read_messages())
+            if events:
+                return events
+            now = time.monotonic()
+            if now >= deadline:
+                return events
+            wait = deadline - now
+            if self.read_until is not None:
+                wait = min(wait, UNSAVED_MESSAGE_RETRY_INTERVAL)
+            try:
+                emitted = [self.listener.get(timeout=wait)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    emitted.append(self.listener.get_nowait())
+                except queue.Empty:
+                    break
+            for name, data in emitted:
+                if name == 'print_message':
+                    self.read_until = max(self.read_until or 0, time.monotonic() + UNSAVED_MESSAGE_RETRY_TIME)
+                elif name in FORWARDED_EVENTS:
+                    events.append((name, data))
+
+
+def event_stream_response(chat_events: ChatEvents) -> Response:
+    """
+    Makes a text/event-stream response of the chat events. print_message events have the message id as the event id,
+    so a reconnecting client continues from Last-Event-ID. The authorization is checked every API_EVENTS_KEEPALIVE
+    seconds and at the token expiration, the stream ends when it fails. The listener is closed, when the client is gone
+    or the stream ends.
+    :param chat_events: listener of the chat
+    :type chat_events: ChatEvents
+    :rtype: Response
+    """
+    keepalive = current_app.config['API_EVENTS_KEEPALIVE']
+
+    def generate() -> Iterator[str]:
+        try:
+            check_at = time.monotonic() + keepalive
+            while True:
+                events = chat_events.wait(max(min(check_at - time.monotonic(), chat_events.token_time_left()), 0))
+                if time.monotonic() >= check_at or chat_events.token_time_left() <= 0:
+                    if not chat_events.is_authorized():
+                        return
+                    check_at = time.monotonic() + keepalive
+                if not events:
+                    yield ': keepalive\n\n'
+                for name, data in events:
+                    event_id = f"id: {data['message_id']}\n" if name == 'print_message' else ''
+                    yield f'{event_id}event: {name}\ndata: {json_backend.dumps(data)}\n\n'
+        finally:
+            chat_events.close()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx must not buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def long_poll(chat_events: ChatEvents) -> dict:
+    """
+    Waits for the chat events up to API_LONG_POLL_TIMEOUT seconds and closes the listener.
+    :param chat_events: listener of the chat
+    :type chat_events: ChatEvents
+    :return: dict with 'since' - the id to poll the next events after, and 'events' - list of dicts with 'event' and
+             'data'
+    :rtype: dict
+    """
+    try:
+        events = chat_events.wait(current_app.config['API_LONG_POLL_TIMEOUT'])
+    finally:
+        chat_events.close()
+    return {'since': chat_events.since, 'events': [{'event': name, 'data': data} for name, data in events]}
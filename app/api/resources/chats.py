@@ -2,16 +2,20 @@
 from flask import g
 from flask_restful import Resource
 from flask_restful import abort
-from flask_restful import fields, marshal_with
+from flask_restful import fields
 from flask_restful import reqparse
 from sqlalchemy import or_
 
 from app import db
 from app.api.decorators import basic_or_bearer_authorization_required as authorization_required
+from app.api.serializers import serialize_with
 from app.api.utils import return_user_or_abort, return_chat_or_abort, abort_if_not_a_participant
+from app.api.utils import etag_header, make_etag, not_modified_or_none
 from app.authentication.models import chats, User
+from app.chats.events import emit_chat_updated
 from app.chats.exceptions import ChatAlreadyExistsError
 from app.chats.models import Message
+from app.routing import read_only
 
 chat_fields = {
     'chat_id': fields.Integer,
@@ -30,13 +34,20 @@ chats_single_fields = {
 
 class ChatsList(Resource):
     @authorization_required
-    @marshal_with(chats_list_fields)
+    @read_only
+    @serialize_with(chats_list_fields)
     def get(self):
-        """Returns the list of current user's chats"""
+        """Returns the list of current user's chats. The list is its own validator: the response is not serialized and
+        sent again, if the client has the same chats (see :func:`app.api.utils.not_modified_or_none`)"""
         current_user_id = g.user.user_id
-        result = db.session.query(chats).filter(
-            or_(chats.c.user1_id == current_user_id, chats.c.user2_id == current_user_id)).all()
-        return {'user_id': current_user_id, 'data': result}, 200
+        result = db.session.query(chats.c.chat_id, chats.c.user1_id, chats.c.user2_id).filter(
+            or_(chats.c.user1_id == current_user_id, chats.c.user2_id == current_user_id)).order_by(
+            chats.c.chat_id).all()
+        etag = make_etag('chats', current_user_id, [tuple(chat) for chat in result])
+        not_modified = not_modified_or_none(etag)
+        if not_modified:
+            return not_modified
+        return {'user_id': current_user_id, 'data': result}, 200, etag_header(etag)
 
     @authorization_required
     def post(self):
@@ -60,7 +71,7 @@ class ChatsList(Resource):
 
 class ChatSingle(Resource):
     @authorization_required
-    @marshal_with(chats_single_fields)
+    @serialize_with(chats_single_fields)
     def get(self, chat_id: int):
         """Returns the certain chat with a given chat_id"""
         current_user_id = g.user.user_id
@@ -77,4 +88,6 @@ class ChatSingle(Resource):
         Message.delete_messages(chat_id=chat_id)
         User.delete_chat(chat_id=chat_id)
         db.session.commit()
+        if chat.last_message_id is not None:
+            emit_chat_updated(chat_id, (chat.user1_id, chat.user2_id), None, None)
         return {'user_id': current_user_id, 'chat_id': chat_id, 'message': 'Chat was successfully deleted'}, 200
@@ -1,20 +1,28 @@
 """Messages api resource, and its fields"""
-from typing import Tuple
+from typing import Tuple, Union
 
-from flask import g
+import datetime
+
+from flask import Response, g
 from flask import request
 from flask_restful import Resource
 from flask_restful import abort
-from flask_restful import marshal_with, fields
+from flask_restful import fields
 from flask_restful import reqparse
 
 from app import db
 from app.api.decorators import basic_or_bearer_authorization_required as authorization_required
+from app.api.events import ChatEvents, accepts_event_stream, event_stream_response, long_poll
+from app.api.serializers import Serializer, serialize_with
 from app.api.utils import abort_if_not_a_participant, return_chat_or_abort, return_message_or_abort, \
     abort_if_not_from_a_chat, abort_if_not_own
-from app.api.utils import model_filter_by_get_params
+from app.api.streaming import get_stream_format, stream_response
+from app.api.utils import paginate_by_get_params, search_messages_by_get_params, stream_by_get_params
+from app.api.utils import etag_header, make_etag, not_modified_or_none
+from app.chats.events import emit_saved_chat_updated, emit_to_chat
 from app.chats.models import Message
 from app.api.utils import longer_than_zero
+from app.routing import read_only
 
 message_fields = {
     'message_id': fields.Integer,
@@ -28,6 +36,35 @@ messages_list_fields = {
     'user_id': fields.Integer,
     'chat_id': fields.Integer,
     'data': fields.List(fields.Nested(message_fields)),
+    'next': fields.String,
+    'has_more': fields.Boolean,
+}
+
+message_serializer = Serializer(message_fields)
+messages_list_serializer = Serializer(messages_list_fields)
+
+found_message_fields = {
+    **message_fields,
+    'chat_id': fields.Integer,
+    'rank': fields.Float,
+    'highlight': fields.String,
+}
+
+chat_messages_search_fields = {
+    'user_id': fields.Integer,
+    'chat_id': fields.Integer,
+    'q': fields.String,
+    'data': fields.List(fields.Nested(found_message_fields)),
+    'next': fields.String,
+    'has_more': fields.Boolean,
+}
+
+messages_search_fields = {
+    'user_id': fields.Integer,
+    'q': fields.String,
+    'data': fields.List(fields.Nested(found_message_fields)),
+    'next': fields.String,
+    'has_more': fields.Boolean,
 }
 
 message_single_fields = {
@@ -39,15 +76,30 @@ message_single_fields = {
 
 class ChatMessagesList(Resource):
     @authorization_required
-    @marshal_with(messages_list_fields)
-    def get(self, chat_id: int) -> Tuple[dict, int]:
-        """Returns the list of messages from given chat"""
+    @read_only
+    def get(self, chat_id: int) -> Union[Tuple[dict, int], Response]:
+        """Returns one page of messages from given chat, to get the next page use 'next' cursor of the response. All the
+        messages are returned, if the list is streamed (see app/api/streaming.py). Responses are tagged by the chat
+        version, so a client which has the current list gets 304 without querying the messages"""
         current_user_id = g.user.user_id
         chat = return_chat_or_abort(chat_id)
         abort_if_not_a_participant(current_user_id, chat)
+        stream_format = get_stream_format()
+        etag = make_etag('messages', chat_id, chat.version, current_user_id, request.query_string, stream_format)
+        not_modified = not_modified_or_none(etag)
+        if not_modified:
+            return not_modified
         messages = Message.query.filter_by(chat_id=chat_id)
-        messages = model_filter_by_get_params(Message, messages, request.args)
-        return {'user_id': current_user_id, 'chat_id': chat_id, 'data': messages}, 200
+        # chronological order by default, it is served by the chat's history index
+        default_ordering = ('datetime_writing', 'message_id')
+        envelope = {'user_id': current_user_id, 'chat_id': chat_id}
+        if stream_format:
+            page = stream_by_get_params(Message, messages, request.args, default_ordering)
+            response = stream_response(stream_format, page, message_serializer, messages_list_serializer, envelope)
+            response.headers.extend(etag_header(etag))
+            return response
+        page = paginate_by_get_params(Message, messages, request.args, default_ordering)
+        return messages_list_serializer({**envelope, **page}), 200, etag_header(etag)
 
     @authorization_required
     def post(self, chat_id: int) -> Tuple[dict, int]:
@@ -61,25 +113,35 @@ class ChatMessagesList(Resource):
         if args['texts']:
             user1_id, user2_id = chat.user1_id, chat.user2_id
             receiver_id = user2_id if user1_id == current_user_id else user1_id
-            for text in args['texts']:
-                message = Message(text=text, sender_id=current_user_id, receiver_id=receiver_id, chat_id=chat_id)
-                db.session.add(message)
+            datetime_writing = datetime.datetime.utcnow()
+            # the participant has already been checked, so the chat is not verified again
+            Message.create_many(chat_id, current_user_id, receiver_id, args['texts'], datetime_writing,
+                                verify_chat=False)
             db.session.commit()
+            timestamp = datetime_writing.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+            for text in args['texts']:
+                emit_to_chat(chat, 'print_message', {'message': text, 'timestamp_milliseconds': timestamp,
+                                                     'sender_id': current_user_id})
+            emit_saved_chat_updated(chat_id)
             return {'user_id': current_user_id, 'chat_id': chat_id,
                     'message': f"Your message{'s were' if len(args['texts']) > 1 else ' was'} successfully sent"}, 201
 
 
 class ChatMessageSingle(Resource):
     @authorization_required
-    @marshal_with(message_single_fields)
+    @serialize_with(message_single_fields)
     def get(self, chat_id: int, message_id: int) -> Tuple[dict, int]:
-        """Return info about a certain message from the chat"""
+        """Return info about a certain message from the chat, tagged by the chat version like the messages list"""
         current_user_id = g.user.user_id
         chat = return_chat_or_abort(chat_id)
         abort_if_not_a_participant(current_user_id, chat)
+        etag = make_etag('message', chat_id, chat.version, current_user_id, message_id)
+        not_modified = not_modified_or_none(etag)
+        if not_modified:
+            return not_modified
         message = return_message_or_abort(message_id)
         abort_if_not_from_a_chat(chat_id, message)
-        return {'user_id': current_user_id, 'chat_id': chat_id, 'data': message}, 200
+        return {'user_id': current_user_id, 'chat_id': chat_id, 'data': message}, 200, etag_header(etag)
 
     @authorization_required
     def delete(self, chat_id: int, message_id: int) -> Tuple[dict, int]:
@@ -92,6 +154,9 @@ class ChatMessageSingle(Resource):
         abort_if_not_own(current_user_id, message)
         db.session.delete(message)
         db.session.commit()
+        emit_to_chat(chat, 'delete_message', {'message_id': message_id})
+        if chat.last_message_id == message_id:
+            emit_saved_chat_updated(chat_id)
         return {'user_id': current_user_id, 'chat_id': chat_id, 'message_id': message_id,
                 'message': f'Message {message_id} was successfully deleted'}, 200
 
@@ -109,5 +174,56 @@ class ChatMessageSingle(Resource):
         abort_if_not_own(current_user_id, message)
         message.text = args.get('text')
         db.session.commit()
+        emit_to_chat(chat, 'edit_message', {'message_id': message_id, 'text': args.get('text')})
+        if chat.last_message_id == message_id:
+            emit_saved_chat_updated(chat_id)
         return {'user_id': current_user_id, 'chat_id': chat_id, 'message_id': message_id, 'text': args.get('text'),
                 'message': f'Message {message_id} was successfully updated'}, 200
+
+
+class ChatMessagesSearch(Resource):
+    @authorization_required
+    @read_only
+    @serialize_with(chat_messages_search_fields)
+    def get(self, chat_id: int) -> Tuple[dict, int]:
+        """Returns one page of messages from given chat which contain all the words of 'q' param, the most relevant
+        first. Found words are highlighted in 'highlight' field"""
+        current_user_id = g.user.user_id
+        chat = return_chat_or_abort(chat_id)
+        abort_if_not_a_participant(current_user_id, chat)
+        page = search_messages_by_get_params(request.args, chat_id=chat_id)
+        return {'user_id': current_user_id, 'chat_id': chat_id, **page}, 200
+
+
+class MessagesSearch(Resource):
+    @authorization_required
+    @read_only
+    @serialize_with(messages_search_fields)
+    def get(self) -> Tuple[dict, int]:
+        """Like :class:`ChatMessagesSearch`, but searches messages from all the chats of the current user"""
+        current_user_id = g.user.user_id
+        page = search_messages_by_get_params(request.args, user_id=current_user_id)
+        return {'user_id': current_user_id, **page}, 200
+
+
+class ChatMessagesEvents(Resource):
+    @authorization_required
+    def get(self, chat_id: int) -> Union[Tuple[dict, int], Response]:
+        """Returns new, edited and deleted messages of given chat as they happen, by server-sent events or by long
+        polling (see app/api/events.py). Messages after 'since' param (or Last-Event-ID header) are given first, by
+        default - after the last message of the chat"""
+        current_user_id = g.user.user_id
+        chat = return_chat_or_abort(chat_id)
+        abort_if_not_a_participant(current_user_id, chat)
+        since = request.args.get('since', request.headers.get('Last-Event-ID'))
+        if since is None:
+            since = chat.last_message_id or 0
+        else:
+            try:
+                since = int(since)
+            except ValueError:
+                abort(400, message="'since' must be a message id")
+        chat_events = ChatEvents(chat, since, message_serializer, current_user_id, g.get('token_claims'))
+        if accepts_event_stream():
+            return event_stream_response(chat_events)
+        return {'user_id': current_user_id, 'chat_id': chat_id, **long_poll(chat_events)}, 200
@@ -2,13 +2,16 @@
 from flask import g
 from flask import request
 from flask_restful import Resource
-from flask_restful import fields, marshal_with
+from flask_restful import fields
 
 from app import db
 from app.api.decorators import basic_or_bearer_authorization_required as authorization_required
-from app.api.utils import model_filter_by_get_params
+from app.api.serializers import Serializer, serialize_with
+from app.api.streaming import get_stream_format, stream_response
+from app.api.utils import paginate_by_get_params, stream_by_get_params
 from app.api.utils import return_user_or_abort
 from app.authentication.models import User
+from app.routing import read_only
 
 user_fields = {
     'user_id': fields.Integer,
@@ -19,7 +22,12 @@ user_fields = {
 users_list_fields = {
     'user_id': fields.Integer,
     'data': fields.List(fields.Nested(user_fields)),
+    'next': fields.String,
+    'has_more': fields.Boolean,
 }
+user_serializer = Serializer(user_fields)
+users_list_serializer = Serializer(users_list_fields)
+
 user_single_fields = {
     'user_id': fields.Integer,
     'data': fields.Nested(user_fields),
@@ -28,17 +36,24 @@ user_single_fields = {
 
 class UsersList(Resource):
     @authorization_required
-    @marshal_with(users_list_fields)
+    @read_only
     def get(self):
-        """Returns the list off all users. To restrict somehow the output use get query params"""
+        """Returns one page of all users ordered by id. To restrict somehow the output use get query params, to get the
+        next page use 'next' cursor of the response. All the users are returned, if the list is streamed (see
+        app/api/streaming.py)"""
         users = db.session.query(User.user_id, User.username, User.name, User.date_joined)
-        users = model_filter_by_get_params(User, users, request.args)
-        return {'user_id': g.user.user_id, 'data': users}, 200
+        stream_format = get_stream_format()
+        if stream_format:
+            page = stream_by_get_params(User, users, request.args, default_ordering=('user_id',))
+            return stream_response(stream_format, page, user_serializer, users_list_serializer,
+                                   {'user_id': g.user.user_id})
+        page = paginate_by_get_params(User, users, request.args, default_ordering=('user_id',))
+        return users_list_serializer({'user_id': g.user.user_id, **page}), 200
 
 
 class UserSingle(Resource):
     @authorization_required
-    @marshal_with(user_single_fields)
+    @serialize_with(user_single_fields)
     def get(self, user_id: int):
         """Returns the only one user with specified id"""
         user = return_user_or_abort(user_id)
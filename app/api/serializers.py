@@ -0,0 +1,227 @@
+"""Compiled serializers of flask_restful fields. :func:`flask_restful.marshal` walks the fields dict for every row:
+every field looks the value up by :func:`flask_restful.fields.get_value` and formats it by a generic method, and dates
+go through :func:`email.utils.formatdate`. A :class:`Serializer` does the same work once per fields dict and type of
+rows: it chooses how to read every value (by position for sqlalchemy rows, by key for dicts and by attribute for other
+objects) and how to format it, so a row is serialized by a list of prepared functions. The output is equal to the one
+of marshal, so the json is byte-identical. Fields which are not known here are serialized by their own output method.
+
+:Example:
+    user_serializer = Serializer(user_fields)
+    data = user_serializer.many(db.session.query(User.user_id, User.username).all())
+"""
+import datetime
+import functools
+from typing import Any, Callable, Iterable, List
+
+from flask import Response
+from flask_restful import fields, unpack
+from flask_restful.fields import get_value, is_indexable_but_not_string
+from sqlalchemy.engine import Row
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_MISSING = object()
+
+
+def format_rfc822(value: datetime.datetime) -> str:
+    """
+    Formats a naive utc datetime like :func:`flask_restful.fields._rfc822` without converting it to a timestamp and
+    back.
+    :param value: naive datetime in utc
+    :type value: datetime.datetime
+    :return: date like 'Thu, 20 May 2021 14:18:38 -0000'
+    :rtype: str
+    """
+    return (f'{_DAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} {value.year:04d} '
+            f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} -0000')
+
+
+def _make_formatter(field: fields.Raw) -> Callable[[Any], Any]:
+    """Returns the function which makes the output of the field from its value, like the field's output method does
+    after the value is taken"""
+    default = field.default
+    field_type = type(field)
+    if field_type is fields.Integer:
+        return lambda value: default if value is None else value if type(value) is int else field.format(value)
+    if field_type is fields.String:
+        return lambda value: default if value is None else value if type(value) is str else field.format(value)
+    if field_type is fields.Boolean:
+        return lambda value: default if value is None else bool(value)
+    if field_type is fields.Raw:
+        return lambda value: default if value is None else value
+    if field_type is fields.DateTime and field.dt_format == 'rfc822':
+        return lambda value: default if value is None else format_rfc822(value) \
+            if type(value) is datetime.datetime and value.tzinfo is None else field.format(value)
+    if field_type is fields.DateTime and field.dt_format == 'iso8601':
+        return lambda value: default if value is None else value.isoformat() \
+            if type(value) is datetime.datetime else field.format(value)
+    if field_type is fields.Nested:
+        return _make_nested_formatter(field)
+    if field_type is fields.List and type(field.container) is fields.Nested:
+        item_formatter = _make_nested_formatter(field.container)
+        # None items are serialized with the defaults of the fields, unless the container has other rules for them
+        serialize_many = Serializer(field.container.nested).many \
+            if not field.container.allow_null and field.container.default is None else None
+
+        def format_list(value):
+            if type(value) is list or type(value) is tuple:
+                return serialize_many(value) if serialize_many else [item_formatter(item) for item in value]
+            return _MISSING
+        return format_list
+    return None
+
+
+def _make_nested_formatter(field: fields.Nested) -> Callable[[Any], Any]:
+    serializer = Serializer(field.nested)
+    allow_null, default = field.allow_null, field.default
+
+    def format_nested(value):
+        if value is None:
+            if allow_null:
+                return None
+            elif default is not None:
+                return default
+        return serializer(value)
+    return format_nested
+
+
+class Serializer:
+    """
+    Serializes objects by the flask_restful fields dict like :func:`flask_restful.marshal`, but the fields are
+    prepared once. Calls of the serializer are equal to marshal(obj, fields), and :meth:`many` is equal to marshalling
+    of a list. Plain dicts are returned instead of OrderedDict, they keep the order of the fields too.
+    :param fields_dict: flask_restful fields
+    :type fields_dict: dict
+    """
+
+    def __init__(self, fields_dict: dict):
+        self.fields = fields_dict
+        self.formatters = []
+        for key, field in fields_dict.items():
+            if isinstance(field, dict):
+                nested = Serializer(field)
+                self.formatters.append((key, None, nested, field))
+                continue
+            if isinstance(field, type):
+                field = field()
+            simple_key = field.attribute is None and '.' not in key
+            self.formatters.append((key, field, _make_formatter(field) if simple_key else None, None))
+        self.compiled = {}
+        self.last_rows = None
+
+    def __call__(self, obj: Any) -> Any:
+        """Returns the serialized object, or the list of serialized objects, if a list or a tuple is given"""
+        if isinstance(obj, (list, tuple)):
+            return self.many(obj)
+        return self._compile(obj)(obj)
+
+    def many(self, objects: Iterable[Any]) -> List[dict]:
+        """
+        Returns the list of serialized objects. The reading of values is chosen by the first object and reused for the
+        following objects of the same type, and for sqlalchemy rows - of the same result.
+        :param objects: rows of a query, model instances or dicts
+        :type objects: Iterable
+        :rtype: list
+        """
+        result = []
+        serialize = kind = None
+        for obj in objects:
+            obj_kind = obj._parent if isinstance(obj, Row) else type(obj)
+            if obj_kind is not kind:
+                kind, serialize = obj_kind, self._compile(obj)
+            result.append(serialize(obj))
+        return result
+
+    def _compile(self, obj: Any) -> Callable[[Any], dict]:
+        """Returns the function which serializes the objects like the given one"""
+        if isinstance(obj, Row):
+            # the positions of columns depend on the query, they are the same for all the rows of one result. The
+            # serializer of the last result is kept in one pair, so concurrent requests never see a half replaced one
+            last_rows = self.last_rows
+            if last_rows is None or last_rows[0] is not obj._parent:
+                positions = {key: position for position, key in enumerate(obj._mapping.keys())}
+                last_rows = (obj._parent, self._build(
+                    lambda key: _item_getter(positions[key]) if key in positions else _attribute_getter(key)))
+                self.last_rows = last_rows
+            return last_rows[1]
+        kind = type(obj)
+        serialize = self.compiled.get(kind)
+        if serialize is None:
+            if isinstance(obj, dict):
+                serialize = self._build(_key_getter)
+            elif is_indexable_but_not_string(obj):
+                serialize = self._build(lambda key: lambda item: get_value(key, item))
+            elif hasattr(obj, '_sa_instance_state'):
+                serialize = self._build(_loaded_attribute_getter)
+            else:
+                serialize = self._build(_attribute_getter)
+            self.compiled[kind] = serialize
+        return serialize
+
+    def _build(self, make_getter: Callable[[str], Callable[[Any], Any]]) -> Callable[[Any], dict]:
+        """Makes the serializing function from the functions which read and format the values of the fields"""
+        steps = []
+        for key, field, formatter, nested_fields in self.formatters:
+            if nested_fields is not None:
+                # a dict of fields is marshalled from the same object
+                steps.append((key, lambda obj, nested=formatter: nested(obj)))
+            elif formatter is None:
+                steps.append((key, lambda obj, key=key, field=field: field.output(key, obj)))
+            else:
+                steps.append((key, _chain(make_getter(key), formatter, key, field)))
+
+        def serialize(obj):
+            return {key: step(obj) for key, step in steps}
+        return serialize
+
+
+def serialize_with(fields_dict: dict):
+    """
+    Decorator like :class:`flask_restful.marshal_with`, which serializes the return value of a view by the compiled
+    :class:`Serializer` of the fields. Responses, e.g. 304 ones, are returned as they are.
+    :param fields_dict: flask_restful fields
+    :type fields_dict: dict
+    """
+    serializer = Serializer(fields_dict)
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            response = f(*args, **kwargs)
+            if isinstance(response, Response):
+                return response
+            if isinstance(response, tuple):
+                data, code, headers = unpack(response)
+                return serializer(data), code, headers
+            return serializer(response)
+        return wrapper
+    return decorator
+
+
+def _chain(getter: Callable, formatter: Callable, key: str, field: fields.Raw) -> Callable[[Any], Any]:
+    def step(obj):
+        value = formatter(getter(obj))
+        # the formatter cannot handle such a value, e.g. a list field of a query
+        return field.output(key, obj) if value is _MISSING else value
+    return step
+
+
+def _item_getter(position: int) -> Callable[[Any], Any]:
+    return lambda row: row[position]
+
+
+def _attribute_getter(key: str) -> Callable[[Any], Any]:
+    return lambda obj: getattr(obj, key, None)
+
+
+def _loaded_attribute_getter(key: str) -> Callable[[Any], Any]:
+    """Reads loaded attributes of model instances from their __dict__ without the instrumented descriptors, expired and
+    deferred ones are loaded by getattr"""
+    def get(obj):
+        value = obj.__dict__.get(key, _MISSING)
+        return getattr(obj, key, None) if value is _MISSING else value
+    return get
+
+
+def _key_getter(key: str) -> Callable[[Any], Any]:
+    return lambda obj: obj[key] if key in obj else getattr(obj, key, None)
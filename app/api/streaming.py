@@ -0,0 +1,85 @@
+"""Streaming responses of the api lists. A list is streamed when 'stream' url param is true, or when a client accepts
+application/x-ndjson. Its rows are read by :class:`app.api.utils.StreamedPage` and encoded one chunk after another, so
+the memory of a worker does not depend on the number of exported rows.
+    - json: the same envelope as the one of a page, like {"user_id": 1, "data": [...], "next": null,
+      "has_more": false}, and the same bytes, if the json is not indented (RESTFUL_JSON setting and debug mode). It is
+      encoded by the configured json backend too;
+    - ndjson: one json object per row and line, without the envelope.
+"""
+from typing import Optional
+
+from flask import Response, current_app, request, stream_with_context
+
+from app.api.serializers import Serializer
+from app.api.utils import StreamedPage
+from app.json_backend import json_backend
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# stands for the rows in the encoded envelope
+_ROWS = '--streamed-rows--'
+
+
+def get_stream_format() -> Optional[str]:
+    """
+    Returns the format the list must be streamed in according to the request.
+    :return: 'ndjson', 'json' or None, if the list is not streamed
+    :rtype: str
+    """
+    if request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        return 'ndjson'
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return 'json'
+    return None
+
+
+def stream_response(stream_format: str, page: StreamedPage, row_serializer: Serializer,
+                    list_serializer: Serializer = None, envelope: dict = None) -> Response:
+    """
+    Makes the response which encodes the rows of the page while they are fetched.
+    :param stream_format: 'json' or 'ndjson', see :func:`get_stream_format`
+    :type stream_format: str
+    :param page: rows to stream
+    :type page: StreamedPage
+    :param row_serializer: serializer of a row
+    :type row_serializer: Serializer
+    :param list_serializer: serializer of the envelope with 'data' list, it is not used for ndjson
+    :type list_serializer: Serializer
+    :param envelope: values of the envelope besides 'data', 'next' and 'has_more'
+    :type envelope: dict
+    :rtype: Response
+    """
+    chunk_size = current_app.config['API_STREAM_CHUNK_SIZE']
+    dumps = json_backend.dumps
+
+    def encoded_chunks():
+        chunk = []
+        for row in page:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield [dumps(item) for item in row_serializer.many(chunk)]
+                chunk = []
+        if chunk:
+            yield [dumps(item) for item in row_serializer.many(chunk)]
+
+    def encoded_envelope(**values):
+        """Returns the encoded envelope before and after the rows"""
+        data = list_serializer(dict(envelope or {}, data=[], **values))
+        data['data'] = [_ROWS]
+        return dumps(data).split(dumps(_ROWS))
+
+    def generate_json():
+        yield encoded_envelope()[0]
+        # the separator of list items depends on the backend
+        separator, items_separator = '', dumps([0, 0])[2:-2]
+        for chunk in encoded_chunks():
+            yield separator + items_separator.join(chunk)
+            separator = items_separator
+        yield encoded_envelope(next=page.next, has_more=page.has_more)[1] + '\n'
+
+    def generate_ndjson():
+        for chunk in encoded_chunks():
+            yield '\n'.join(chunk) + '\n'
+
+    if stream_format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype=NDJSON_MIMETYPE)
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
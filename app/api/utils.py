@@ -1,22 +1,143 @@
 """Essential and repetitive utils for rest api views"""
-from typing import Any
+import datetime
+import hashlib
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
 
+from flask import Response, current_app, request
 from flask_restful import abort
 from flask_sqlalchemy import BaseQuery
 from flask_sqlalchemy.model import DefaultMeta
-from sqlalchemy import desc
+from sqlalchemy import Column, UniqueConstraint, and_, desc, or_
 from sqlalchemy.engine.row import Row
-from sqlalchemy.sql.sqltypes import String
+from sqlalchemy.sql.sqltypes import DateTime, String
+from werkzeug.http import quote_etag
 
 from app import db
 from app.authentication.exceptions import UserNotFoundByIndexError
 from app.authentication.models import User, chats
 from app.chats.exceptions import MessageNotFoundByIndexError
 from app.chats.models import Message
+from app.cursors import decode_cursor, encode_cursor
 from . import logger
 
 
-def model_filter_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict) -> BaseQuery:
+def get_orderable_columns(model: DefaultMeta, query: BaseQuery) -> List[str]:
+    """
+    Returns names of the columns results can be ordered and paged by: the columns which lead an index, a unique
+    constraint or the primary key of the model's table, and are selected by the query. Ordering by other columns makes
+    the database sort the whole filtered table for every page.
+    :param model: model base class
+    :type model: DefaultMeta
+    :param query: query whose results are ordered
+    :type query: BaseQuery
+    :return: sorted names of the columns
+    :rtype: list
+    """
+    table = model.__table__
+    indexed = {column.name for column in table.primary_key.columns}
+    for constraint in list(table.indexes) + [item for item in table.constraints if isinstance(item, UniqueConstraint)]:
+        expressions = getattr(constraint, 'expressions', None) or list(constraint.columns)
+        if expressions and isinstance(expressions[0], Column):
+            indexed.add(expressions[0].name)
+    selected = set()
+    for description in query.column_descriptions:
+        if description['expr'] is model:
+            selected.update(table.c.keys())
+        else:
+            selected.add(description['name'])
+    return sorted(indexed & selected)
+
+
+def _parse_int(args: dict, key: str, default: Optional[int], minimum: int) -> Optional[int]:
+    """Returns the url param as an integer or makes abort with 400, if it is not an integer or less than minimum"""
+    if key not in args:
+        return default
+    try:
+        value = int(args.get(key))
+    except (TypeError, ValueError):
+        value = None
+    if value is None or value < minimum:
+        logger.info(f'Abort because of invalid {key}')
+        abort(400, message=f"'{key}' must be an integer not less than {minimum}")
+    return value
+
+
+def _apply_get_params(model: DefaultMeta, query: BaseQuery, args: dict, default_ordering: Sequence[str] = (),
+                      bounded: bool = True) -> Tuple[BaseQuery, List[Tuple[Column, bool]], Optional[int]]:
+    """Filters and orders the query by the url params and applies the cursor and the offset. Returns the query, the
+    ordering columns with their descending flags and the page size. If the page is not bounded, the size is None
+    unless the limit is given, and it is not restricted by API_MAX_PAGE_SIZE"""
+    model_columns = model.__table__.c.keys()
+    orderable = None
+    ordering = []
+    for key, value in args.items():
+        if key in ('ordered-by', 'ordered-by-desc'):
+            if orderable is None:
+                orderable = get_orderable_columns(model, query)
+            if value not in orderable:
+                logger.info('Abort because of ordering by a column without an index')
+                abort(400, message=f"Results can be ordered only by the indexed columns: {', '.join(orderable)}")
+            ordering.append((model.__table__.c[value], key == 'ordered-by-desc'))
+        elif key.endswith('-like'):
+            attr = key.split('-like')[0]
+            if attr in model_columns and isinstance(model.__table__.c.get(attr).type, String):
+                query = query.filter(getattr(model, attr).ilike(f'%{value}%'))
+        elif key in model_columns:
+            query = query.filter(getattr(model, key) == value)
+    if not ordering:
+        ordering = [(model.__table__.c[name], False) for name in default_ordering]
+    # the primary key makes the order total, so every row is returned by exactly one page
+    primary_key = model.__table__.primary_key.columns
+    ordering.extend((column, ordering[-1][1] if ordering else False) for column in primary_key
+                    if all(column is not ordered for ordered, _ in ordering))
+    query = query.order_by(*[desc(column) if descending else column for column, descending in ordering])
+
+    if 'cursor' in args:
+        query = query.filter(_after_cursor(ordering, args.get('cursor')))
+    if bounded:
+        limit = min(_parse_int(args, 'limit', current_app.config['API_PAGE_SIZE'], 1),
+                    current_app.config['API_MAX_PAGE_SIZE'])
+    else:
+        limit = _parse_int(args, 'limit', None, 1)
+    offset = _parse_int(args, 'offset', None, 0)
+    if offset:
+        query = query.offset(offset)
+    return query, ordering, limit
+
+
+def _after_cursor(ordering: List[Tuple[Column, bool]], cursor: str):
+    """Makes the keyset predicate which selects the rows after the row the cursor was made from. Makes abort with 400,
+    if the cursor is broken or was made for another ordering"""
+    try:
+        key = decode_cursor(cursor, 'order', 'values')
+        if key['order'] != [f"{'-' if descending else ''}{column.name}" for column, descending in ordering] or \
+                len(key['values']) != len(ordering):
+            raise ValueError('Cursor is made for another ordering')
+        values = [datetime.datetime.fromisoformat(value) if isinstance(column.type, DateTime) and value is not None
+                  else value for (column, _), value in zip(ordering, key['values'])]
+    except (ValueError, TypeError):
+        logger.info('Abort because of invalid cursor')
+        abort(400, message='Cursor is not valid')
+    clauses = []
+    for position, ((column, descending), value) in enumerate(zip(ordering, values)):
+        previous_equal = [ordered == ordered_value for (ordered, _), ordered_value in
+                          zip(ordering[:position], values[:position])]
+        clauses.append(and_(*previous_equal, column < value if descending else column > value))
+    return or_(*clauses)
+
+
+def _make_cursor(ordering: List[Tuple[Column, bool]], row: Any) -> str:
+    """Makes the cursor of the next page from the last row of the current one"""
+    values = []
+    for column, _ in ordering:
+        value = getattr(row, column.name)
+        values.append(value.isoformat() if isinstance(value, datetime.datetime) else value)
+    return encode_cursor({'order': [f"{'-' if descending else ''}{column.name}" for column, descending in ordering],
+                          'values': values})
+
+
+def model_filter_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict,
+                               default_ordering: Sequence[str] = ()) -> BaseQuery:
     """
     Here is implemented a search and filtering the model by request url params. There are several possible variants of
     search, and, of course, they can be easily combined to attain the necessary result.
@@ -28,9 +149,16 @@ def model_filter_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict)
             :class:`sqlalchemy.sql.sqltypes.String` and gives the result from sql `LIKE` statement. Common url looks
             like: http://localhost:5000/api/users?username-like=ma
         3. To sort an output use 'ordered-by' and 'ordered-by-desc' parameter and specify db column name to order by:
-            http://localhost:5000/api/users?name-like=a&ordered-by=username
+            http://localhost:5000/api/users?username-like=a&ordered-by=username
+            Only the columns returned by :func:`get_orderable_columns` are allowed, otherwise 400 error is raised. The
+            primary key is always added to the ordering, so the order is total.
         4. To restrict the number of results use 'limit' and 'offset' statements together or separately:
             http://localhost:5000/api/users?name-like=a&ordered-by=username&limit=2&offset=3
+            The number of results is never bigger than API_MAX_PAGE_SIZE, and it is API_PAGE_SIZE, if the limit is not
+            given. An invalid limit or offset leads to 400 error.
+        5. To take the next page use 'cursor' param with 'next' of the previous page given by
+            :func:`paginate_by_get_params`. It is faster than 'offset', because the rows of the previous pages are not
+            read again.
 
         A simple use case is below::
 
@@ -41,7 +169,7 @@ def model_filter_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict)
                 users = User.query
                 users = model_filter_by_get_params(User, users, request.args).all()
 
-    If given params are not valid, they will be ignored.
+    Other invalid params are ignored.
     The function can pe applied for different models and queries and can be expanded if it is necessary.
     :param model: model base class
     :type model: DefaultMeta
@@ -49,28 +177,159 @@ def model_filter_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict)
     :type query: BaseQuery
     :param args: url query parameters
     :type args: dict
+    :param default_ordering: names of the columns to order by, if the ordering is not given by the params
+    :type default_ordering: Sequence[str]
     :return: not executed filtered query object
     :rtype: BaseQuery
     """
-    model_columns = model.__table__.c.keys()
-    for key, value in args.items():
-        if key == 'ordered-by':
-            if value in model_columns:
-                query = query.order_by(getattr(model, value))
-        elif key == 'ordered-by-desc':
-            if value in model_columns:
-                query = query.order_by(desc(getattr(model, value)))
-        elif key.endswith('-like'):
-            attr = key.split('-like')[0]
-            if attr in model_columns and isinstance(model.__table__.c.get(attr).type, String):
-                query = query.filter(getattr(model, attr).ilike(f'%{value}%'))
-        elif key in model_columns:
-            query = query.filter(getattr(model, key) == value)
-    if 'limit' in args:
-        query = query.limit(int(args.get('limit')))
-    if 'offset' in args:
-        query = query.offset(int(args.get('offset')))
-    return query
+    query, _, limit = _apply_get_params(model, query, args, default_ordering)
+    return query.limit(limit)
+
+
+def paginate_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict,
+                           default_ordering: Sequence[str] = ()) -> dict:
+    """
+    Executes the query filtered by :func:`model_filter_by_get_params` and returns one page of results with the
+    pagination metadata: 'has_more' tells whether there are more results, and 'next' is the cursor of the next page
+    or None.
+    :param model: model base class
+    :type model: DefaultMeta
+    :param query: not executed query object to filtering
+    :type query: BaseQuery
+    :param args: url query parameters
+    :type args: dict
+    :param default_ordering: names of the columns to order by, if the ordering is not given by the params
+    :type default_ordering: Sequence[str]
+    :return: dict with 'data', 'next' and 'has_more' keys
+    :rtype: dict
+    """
+    query, ordering, limit = _apply_get_params(model, query, args, default_ordering)
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {'data': rows, 'next': _make_cursor(ordering, rows[-1]) if has_more else None, 'has_more': has_more}
+
+
+class StreamedPage:
+    """
+    Rows of a page which are fetched from the database by chunks of API_STREAM_CHUNK_SIZE rows through a server side
+    cursor, so only one chunk is kept in memory. The query is executed when the page is made, and the rows can be
+    iterated once. 'next' and 'has_more' are known when the iteration is finished.
+    :param query: filtered and ordered query
+    :type query: BaseQuery
+    :param ordering: ordering columns with their descending flags
+    :type ordering: list
+    :param limit: the maximum number of rows or None for all of them
+    :type limit: int
+    """
+
+    def __init__(self, query: BaseQuery, ordering: List[Tuple[Column, bool]], limit: Optional[int] = None):
+        if limit is not None:
+            query = query.limit(limit + 1)
+        chunk_size = current_app.config['API_STREAM_CHUNK_SIZE']
+        self.rows = iter(query.execution_options(stream_results=True).yield_per(chunk_size))
+        self.ordering = ordering
+        self.limit = limit
+        self.next = None
+        self.has_more = False
+
+    def __iter__(self) -> Iterator[Any]:
+        last = None
+        for number, row in enumerate(self.rows):
+            if number == self.limit:
+                self.has_more = True
+                self.next = _make_cursor(self.ordering, last)
+                break
+            yield row
+            last = row
+
+
+def stream_by_get_params(model: DefaultMeta, query: BaseQuery, args: dict,
+                         default_ordering: Sequence[str] = ()) -> StreamedPage:
+    """
+    Filters the query like :func:`paginate_by_get_params` and returns its rows as :class:`StreamedPage`. Unlike pages
+    of lists, all the results are returned if the limit is not given, and API_MAX_PAGE_SIZE is not applied.
+    :param model: model base class
+    :type model: DefaultMeta
+    :param query: not executed query object to filtering
+    :type query: BaseQuery
+    :param args: url query parameters
+    :type args: dict
+    :param default_ordering: names of the columns to order by, if the ordering is not given by the params
+    :type default_ordering: Sequence[str]
+    :return: lazily fetched rows
+    :rtype: StreamedPage
+    """
+    query, ordering, limit = _apply_get_params(model, query, args, default_ordering, bounded=False)
+    return StreamedPage(query, ordering, limit)
+
+
+def search_messages_by_get_params(args: dict, user_id: int = None, chat_id: int = None) -> dict:
+    """
+    Makes full-text search of messages by 'q' url param (see :meth:`Message.search`) and returns one page of found
+    messages ordered by relevance, with 'q' and the pagination metadata like :func:`paginate_by_get_params` does. The
+    page size is given by 'limit' param, and the next page is taken by 'cursor' param. Makes abort with 400, if 'q' has
+    no words, or the limit or the cursor are invalid.
+    :param args: url query parameters
+    :type args: dict
+    :param user_id: if it is given, only messages of the user are searched
+    :type user_id: int
+    :param chat_id: if it is given, only messages of the chat are searched
+    :type chat_id: int
+    :return: dict with 'q', 'data', 'next' and 'has_more' keys
+    :rtype: dict
+    """
+    search_string = args.get('q', '').strip()
+    if not search_string:
+        logger.info('Abort because of empty search string')
+        abort(400, message="'q' param with words to search is required")
+    limit = min(_parse_int(args, 'limit', current_app.config['API_PAGE_SIZE'], 1),
+                current_app.config['API_MAX_PAGE_SIZE'])
+    after = None
+    if 'cursor' in args:
+        try:
+            key = decode_cursor(args.get('cursor'), 'rank', 'message_id', rank=(int, float), message_id=int)
+            after = (float(key['rank']), key['message_id'])
+        except (ValueError, TypeError):
+            logger.info('Abort because of invalid cursor')
+            abort(400, message='Cursor is not valid')
+    rows = Message.search(search_string, user_id=user_id, chat_id=chat_id, after=after, limit=limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor({'rank': rows[-1].rank, 'message_id': rows[-1].message_id}) if has_more else None
+    return {'q': search_string, 'data': rows, 'next': next_cursor, 'has_more': has_more}
+
+
+def make_etag(*parts: Any) -> str:
+    """
+    Makes an entity tag of a response from the values it depends on, e.g. the chat version, the current user and the
+    url params. Tags are weak, because the same data can be encoded differently, e.g. by another json backend.
+    :param parts: values whose repr defines the response
+    :type parts: Any
+    :return: unquoted entity tag
+    :rtype: str
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def etag_header(etag: str) -> dict:
+    """Returns ETag header of a response with the tag given by :func:`make_etag`"""
+    return {'ETag': quote_etag(etag, weak=True)}
+
+
+def not_modified_or_none(etag: str) -> Optional[Response]:
+    """
+    Returns an empty response with 304 status, if the client already has the response with the given entity tag (it is
+    in If-None-Match header), otherwise None. Views return it before querying and serializing the data.
+    :param etag: tag given by :func:`make_etag`
+    :type etag: str
+    :return: 304 response or None
+    :rtype: Response
+    """
+    if request.if_none_match.contains_weak(etag):
+        logger.info('Response is not modified')
+        return current_app.response_class(status=304, headers=etag_header(etag))
+    return None
 
 
 def longer_than_zero(value: Any) -> str:
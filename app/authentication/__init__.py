@@ -2,7 +2,6 @@
 import logging
 
 from flask import Blueprint
-from flask import g
 
 authentication = Blueprint('authentication', __name__, url_prefix='/authentication')
 logger = logging.getLogger(__name__)
@@ -13,7 +12,8 @@ logger.info('Authentication blueprint is being loaded')
 def insert_user():
     """Adds variable `user` into a context of each template. if it is not None, the current user has logged in.
     If it is None, the current user is anonymous"""
-    return {'user': g.user}
+    from .views import load_logged_in_user
+    return {'user': load_logged_in_user()}
 
 
 from .models import User
@@ -1,23 +1,41 @@
 """Main models to realize an authentication. Chats table is also specified here in order to prevent from circular
 import with app/chats/models.py"""
 import datetime
-from functools import lru_cache
 
 from flask import current_app
-from itsdangerous import TimedJSONWebSignatureSerializer
-from sqlalchemy import and_, exists
+from sqlalchemy import and_, event
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached, object_session
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from app import db
+from app.cache import chat_cache, search_cache, user_cache
 from app.authentication.email import send_mail
 from app.authentication.exceptions import UserNotFoundByIndexError
+from app.authentication.tokens import dump_token, load_token, make_authentication_token
 from app.chats.exceptions import ChatNotFoundByIndexesError, ChatAlreadyExistsError
+from app.routing import reads_from_replica
 from . import logger
 
 chats = db.Table('chats',
                  db.Column('chat_id', db.Integer, primary_key=True),
                  db.Column('user1_id', db.Integer, db.ForeignKey('users.user_id'), nullable=False),
-                 db.Column('user2_id', db.Integer, db.ForeignKey('users.user_id'), nullable=False))
+                 db.Column('user2_id', db.Integer, db.ForeignKey('users.user_id'), nullable=False),
+                 # the last message is denormalized to read the list of user's chats without scanning messages.
+                 # It is kept up to date by app/chats/models.py
+                 db.Column('last_message_id', db.Integer),
+                 db.Column('last_message_at', db.DateTime),
+                 db.Column('last_message_preview', db.String(100)),
+                 # incremented whenever a message of the chat is inserted, edited or deleted, so the api can tell
+                 # clients that their copy of the messages is still valid (see app/api/utils.py)
+                 db.Column('version', db.Integer, nullable=False, server_default='0'),
+                 db.UniqueConstraint('user1_id', 'user2_id', name='uq_chats_user1_id_user2_id'),
+                 db.Index('ix_chats_user1_id_last_message_at', 'user1_id', 'last_message_at'),
+                 db.Index('ix_chats_user2_id_last_message_at', 'user2_id', 'last_message_at'))
+
+
+USER_CACHED_COLUMNS = ('user_id', 'username', 'email', 'name', 'date_joined')
 
 
 class User(db.Model):
@@ -58,6 +76,27 @@ class User(db.Model):
             raise UserNotFoundByIndexError
         return user
 
+    @classmethod
+    def get_cached_user_by_id(cls, user_id: int) -> 'User':
+        """
+        Works like :meth:`get_user_by_id`, but keeps the user's columns in user_cache, so the logged in user is not
+        queried on every request. The password hash is never cached, it is loaded from the database on access.
+        Entries are invalidated when the user is updated or deleted.
+        :param user_id: id of the user
+        :type user_id: int
+        :return: user, attached to the current session
+        :rtype: User
+        """
+        columns = user_cache.get(user_id)
+        if columns is None:
+            user = cls.get_user_by_id(user_id)
+            if not reads_from_replica(db.session):
+                user_cache.set(user_id, {column: getattr(user, column) for column in USER_CACHED_COLUMNS})
+            return user
+        user = cls(**columns)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def send_email(self, subject: str, text: str):
         """Sends an e-mail with given subject and text to the current user"""
         send_mail(self.email, subject, text)
@@ -72,10 +111,7 @@ class User(db.Model):
         """
         if not expiration_period:
             expiration_period = current_app.config['PASSWORD_DEFAULT_EXPIRES_IN']
-        secret_key = current_app.config['SECRET_KEY']
-        serializer = TimedJSONWebSignatureSerializer(secret_key, expiration_period)
-        token = serializer.dumps({'user_id': self.user_id}).decode()
-        return token
+        return dump_token({'user_id': self.user_id}, expiration_period)
 
     @classmethod
     def get_user_by_reset_password_token(cls, token: str) -> 'User':
@@ -86,24 +122,24 @@ class User(db.Model):
         :returns: user with received id
         :rtype User
         """
-        serializer = TimedJSONWebSignatureSerializer(current_app.config['SECRET_KEY'])
-        user_id = serializer.loads(token)['user_id']
+        user_id = load_token(token)[0]['user_id']
         return cls.get_user_by_id(user_id)
 
     @staticmethod
     def create_chat(user1_id: int, user2_id: int):
         """Crete a note in chats table which connects two user in chat.
         Params can be given in an arbitrary order, so only ascending sequence of users ids will be saved to DB.
-        If a chats between given users already exists, error will be thrown.
+        If a chats between given users already exists, error will be thrown. It is decided by the unique constraint of
+        the users ids, not by chat_cache, whose entry can be stale, e.g. if another worker has just made the chat.
         db.session must be committed after executing the function to save changes.
         :param user1_id: first user's id to check
         :param user2_id: second user's id to check"""
         user1_id, user2_id = sorted([user1_id, user2_id])
-        if not User.is_chat_between(user1_id, user2_id):
-            db.session.execute(chats.insert(
-                values=[{'user1_id': user1_id, 'user2_id': user2_id}, ]))
-            User.is_chat_between.cache_clear()
-        else:
+        dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        insert = dialect.insert(chats).values(user1_id=user1_id, user2_id=user2_id)
+        result = db.session.execute(insert.on_conflict_do_nothing(index_elements=[chats.c.user1_id, chats.c.user2_id]))
+        chat_cache.invalidate(db.session, f'{user1_id}:{user2_id}')
+        if not result.rowcount:
             logger.info("Chat already exists when create_chat method is executed")
             raise ChatAlreadyExistsError
 
@@ -119,24 +155,21 @@ class User(db.Model):
         :type chat_id: int
         """
         chat_id = chat_id or User.get_chat_id_by_users_ids(*two_users_ids)
+        chat_users = db.session.query(chats.c.user1_id, chats.c.user2_id).filter(chats.c.chat_id == chat_id).first()
         db.session.execute(chats.delete().where(chats.c.chat_id == chat_id))
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        if chat_users:
+            chat_cache.invalidate(db.session, f'{chat_users.user1_id}:{chat_users.user2_id}')
 
     @staticmethod
-    @lru_cache(maxsize=256)
     def is_chat_between(user1_id: int, user2_id: int) -> bool:
         """Check if two users have chat together.
         :param user1_id: first user's id to check
         :param user2_id: second user's id to check
         :returns boolean value: if it is true, users have already had chat together.
         If it is false - they have not had"""
-        user1_id, user2_id = sorted([user1_id, user2_id])
-        return db.session.query(
-            exists(chats).where(and_(chats.c.user1_id == user1_id, chats.c.user2_id == user2_id))).scalar()
+        return bool(User._get_cached_chat_id(user1_id, user2_id))
 
     @staticmethod
-    @lru_cache(maxsize=256)
     def get_chat_id_by_users_ids(user1_id: int, user2_id: int) -> int:
         """
         Return a unique chat's id which connects two users from given ids. If a chat does not exist, raises error.
@@ -147,18 +180,40 @@ class User(db.Model):
         :return: chat id
         :rtype:int
         """
-        user1_id, user2_id = sorted([user1_id, user2_id])
-        chat_id = db.session.query(chats.c.chat_id).filter(
-            and_(chats.c.user1_id == user1_id, chats.c.user2_id == user2_id)).scalar()
+        chat_id = User._get_cached_chat_id(user1_id, user2_id)
         if not chat_id:
             logger.warning('Chat must be found by index, but it is not')
             raise ChatNotFoundByIndexesError
         return chat_id
 
+    @staticmethod
+    def _get_cached_chat_id(user1_id: int, user2_id: int) -> int:
+        """
+        Returns id of the chat between two users or 0, if they do not have a chat. Both answers are kept in chat_cache
+        by the key 'user1_id:user2_id' with ascending ids, which is invalidated by :meth:`create_chat` and
+        :meth:`delete_chat`.
+        :param user1_id: first user's id.
+        :type user1_id: int
+        :param user2_id: second user's id.
+        :type user2_id: int
+        :return: chat id or 0
+        :rtype: int
+        """
+        user1_id, user2_id = sorted([user1_id, user2_id])
+        key = f'{user1_id}:{user2_id}'
+        chat_id = chat_cache.get(key)
+        if chat_id is None:
+            chat_id = db.session.query(chats.c.chat_id).filter(
+                and_(chats.c.user1_id == user1_id, chats.c.user2_id == user2_id)).scalar() or 0
+            # a replica can miss a just created chat
+            if not reads_from_replica(db.session):
+                chat_cache.set(key, chat_id)
+        return chat_id
+
     def get_authentication_token(self, expires_in: int = None) -> str:
         """
         Generates authentication token for the current user so that he can access the secure functionality without
-        putting login and password every request.
+        putting login and password every request. The token contains user_id, username and the token id to revoke it.
         :param expires_in: time in seconds which must go by before the token is spoilt. If nothing is put, a default
         value will be chosen.
         :type expires_in: int
@@ -167,8 +222,7 @@ class User(db.Model):
         """
         if not expires_in:
             expires_in = current_app.config['AUTHENTICATION_TOKEN_DEFAULT_EXPIRES_IN']
-        serializer = TimedJSONWebSignatureSerializer(current_app.config['SECRET_KEY'], expires_in)
-        return serializer.dumps({'user_id': self.user_id}).decode()
+        return make_authentication_token(self.user_id, self.username, expires_in)
 
     @staticmethod
     def get_user_by_authentication_token(token: str) -> 'User':
@@ -180,6 +234,31 @@ class User(db.Model):
         :return: User instance
         :rtype: User
         """
-        serializer = TimedJSONWebSignatureSerializer(current_app.config['SECRET_KEY'])
-        user_id = serializer.loads(token)['user_id']
+        user_id = load_token(token)[0]['user_id']
         return User.get_user_by_id(user_id)
+
+
+@event.listens_for(User, 'after_insert')
+def invalidate_search_results(mapper, connection, user: User):
+    """Clears the cached search results, because the registered user can be found by any of them"""
+    search_cache.invalidate_all(object_session(user))
+
+
+@event.listens_for(User, 'after_update')
+def invalidate_cached_user(mapper, connection, user: User):
+    """Removes the changed user from user_cache, e.g. after the profile update or the password reset. If the user was
+    renamed, the cached search results become invalid too. Cached credentials do not need it, they are bound to the
+    password hash"""
+    session = object_session(user)
+    user_cache.invalidate(session, user.user_id)
+    state = inspect(user)
+    if state.attrs.name.history.has_changes() or state.attrs.username.history.has_changes():
+        search_cache.invalidate_all(session)
+
+
+@event.listens_for(User, 'after_delete')
+def invalidate_deleted_user(mapper, connection, user: User):
+    """Removes the deleted user and the search results from the caches"""
+    session = object_session(user)
+    user_cache.invalidate(session, user.user_id)
+    search_cache.invalidate_all(session)
@@ -0,0 +1,196 @@
+"""Signed json web tokens of the application. Serializers are reused for each secret key and expiration period instead
+of being created on every call. Authentication tokens carry the claims which api handlers need (user_id and username)
+and a token id, so a request authorized by a token does not load the user until a handler needs other fields.
+Tokens can be revoked before their expiration, the revoked token ids are kept in memory of the process until the
+tokens expire. Revocations are sent to the other workers through SOCKETIO_MESSAGE_QUEUE (see app/message_queue.py), and
+with REVOKED_TOKENS_URL they are also kept in redis or in the store of the local broker, so they survive restarts of
+the workers.
+"""
+import functools
+import heapq
+import secrets
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
+
+from flask import Flask, current_app
+from itsdangerous import TimedJSONWebSignatureSerializer
+
+from app.cache import make_cache_backend
+from app.stats import register_stats_provider
+from . import logger
+
+if TYPE_CHECKING:
+    from .models import User
+
+
+@functools.lru_cache(maxsize=64)
+def get_serializer(secret_key: str, expires_in: float = None) -> TimedJSONWebSignatureSerializer:
+    """
+    Returns a serializer for the given secret key and expiration period. It is created only once, because making a
+    serializer is much more expensive than signing a token by it.
+    :param secret_key: key to sign tokens
+    :type secret_key: str
+    :param expires_in: seconds before the expiration of signed tokens, the default one of itsdangerous is used if None
+    :type expires_in: float
+    :return: serializer
+    :rtype: TimedJSONWebSignatureSerializer
+    """
+    return TimedJSONWebSignatureSerializer(secret_key, expires_in)
+
+
+def dump_token(payload: dict, expires_in: float = None) -> str:
+    """Signs the payload with the application secret key"""
+    return get_serializer(current_app.config['SECRET_KEY'], expires_in).dumps(payload).decode()
+
+
+def load_token(token: str) -> Tuple[dict, dict]:
+    """
+    Checks the signature and the expiration of the token. Raises BadSignature or SignatureExpired if it is not valid.
+    :param token: token string
+    :type token: str
+    :return: the payload and the header, which contains the expiration timestamp 'exp'
+    :rtype: tuple
+    """
+    return get_serializer(current_app.config['SECRET_KEY']).loads(token, return_header=True)
+
+
+def make_authentication_token(user_id: int, username: str, expires_in: float) -> str:
+    """
+    Makes an authentication token with the claims user_id, username and the unique token id jti.
+    :param user_id: id of the user
+    :type user_id: int
+    :param username: username of the user
+    :type username: str
+    :param expires_in: seconds before the expiration
+    :type expires_in: float
+    :return: token
+    :rtype: str
+    """
+    return dump_token({'user_id': user_id, 'username': username, 'jti': secrets.token_hex(8)}, expires_in)
+
+
+class TokenUser:
+    """
+    The user recognized by an authentication token. The claims of the token are available at once, the user
+    instance is loaded only if another attribute is used. The username claim is taken at the moment of signing, so it
+    can be stale.
+    :param claims: payload of the token
+    :type claims: dict
+    """
+
+    def __init__(self, claims: dict):
+        self.user_id = claims['user_id']
+        if 'username' in claims:
+            self.username = claims['username']
+        self._user = None
+
+    @property
+    def user(self) -> 'User':
+        """The full user instance, which is loaded on the first access"""
+        if self._user is None:
+            from .models import User
+            self._user = User.get_cached_user_by_id(self.user_id)
+        return self._user
+
+    def __getattr__(self, name: str):
+        return getattr(self.user, name)
+
+    def __repr__(self) -> str:
+        return f'TokenUser - {self.user_id}'
+
+
+class RevocationList:
+    """
+    Ids of revoked tokens with their expiration timestamps. A revoked token is forgotten when it expires, because it is
+    not valid anyway, so the list keeps only the tokens revoked during the last expiration period. Revocations are
+    given to the publisher, which sends them to the lists of other processes, and to the shared store, if it is
+    configured by REVOKED_TOKENS_URL.
+    """
+
+    def __init__(self):
+        self.expirations = {}
+        self.heap = []
+        self.lock = threading.Lock()
+        self.publisher = None
+        self.store = None
+
+    def init_app(self, app: Flask):
+        """Makes the shared store from REVOKED_TOKENS_URL, the list is kept only in the process without it"""
+        url = app.config.get('REVOKED_TOKENS_URL')
+        self.store = make_cache_backend(url, prefix='revoked_tokens:') if url else None
+
+    def set_publisher(self, publisher: Optional[Callable[[str, float], None]]):
+        """
+        Sets the function which sends revocations to the other processes, they apply them by :meth:`revoke` with
+        publish=False.
+        :param publisher: the function called with the token id and the expiration, or None if there is one process
+        """
+        self.publisher = publisher
+
+    def revoke(self, token_id: str, expires_at: float, publish: bool = True):
+        """
+        Adds the token to the list, to the shared store and sends it to the other processes.
+        :param token_id: jti claim of the token
+        :type token_id: str
+        :param expires_at: unix timestamp of the token expiration
+        :type expires_at: float
+        :param publish: False if the revocation has come from another process
+        :type publish: bool
+        """
+        with self.lock:
+            self._prune()
+            if token_id not in self.expirations:
+                self.expirations[token_id] = expires_at
+                heapq.heappush(self.heap, (expires_at, token_id))
+        if not publish:
+            return
+        if self.store is not None:
+            try:
+                self.store.set(token_id, expires_at, ttl=max(expires_at - time.time(), 1))
+            except Exception:
+                logger.exception('Revoked token cannot be saved into the shared store')
+        if self.publisher is not None:
+            try:
+                self.publisher(token_id, expires_at)
+            except Exception:
+                logger.exception('Token revocation could not be published')
+
+    def is_revoked(self, token_id: str) -> bool:
+        """Checks whether the token with the given jti has been revoked by this process, by another one or before a
+        restart"""
+        if token_id is None:
+            return False
+        with self.lock:
+            self._prune()
+            if token_id in self.expirations:
+                return True
+        if self.store is None:
+            return False
+        try:
+            expires_at = self.store.get(token_id)
+        except Exception:
+            logger.exception('Revoked tokens cannot be read from the shared store')
+            return False
+        if expires_at is None:
+            return False
+        self.revoke(token_id, expires_at, publish=False)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.expirations.clear()
+            self.heap.clear()
+
+    def __len__(self) -> int:
+        return len(self.expirations)
+
+    def _prune(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, token_id = heapq.heappop(self.heap)
+            self.expirations.pop(token_id, None)
+
+
+revoked_tokens = RevocationList()
+register_stats_provider('revoked_tokens', lambda: {'size': len(revoked_tokens)})
@@ -18,13 +18,35 @@ from app.authentication.validators import validate_equal_passwords, validate_ema
 from app.authentication.validators import validate_length
 
 
+# endpoints which do not use the logged in user, the api authorizes users by itself
+ANONYMOUS_ENDPOINTS = {'static', 'view.stats'}
+ANONYMOUS_BLUEPRINTS = {'api'}
+
+
 @auth_bp.before_app_request
 def recognize_logged_in_user():
     """Before each request to the server the function takes user id from the session, receives user instance by the id
-    and add him to flask application context variable. So, each view has an access to the current logged in user"""
-    current_user_id = session.get('current_user_id')
-    user = User.get_user_by_id(current_user_id) if current_user_id is not None else None
-    setattr(g, 'user', user)
+    and add him to flask application context variable. So, each view has an access to the current logged in user.
+    Static files, api and not found urls are skipped, for them the user is loaded only if a template needs it"""
+    # g can be shared by several requests, when the application context has been pushed before them
+    g.pop('user', None)
+    if request.endpoint is None or request.endpoint in ANONYMOUS_ENDPOINTS or request.blueprint in ANONYMOUS_BLUEPRINTS:
+        return
+    load_logged_in_user()
+
+
+def load_logged_in_user() -> User:
+    """
+    Returns the logged in user from g or loads him by the id from the session. The user is taken from user_cache, so
+    usually no queries are made.
+    :return: the current user or None, if the user is anonymous
+    :rtype: User
+    """
+    if 'user' not in g:
+        current_user_id = session.get('current_user_id')
+        user = User.get_cached_user_by_id(current_user_id) if current_user_id is not None else None
+        setattr(g, 'user', user)
+    return g.user
 
 
 class LoginView(MethodView):
@@ -0,0 +1,387 @@
+"""Caches for the data which is read much more often than it is changed, like the chat between two users. A cache is a
+flask extension configured by the settings with its prefix:
+    - <PREFIX>_URL - backend of the cache. If it is empty, every process keeps its own LRU cache with TTL. Use
+      redis://... or unix:///path/to/broker.sock (the store of the local broker, see app/message_queue.py) to share
+      the cache between worker processes, so an invalidation in one worker is seen by all the others. Process local
+      caches of several workers are invalidated by messages of SOCKETIO_MESSAGE_QUEUE, which come to the other
+      workers a moment after the commit, so their entries can be stale for this moment;
+    - <PREFIX>_SIZE - the maximum number of entries in a process local cache;
+    - <PREFIX>_TTL - seconds after which an entry expires.
+The hits, misses and the evictions of a local cache are reported by /stats.
+
+:Example:
+    chat_cache = Cache('CHAT_CACHE')
+    chat_cache.init_app(app)
+    chat_id = chat_cache.get('1:2')
+    if chat_id is None:
+        chat_id = load_chat_id(1, 2)
+        chat_cache.set('1:2', chat_id)
+"""
+import pickle
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import logger
+from .stats import register_stats_provider
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+_INVALIDATED_KEYS = 'invalidated_cache_keys'
+# caches by their config prefixes, to apply invalidations received from other processes
+_caches = {}
+# sends invalidations of process local caches to other processes, see :func:`set_invalidation_publisher`
+_invalidation_publisher = None
+
+
+class LocalCache:
+    """
+    Thread safe in-process LRU cache, whose entries expire after ttl seconds.
+    :param size: the maximum number of entries, the least recently used one is evicted when it is exceeded
+    :type size: int
+    :param ttl: default time to live of entries in seconds, None means forever
+    :type ttl: float
+    """
+    name = 'local'
+
+    def __init__(self, size: int = 1024, ttl: float = None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the value or None, if there is no such a key or the entry has expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        """Saves the value, if ttl is not given, the default one is used"""
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys: Hashable):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """Deletes all the entries. The counters of evictions and expirations are kept"""
+        with self.lock:
+            self.entries.clear()
+
+    def reset_stats(self):
+        with self.lock:
+            self.evictions = 0
+            self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class RedisCache:
+    """
+    Cache shared by all the processes through redis. Values are pickled.
+    :param url: redis url, like redis://localhost:6379/0
+    :type url: str
+    :param ttl: default time to live of entries in seconds
+    :type ttl: float
+    :param prefix: prefix of the keys, which separates caches in one redis database
+    :type prefix: str
+    """
+    name = 'redis'
+
+    def __init__(self, url: str, ttl: float = None, prefix: str = ''):
+        if redis is None:
+            raise RuntimeError('Redis package is not installed (Run "pip install redis" in your virtualenv).')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value = self.client.get(f'{self.prefix}{key}')
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        ttl = ttl if ttl is not None else self.ttl
+        self.client.set(f'{self.prefix}{key}', pickle.dumps(value), px=int(ttl * 1000) if ttl is not None else None)
+
+    def delete(self, *keys: Hashable):
+        if keys:
+            self.client.delete(*[f'{self.prefix}{key}' for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+
+class BrokerCache:
+    """
+    Cache shared by all the processes on one machine through the store of the local broker. It is a stand-in for
+    :class:`RedisCache`, when redis is not available. Values are pickled.
+    :param url: url of the local broker, like unix:///tmp/flask-simple-chats.sock
+    :type url: str
+    :param ttl: default time to live of entries in seconds
+    :type ttl: float
+    :param prefix: prefix of the keys, which separates caches in one broker
+    :type prefix: str
+    """
+    name = 'local-broker'
+
+    def __init__(self, url: str, ttl: float = None, prefix: str = ''):
+        self.path = url[len('unix://'):]
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local = threading.local()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        found, value = self._request(b'get', f'{self.prefix}{key}'.encode())
+        return pickle.loads(value) if found else None
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        ttl = ttl if ttl is not None else self.ttl
+        self._request(b'set', str(ttl if ttl is not None else '').encode(), f'{self.prefix}{key}'.encode(),
+                      pickle.dumps(value))
+
+    def delete(self, *keys: Hashable):
+        if keys:
+            self._request(b'delete', *[f'{self.prefix}{key}'.encode() for key in keys])
+
+    def clear(self):
+        self._request(b'clear', self.prefix.encode())
+
+    def _request(self, *parts: bytes):
+        """Sends the command to the broker by the connection of the current thread and returns the answer"""
+        from .message_queue import STORE, encode_parts, receive_frame, send_frame
+        for retry in (True, False):
+            sock = getattr(self.local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(self.path)
+                    send_frame(sock, STORE)
+                    self.local.sock = sock
+                send_frame(sock, encode_parts(parts))
+                answer = receive_frame(sock)
+                if answer is None:
+                    raise ConnectionError('Local broker closed the connection')
+                return answer[:1] == b'1', answer[1:]
+            except OSError:
+                self.local.sock = None
+                if not retry:
+                    raise
+
+
+def make_cache_backend(url: str = None, size: int = 1024, ttl: float = None, prefix: str = ''):
+    """
+    Chooses the cache backend according to the url.
+    :param url: redis://... or unix://... for a shared cache. If it is empty, a process local cache is used
+    :type url: str
+    :param size: the maximum number of entries of a local cache
+    :type size: int
+    :param ttl: default time to live of entries in seconds
+    :type ttl: float
+    :param prefix: prefix of the keys in a shared cache
+    :type prefix: str
+    :return: cache backend
+    """
+    if not url:
+        return LocalCache(size, ttl)
+    if url.startswith('unix://'):
+        return BrokerCache(url, ttl, prefix)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisCache(url, ttl, prefix)
+    raise ValueError(f'Unknown cache url: {url}')
+
+
+class Cache:
+    """
+    Flask extension which counts hits and misses of the configured backend. Values cannot be None, because None means a
+    miss. If the backend is not available, the cache is bypassed: misses are returned and changes are skipped, so the
+    data is read from the database.
+    :param config_prefix: prefix of the settings of the cache, it is also used as the prefix of the keys
+    :type config_prefix: str
+    """
+
+    def __init__(self, config_prefix: str):
+        self.config_prefix = config_prefix
+        self.backend = LocalCache()
+        self._reset_stats()
+        _caches[config_prefix] = self
+        register_stats_provider(config_prefix.lower(), self.stats)
+
+    def init_app(self, app: Flask):
+        """Makes the backend from the application settings. The entries cached for the previous application are lost"""
+        self.backend = make_cache_backend(app.config.get(f'{self.config_prefix}_URL'),
+                                          app.config[f'{self.config_prefix}_SIZE'],
+                                          app.config[f'{self.config_prefix}_TTL'],
+                                          f'{self.config_prefix.lower()}:')
+        self._reset_stats()
+        app.extensions[self.config_prefix.lower()] = self
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            logger.exception(f'{self.config_prefix} get failed')
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        try:
+            self.backend.set(key, value, ttl)
+        except Exception:
+            logger.exception(f'{self.config_prefix} set failed')
+
+    def delete(self, *keys: Hashable):
+        try:
+            self.backend.delete(*keys)
+        except Exception:
+            logger.exception(f'{self.config_prefix} delete failed')
+
+    def invalidate(self, session: Session, *keys: Hashable):
+        """
+        Deletes the keys right now and once more after the transaction of the session is committed or rolled back.
+        Otherwise, a concurrent request could cache the data which is not committed yet, or it could be cached before
+        the commit, when other processes still see the old data.
+        :param session: the session with the changes of the cached data
+        :type session: Session
+        :param keys: keys to delete
+        """
+        self.delete(*keys)
+        session.info.setdefault(_INVALIDATED_KEYS, []).append((self, keys))
+
+    def invalidate_all(self, session: Session):
+        """
+        Clears the cache right now and once more after the transaction of the session is finished, like
+        :meth:`invalidate`. It is meant for caches whose entries can be changed by any update, e.g. search results.
+        The statistics are kept.
+        :param session: the session with the changes of the cached data
+        :type session: Session
+        """
+        self.clear(reset_stats=False)
+        session.info.setdefault(_INVALIDATED_KEYS, []).append((self, None))
+
+    def clear(self, reset_stats: bool = True):
+        try:
+            self.backend.clear()
+        except Exception:
+            logger.exception(f'{self.config_prefix} clear failed')
+        if reset_stats:
+            self._reset_stats()
+
+    def stats(self) -> dict:
+        """Returns the backend name, hits, misses, hit rate, and the size and the evictions of a local cache"""
+        requests = self.hits + self.misses
+        local = isinstance(self.backend, LocalCache)
+        return {'backend': self.backend.name,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 4) if requests else 0,
+                'size': len(self.backend) if local else None,
+                'evictions': self.backend.evictions if local else None,
+                'expirations': self.backend.expirations if local else None}
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        if isinstance(self.backend, LocalCache):
+            self.backend.reset_stats()
+
+
+def set_invalidation_publisher(publisher: Optional[Callable[[str, Optional[list]], None]]):
+    """
+    Sets the function which sends the invalidations of process local caches to the other processes. It is called with
+    the cache config prefix and the list of keys, or None if the whole cache is invalidated. The other processes apply
+    it by :func:`apply_invalidation`.
+    :param publisher: the function or None, if there is only one process
+    """
+    global _invalidation_publisher
+    _invalidation_publisher = publisher
+
+
+def apply_invalidation(cache_name: str, keys: Optional[Iterable[Hashable]]):
+    """
+    Deletes the keys from the process local cache, or clears it if keys are None. It is called when another process
+    has invalidated them. Shared caches are skipped, they have been invalidated by that process.
+    :param cache_name: the config prefix of the cache
+    :type cache_name: str
+    :param keys: keys to delete or None
+    """
+    cache = _caches.get(cache_name)
+    if cache is None or not isinstance(cache.backend, LocalCache):
+        return
+    if keys is None:
+        cache.clear(reset_stats=False)
+    else:
+        cache.delete(*keys)
+
+
+def _publish_invalidation(cache: Cache, keys: Optional[tuple]):
+    if _invalidation_publisher is None or not isinstance(cache.backend, LocalCache):
+        return
+    try:
+        _invalidation_publisher(cache.config_prefix, list(keys) if keys is not None else None)
+    except Exception:
+        logger.exception(f'{cache.config_prefix} invalidation could not be published')
+
+
+def _finish_invalidations(session: Session, committed: bool):
+    for cache, keys in session.info.pop(_INVALIDATED_KEYS, []):
+        if keys is None:
+            cache.clear(reset_stats=False)
+        else:
+            cache.delete(*keys)
+        if committed:
+            _publish_invalidation(cache, keys)
+
+
+@event.listens_for(Session, 'after_commit')
+def delete_committed_keys(session: Session):
+    """Repeats deleting the keys given to :meth:`Cache.invalidate` and clearing by :meth:`Cache.invalidate_all`, when
+    the transaction is committed, and sends the invalidations of process local caches to the other processes"""
+    _finish_invalidations(session, committed=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def delete_invalidated_keys(session: Session):
+    """Repeats deleting the keys given to :meth:`Cache.invalidate` and clearing by :meth:`Cache.invalidate_all`, when
+    the transaction is rolled back"""
+    _finish_invalidations(session, committed=False)
+
+
+chat_cache = Cache('CHAT_CACHE')
+user_cache = Cache('USER_CACHE')
+credentials_cache = Cache('CREDENTIALS_CACHE')
+recent_writers_cache = Cache('RECENT_WRITERS_CACHE')
+search_cache = Cache('SEARCH_CACHE')
@@ -16,3 +16,7 @@ chats.add_url_rule('/begin/<string:companion_username>', view_func=UserChatBegin
 chats.add_url_rule('/going', view_func=UsersChatGoing.as_view('going'))
 chats.add_url_rule('/end', view_func=UserChatEnd.as_view('end'))
 chats.add_url_rule('/search', view_func=UserSearchForChat.as_view('search'))
+
+from .utils import to_timestamp_milliseconds
+
+chats.add_app_template_filter(to_timestamp_milliseconds, 'timestamp_milliseconds')
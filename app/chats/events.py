@@ -1,16 +1,29 @@
 """Socket io events to keep connection with a client, receive and send messages"""
-from datetime import datetime, timezone
+import math
+from datetime import datetime
+from typing import Optional, Tuple
 
 from flask import current_app
 from flask import session
 from flask_socketio import Namespace
 from flask_socketio import emit, join_room, leave_room
 from sqlalchemy import desc, or_, and_
+from sqlalchemy.engine import Row
 
 from app import db
-from app.chats.models import Message
+from app.authentication.models import User, chats
+from app.chats.exceptions import ChatAlreadyExistsError
+from app.chats.models import MESSAGE_PREVIEW_LENGTH, Message
+from app.chats.utils import get_chat_messages_before, get_chat_room_name, get_user_room_name, \
+    to_timestamp_milliseconds
+from app.chats.writer import message_writer
+from app.routing import read_only
+from . import logger
 from .. import socket_io
 
+CHATS_NAMESPACE = '/chats/going'
+CHATS_LIST_NAMESPACE = '/chats/list'
+
 
 class ChatRoomNamespace(Namespace):
     def on_connect(self):
@@ -28,18 +41,37 @@ class ChatRoomNamespace(Namespace):
     def on_put_data(self, data: dict):
         """
         Receives message and time of writing, saves the message and redirects it into print_message handler on client.
-        Broadcasts to all people in room (to the current user and to a companion).
+        Broadcasts to all people in room (to the current user and to a companion). If write-behind is enabled, the
+        message is queued and saved by the next batch. A message without text or with a broken timestamp is neither sent
+        nor saved, the client gets a status message about it.
         :param data: json from client which contains message and timestamp
         :type data: dict
         """
+        try:
+            datetime_writing = self._parse_message_data(data)
+        except ValueError:
+            logger.warning('A socket client sent a message which is not valid')
+            emit('status', {'message': 'Message is not valid'}, broadcast=False)
+            return
         room_name = session.get('room_name')
         emit('print_message', data, room=room_name)
-        message = Message(datetime_writing=datetime.utcfromtimestamp(data['timestamp_milliseconds'] / 1000),
+        chat_id = self._get_chat_id()
+        if message_writer.enabled:
+            message_writer.put(sender_id=session.get('current_user_id'), receiver_id=session.get('companion_id'),
+                               text=data['message'], datetime_writing=datetime_writing, chat_id=chat_id)
+            # the message is not saved yet, so the lists are updated by the message itself
+            emit_chat_updated(chat_id, (session.get('current_user_id'), session.get('companion_id')),
+                              data['message'][:MESSAGE_PREVIEW_LENGTH], datetime_writing)
+            return
+        message = Message(datetime_writing=datetime_writing,
                     text=data['message'],
                     sender_id=session.get('current_user_id'),
-                    receiver_id=session.get('companion_id'))
+                    receiver_id=session.get('companion_id'),
+                    chat_id=chat_id,
+                    verify_chat=False)
         db.session.add(message)
         db.session.commit()
+        emit_saved_chat_updated(chat_id)
 
     def on_leave_room(self):
         """Sent by client when it leaves the room. Remove variables from user session, leaves room and sends
@@ -49,15 +81,25 @@ class ChatRoomNamespace(Namespace):
         leave_room(room_name)
         emit('status', {'message': f'{user_name} left the room'}, room=room_name)
 
+    @read_only
     def on_get_more_messages(self, data: dict):
         """
-        Receives from a client offset and limit numbers and return prepared list with messages to load, if user scrolls
+        Receives from a client a cursor (or an offset) and returns prepared list with messages to load, if user scrolls
         up. The idea takes after typical ajax requests but here sockets are used.
-        Emits json which contains descending messages from current user and companion's chat with given offset and limit
-        from config. For each message there is an information if the owner is the current user.
-        :param data: json, contains messages_offset number
+        Emits json which contains descending messages from current user and companion's chat with a limit from config.
+        For each message there is an information if the owner is the current user.
+        There are two modes:
+            1. Cursor mode, if data contains 'cursor' key. The cursor is null for the first request and is equal to
+               'next_cursor' from the previous response for the next ones. Messages are taken by the keyset predicate
+               on (datetime_writing, message_id), so the time of loading does not grow with the depth of scrolling.
+               The response also contains 'next_cursor', which is null if there are no older messages.
+            2. Offset mode, if data contains 'messages_offset' number. It is kept for older clients.
+        :param data: json, contains cursor or messages_offset number
         :type data: dict
         """
+        if 'cursor' in data:
+            self._emit_messages_by_cursor(data['cursor'])
+            return
         messages_offset = data['messages_offset']
         messages_limit = current_app.config['MESSAGES_PER_LOAD_EVENT']
         current_user_id = session.get('current_user_id')
@@ -69,11 +111,253 @@ class ChatRoomNamespace(Namespace):
         result_data = {'messages_number': len(last_messages),
                        'messages': [{'is_current_user': current_user_id == message[0],
                                      'message_text': message[1],
-                                     'timestamp_milliseconds': message[2].replace(
-                                         tzinfo=timezone.utc).timestamp() * 1000,
+                                     'timestamp_milliseconds': to_timestamp_milliseconds(message[2]),
                                      } for message in last_messages]
                        }
         emit('load_more_messages', result_data, broadcast=False)
 
+    def on_sync(self, data: dict):
+        """
+        Is sent by a client when its socket reconnects after the room has been entered again. Receives the id of the
+        newest message the client has got from the server and emits only the messages of the chat saved after it, in
+        ascending order, by one sync_messages event. So a network flap neither loses the messages sent meanwhile nor
+        makes the client load the history again.
+        The messages are at most MESSAGES_PER_SYNC_EVENT. If there are more, no messages are sent and 'too_far_behind'
+        is true, the client is expected to load the history from the beginning. The response also contains
+        'last_message_id' to send in the next sync event.
+        Messages are read from the primary database after the message writer of this worker is flushed. With
+        write-behind and several workers (SOCKETIO_MESSAGE_QUEUE), messages queued by the writers of other workers can
+        be not saved yet, so 'sync_again_in' tells in how many milliseconds they are written and the client should sync
+        once more, otherwise it is null. A message whose transaction commits after a message with a bigger id has
+        been synced is not returned by later syncs either.
+        Messages which the client has printed by print_message events have no ids, so they can be among the returned
+        ones, now or by a later sync. The client skips them by the text and the timestamp.
+        :param data: json, contains 'last_message_id', null or 0 if the client has no messages
+        :type data: dict
+        """
+        try:
+            last_message_id = self._parse_last_message_id(data)
+        except ValueError:
+            logger.warning('A socket client sent a broken last_message_id to sync')
+            emit('sync_messages', {'too_far_behind': False, 'messages_number': 0, 'messages': [],
+                                   'last_message_id': None, 'sync_again_in': None,
+                                   'error': 'Last message id is not valid'}, broadcast=False)
+            return
+        messages_limit = current_app.config['MESSAGES_PER_SYNC_EVENT']
+        current_user_id = session.get('current_user_id')
+        companion_id = session.get('companion_id')
+        new_messages = []
+        sync_again_in = None
+        if message_writer.enabled and current_app.config['SOCKETIO_MESSAGE_QUEUE']:
+            sync_again_in = current_app.config['MESSAGES_WRITE_BEHIND_INTERVAL'] * 2
+        if User.is_chat_between(current_user_id, companion_id):
+            chat_id = User.get_chat_id_by_users_ids(current_user_id, companion_id)
+            if message_writer.enabled:
+                message_writer.flush()
+            new_messages = db.session.query(Message.message_id, Message.sender_id, Message.text,
+                                            Message.datetime_writing).filter(
+                Message.chat_id == chat_id, Message.message_id > last_message_id).order_by(
+                Message.message_id).limit(messages_limit + 1).all()
+        too_far_behind = len(new_messages) > messages_limit
+        if too_far_behind:
+            new_messages = []
+        result_data = {'too_far_behind': too_far_behind,
+                       'messages_number': len(new_messages),
+                       'messages': [{'message_id': message.message_id,
+                                     'is_current_user': current_user_id == message.sender_id,
+                                     'message_text': message.text,
+                                     'timestamp_milliseconds': to_timestamp_milliseconds(message.datetime_writing),
+                                     } for message in new_messages],
+                       'last_message_id': new_messages[-1].message_id if new_messages else last_message_id,
+                       'sync_again_in': sync_again_in,
+                       }
+        emit('sync_messages', result_data, broadcast=False)
+
+    @staticmethod
+    def _get_chat_id() -> int:
+        """
+        Returns id of the chat between the current user and the companion, creating the chat if it does not exist yet.
+        The id is taken from chat_cache, so sending messages does not look the chat up again, and the chat deleted
+        meanwhile (the cache is invalidated in every worker) is made again instead of being written to.
+        :return: chat id
+        :rtype: int
+        """
+        current_user_id = session.get('current_user_id')
+        companion_id = session.get('companion_id')
+        if not User.is_chat_between(current_user_id, companion_id):
+            logger.info('Chat is being made between users, who are talking in the room')
+            try:
+                User.create_chat(current_user_id, companion_id)
+                db.session.commit()
+            except ChatAlreadyExistsError:
+                # chat_cache was stale, another worker has made the chat
+                pass
+        return User.get_chat_id_by_users_ids(current_user_id, companion_id)
+
+    @staticmethod
+    def _emit_messages_by_cursor(cursor: dict = None):
+        """
+        Emits the next page of messages older than the given cursor. If the chat between the current user and the
+        companion has not been created yet, the page is empty.
+        :param cursor: dict with 'datetime_writing' in iso format and 'message_id' of the oldest loaded message or None
+        :type cursor: dict
+        """
+        messages_limit = current_app.config['MESSAGES_PER_LOAD_EVENT']
+        current_user_id = session.get('current_user_id')
+        companion_id = session.get('companion_id')
+        datetime_writing, message_id = None, None
+        if cursor:
+            try:
+                datetime_writing, message_id = ChatRoomNamespace._parse_cursor(cursor)
+            except ValueError:
+                logger.warning('A socket client sent a broken cursor to get_more_messages')
+                emit('load_more_messages', {'messages_number': 0, 'messages': [], 'next_cursor': None,
+                                            'error': 'Cursor is not valid'}, broadcast=False)
+                return
+        last_messages = []
+        if User.is_chat_between(current_user_id, companion_id):
+            chat_id = User.get_chat_id_by_users_ids(current_user_id, companion_id)
+            last_messages = get_chat_messages_before(chat_id, datetime_writing, message_id).limit(
+                messages_limit).all()
+        next_cursor = None
+        if len(last_messages) == messages_limit:
+            oldest_message = last_messages[-1]
+            next_cursor = {'datetime_writing': oldest_message.datetime_writing.isoformat(),
+                           'message_id': oldest_message.message_id}
+        result_data = {'messages_number': len(last_messages),
+                       'messages': [{'message_id': message.message_id,
+                                     'is_current_user': current_user_id == message.sender_id,
+                                     'message_text': message.text,
+                                     'timestamp_milliseconds': to_timestamp_milliseconds(message.datetime_writing),
+                                     } for message in last_messages],
+                       'next_cursor': next_cursor,
+                       }
+        emit('load_more_messages', result_data, broadcast=False)
+
+    @staticmethod
+    def _parse_message_data(data: dict) -> datetime:
+        """
+        Checks the message from a client. Raises ValueError if the data is not a dict with a non-empty string 'message'
+        and a number 'timestamp_milliseconds', which is a valid time.
+        :param data: json from client which contains message and timestamp
+        :type data: dict
+        :return: utc datetime of writing
+        :rtype: datetime
+        """
+        if not isinstance(data, dict):
+            raise ValueError('Message is not valid')
+        text = data.get('message')
+        timestamp = data.get('timestamp_milliseconds')
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError('Message text is not valid')
+        if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool) or not math.isfinite(timestamp):
+            raise ValueError('Message timestamp is not valid')
+        try:
+            return datetime.utcfromtimestamp(timestamp / 1000)
+        except (OverflowError, OSError, ValueError) as error:
+            raise ValueError('Message timestamp is not valid') from error
+
+    @staticmethod
+    def _parse_last_message_id(data: dict) -> int:
+        """
+        Takes last_message_id from the sync event data. Raises ValueError if the data is not a dict or the id is not
+        null or a non-negative integer.
+        :param data: json, contains 'last_message_id'
+        :type data: dict
+        :return: the id, 0 if it is null
+        :rtype: int
+        """
+        if not isinstance(data, dict):
+            raise ValueError('Sync data is not valid')
+        last_message_id = data.get('last_message_id')
+        if last_message_id is None:
+            return 0
+        if not isinstance(last_message_id, int) or isinstance(last_message_id, bool) or last_message_id < 0:
+            raise ValueError('Last message id is not valid')
+        return last_message_id
+
+    @staticmethod
+    def _parse_cursor(cursor: dict) -> Tuple[datetime, int]:
+        """
+        Takes datetime_writing and message_id from the cursor given by a client. Raises ValueError if the cursor is
+        not a dict with an iso formatted datetime and an integer id.
+        :param cursor: dict with 'datetime_writing' and 'message_id' of the oldest loaded message
+        :type cursor: dict
+        :return: datetime_writing and message_id
+        :rtype: tuple
+        """
+        try:
+            datetime_writing = datetime.fromisoformat(cursor['datetime_writing'])
+            message_id = cursor['message_id']
+        except (KeyError, TypeError) as error:
+            raise ValueError('Cursor is not valid') from error
+        if not isinstance(message_id, int) or isinstance(message_id, bool):
+            raise ValueError('Cursor is not valid')
+        return datetime_writing, message_id
+
+
+class ChatsListNamespace(Namespace):
+    def on_connect(self) -> Optional[bool]:
+        """Joins the socket of the chats list page into the personal room of the logged in user, where chat_updated
+        events are sent. Anonymous sockets are refused."""
+        current_user_id = session.get('current_user_id')
+        if current_user_id is None:
+            return False
+        join_room(get_user_room_name(current_user_id))
+        emit('status', {'message': 'connected'}, broadcast=False)
+
+
+def emit_to_chat(chat: Row, event: str, data: dict):
+    """
+    Emits the event into the room of the chat participants from outside socket handlers, e.g. from api views, so the
+    participants who are in the room and listeners of :data:`app.message_queue.event_tap` get it.
+    :param chat: row of chats table
+    :type chat: Row
+    :param event: event name, like print_message
+    :type event: str
+    :param data: json serializable event data
+    :type data: dict
+    """
+    socket_io.emit(event, data, namespace=CHATS_NAMESPACE, room=get_chat_room_name(chat.user1_id, chat.user2_id))
+
+
+def emit_chat_updated(chat_id: int, users_ids: Tuple[int, int], preview: Optional[str],
+                      datetime_writing: Optional[datetime]):
+    """
+    Sends chat_updated event into the personal rooms of both participants, so their chats list pages show the new last
+    message without reloading and without querying all their chats again. Each participant gets the companion's
+    username and name, so a chat which is not in the list yet can be added. If the chat has no messages any more,
+    preview and timestamp_milliseconds are null and the chat is removed from the list.
+    :param chat_id: id of the chat
+    :type chat_id: int
+    :param users_ids: ids of the participants
+    :type users_ids: tuple
+    :param preview: preview of the last message of the chat
+    :type preview: str
+    :param datetime_writing: utc datetime of writing of the last message
+    :type datetime_writing: datetime
+    """
+    timestamp = to_timestamp_milliseconds(datetime_writing)
+    for user_id, companion_id in (users_ids, tuple(reversed(users_ids))):
+        companion = User.get_cached_user_by_id(companion_id)
+        socket_io.emit('chat_updated', {'chat_id': chat_id, 'companion_username': companion.username,
+                                        'companion_name': companion.name, 'preview': preview,
+                                        'timestamp_milliseconds': timestamp},
+                       namespace=CHATS_LIST_NAMESPACE, room=get_user_room_name(user_id))
+
+
+def emit_saved_chat_updated(chat_id: int):
+    """
+    Reads the last message of the chat, as the chats table keeps it after the committed changes, and sends it by
+    :func:`emit_chat_updated`. Nothing is sent if the chat does not exist.
+    :param chat_id: id of the chat
+    :type chat_id: int
+    """
+    chat = db.session.query(chats.c.user1_id, chats.c.user2_id, chats.c.last_message_preview,
+                            chats.c.last_message_at).filter(chats.c.chat_id == chat_id).first()
+    if chat is not None:
+        emit_chat_updated(chat_id, (chat.user1_id, chat.user2_id), chat.last_message_preview, chat.last_message_at)
+
 
-socket_io.on_namespace(ChatRoomNamespace('/chats/going'))
+socket_io.on_namespace(ChatRoomNamespace(CHATS_NAMESPACE))
+socket_io.on_namespace(ChatsListNamespace(CHATS_LIST_NAMESPACE))
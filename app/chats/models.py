@@ -1,12 +1,31 @@
 """Necessary database tables to provide minimal chats application"""
 import datetime
+import html
+from collections import namedtuple
+from typing import List, Optional, Tuple
 
-from sqlalchemy import delete
+from sqlalchemy import DDL, Integer, Text, case, column, delete, desc, event, exists, func, insert, literal_column, \
+    select, table, or_, and_
+from sqlalchemy.engine import Connection
 
 from app import db
-from app.authentication.models import User
+from app.authentication.models import User, chats
 from . import logger
-from .exceptions import MessageNotFoundByIndexError
+from .exceptions import ChatAlreadyExistsError, ChatNotFoundByIndexesError, MessageNotFoundByIndexError
+
+MESSAGE_PREVIEW_LENGTH = 100
+# text search configuration of postgres, 'simple' neither stems words nor drops stop words, so it suits any language
+MESSAGES_SEARCH_CONFIG = 'simple'
+# marks of the found words in the highlighted text of a message. The database wraps the words by the private use
+# characters below, then the text is html escaped and they are replaced by the marks, so the text cannot inject markup
+SEARCH_HIGHLIGHT_START = '<mark>'
+SEARCH_HIGHLIGHT_STOP = '</mark>'
+_HIGHLIGHT_START_SENTINEL = '\ue000'
+_HIGHLIGHT_STOP_SENTINEL = '\ue001'
+# fts5 table which indexes the texts of messages on sqlite, it is filled by the triggers below
+messages_fts = table('messages_fts', column('rowid', Integer), column('text', Text))
+FoundMessage = namedtuple('FoundMessage', ['message_id', 'datetime_writing', 'text', 'sender_id', 'receiver_id',
+                                           'chat_id', 'rank', 'highlight'])
 
 
 class Message(db.Model):
@@ -17,18 +36,40 @@ class Message(db.Model):
     message_id = db.Column(db.Integer, primary_key=True)
     datetime_writing = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
     text = db.Column(db.Text, nullable=False)
-    sender_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
-    receiver_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), index=True, nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), index=True, nullable=False)
     chat_id = db.Column(db.Integer, db.ForeignKey('chats.chat_id'), nullable=False)
     sender = db.relationship('User', foreign_keys=[sender_id], backref='messages_sent')
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref='messages_received')
+    # serves chat history pages, both by offset and by (datetime_writing, message_id) cursor, which are read in
+    # datetime_writing DESC, message_id DESC order. Ids of deleted messages are not reused by sqlite either, so a new
+    # message always has the biggest id (see app/api/events.py)
+    __table_args__ = (
+        db.Index('ix_messages_chat_id_datetime_writing_message_id', chat_id, datetime_writing.desc(),
+                 message_id.desc()),
+        {'sqlite_autoincrement': True},
+    )
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, verify_chat: bool = True, **kwargs):
+        """
+        Makes a new message. By default, the chat between the sender and the receiver is found (or created) to fill in
+        or to verify chat_id, which takes up to three queries.
+        :param verify_chat: if it is false and chat_id is given, chat_id is trusted and no queries are made. Use it
+                            when the chat has already been resolved, e.g. once per socket connection or api request.
+        :type verify_chat: bool
+        """
+        if not verify_chat and kwargs.get('chat_id') is not None:
+            super().__init__(*args, **kwargs)
+            return
         sender_id = kwargs.get('sender_id')
         receiver_id = kwargs.get('receiver_id')
         if not User.is_chat_between(sender_id, receiver_id):
             logger.info('Message __init__ is making a chat between users')
-            User.create_chat(sender_id, receiver_id)
+            try:
+                User.create_chat(sender_id, receiver_id)
+            except ChatAlreadyExistsError:
+                # chat_cache was stale, another worker has made the chat
+                pass
         if 'chat_id' not in kwargs:
             self.chat_id = User.get_chat_id_by_users_ids(sender_id, receiver_id)
         else:
@@ -50,8 +91,45 @@ class Message(db.Model):
         """
         chat_id = chat_id or User.get_chat_id_by_users_ids(*two_users_ids)
         db.session.execute(delete(Message).where(Message.chat_id == chat_id))
+        db.session.execute(chats.update().where(chats.c.chat_id == chat_id).values(
+            last_message_id=None, last_message_at=None, last_message_preview=None, version=chats.c.version + 1))
         logger.warning(f"All the messages between {two_users_ids} were deleted")
 
+    @classmethod
+    def create_many(cls, chat_id: int, sender_id: int, receiver_id: int, texts: List[str],
+                    datetime_writing: datetime.datetime = None, verify_chat: bool = True):
+        """
+        Saves several messages from the sender to the receiver by one multi-row insert. The chat is verified once for
+        all the messages, and its last message is refreshed after the insert. Messages get the same datetime_writing,
+        so their order is kept by message_id. Changes must be committed after executing this method in order to save
+        them.
+        :param chat_id: the chat between the sender and the receiver, it must exist
+        :type chat_id: int
+        :param sender_id: id of the user who sends the messages
+        :type sender_id: int
+        :param receiver_id: id of the companion
+        :type receiver_id: int
+        :param texts: texts of the messages in the sending order
+        :type texts: list
+        :param datetime_writing: utc datetime of writing, now by default
+        :type datetime_writing: datetime.datetime
+        :param verify_chat: if it is false, the chat is trusted to be between the sender and the receiver
+        :type verify_chat: bool
+        """
+        if not texts:
+            return
+        if verify_chat:
+            user1_id, user2_id = sorted([sender_id, receiver_id])
+            if not db.session.query(exists(chats).where(and_(
+                    chats.c.chat_id == chat_id, chats.c.user1_id == user1_id, chats.c.user2_id == user2_id))).scalar():
+                logger.info('Chat for the messages was not found by index and users ids')
+                raise ChatNotFoundByIndexesError
+        datetime_writing = datetime_writing or datetime.datetime.utcnow()
+        db.session.execute(insert(cls).values(
+            [{'chat_id': chat_id, 'sender_id': sender_id, 'receiver_id': receiver_id, 'text': text,
+              'datetime_writing': datetime_writing} for text in texts]))
+        cls.refresh_chat_last_message(chat_id)
+
     @classmethod
     def get_message_by_id(cls, message_id: int) -> 'Message':
         """Return a certain message instance with given id if exists, else - raise error"""
@@ -60,3 +138,159 @@ class Message(db.Model):
             logger.info('Message was not found by index')
             raise MessageNotFoundByIndexError
         return message
+
+    @staticmethod
+    def refresh_chat_last_message(chat_id: int, connection: Connection = None):
+        """
+        Recalculates the denormalized last message of the chat (chats.last_message_id, last_message_at and
+        last_message_preview) from the messages table and increments the chat version. It is necessary after deleting
+        messages or inserting them without the ORM. The newest message is found by the chat's history index, so the
+        cost does not depend on the chat size. Changes must be committed after executing this method in order to save
+        them.
+        :param chat_id: the chat to refresh
+        :type chat_id: int
+        :param connection: connection of the current flush, if the method is called from a mapper event
+        :type connection: Connection
+        """
+        execute = connection.execute if connection is not None else db.session.execute
+        last_message = execute(
+            select(Message.message_id, Message.datetime_writing, Message.text).where(
+                Message.chat_id == chat_id).order_by(
+                desc(Message.datetime_writing), desc(Message.message_id)).limit(1)).first()
+        values = {'last_message_id': None, 'last_message_at': None, 'last_message_preview': None}
+        if last_message:
+            values = {'last_message_id': last_message.message_id, 'last_message_at': last_message.datetime_writing,
+                      'last_message_preview': last_message.text[:MESSAGE_PREVIEW_LENGTH]}
+        execute(chats.update().where(chats.c.chat_id == chat_id).values(**values, version=chats.c.version + 1))
+
+    @classmethod
+    def search(cls, search_string: str, user_id: int = None, chat_id: int = None,
+               after: Optional[Tuple[float, int]] = None, limit: int = None) -> List[FoundMessage]:
+        """
+        Full-text search of messages which contain all the words of the search string. Postgres matches the
+        search_vector column by its GIN index and ranks messages by ts_rank, sqlite matches messages_fts table and ranks
+        by bm25. Found messages are ordered by descending rank and message_id, and every row has the message columns,
+        'rank' and 'highlight' - the html escaped text with the found words wrapped by SEARCH_HIGHLIGHT_START and
+        SEARCH_HIGHLIGHT_STOP.
+        :param search_string: words to search, the case does not matter
+        :type search_string: str
+        :param user_id: if it is given, only messages sent or received by the user are searched
+        :type user_id: int
+        :param chat_id: if it is given, only messages of the chat are searched
+        :type chat_id: int
+        :param after: rank and message_id of the last message of the previous page
+        :type after: tuple
+        :param limit: the maximum number of messages
+        :type limit: int
+        :return: found messages
+        :rtype: list of :class:`FoundMessage`
+        """
+        words = search_string.split()
+        if not words:
+            return []
+        postgres = db.engine.dialect.name == 'postgresql'
+        if postgres:
+            query = func.plainto_tsquery(MESSAGES_SEARCH_CONFIG, search_string)
+            search_vector = literal_column('messages.search_vector')
+            rank = func.ts_rank(search_vector, query)
+            highlight = func.ts_headline(
+                MESSAGES_SEARCH_CONFIG, cls.text, query,
+                f'HighlightAll=true, StartSel="{_HIGHLIGHT_START_SENTINEL}", StopSel="{_HIGHLIGHT_STOP_SENTINEL}"')
+            match = search_vector.op('@@')(query)
+        else:
+            # every word is quoted, so the search string cannot be taken as fts5 query syntax
+            fts_query = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+            fts_table = literal_column('messages_fts')
+            rank = -func.bm25(fts_table)
+            highlight = func.highlight(fts_table, 0, _HIGHLIGHT_START_SENTINEL, _HIGHLIGHT_STOP_SENTINEL)
+            match = fts_table.op('MATCH')(fts_query)
+        found = select(cls.message_id, cls.datetime_writing, cls.text, cls.sender_id, cls.receiver_id, cls.chat_id,
+                       rank.label('rank'), highlight.label('highlight')).where(match)
+        if not postgres:
+            found = found.join_from(cls, messages_fts, messages_fts.c.rowid == cls.message_id)
+        if chat_id is not None:
+            found = found.where(cls.chat_id == chat_id)
+        if user_id is not None:
+            found = found.where(or_(cls.sender_id == user_id, cls.receiver_id == user_id))
+        found = found.subquery()
+        statement = select(found).order_by(desc(found.c.rank), desc(found.c.message_id))
+        if after is not None:
+            after_rank, after_message_id = after
+            statement = statement.where(or_(found.c.rank < after_rank,
+                                            and_(found.c.rank == after_rank, found.c.message_id < after_message_id)))
+        if limit is not None:
+            statement = statement.limit(limit)
+        return [FoundMessage(*row[:-1], _escape_highlight(row.highlight)) for row in db.session.execute(statement)]
+
+
+def _escape_highlight(highlight: str) -> str:
+    """Escapes the text highlighted by the database and replaces the sentinels of found words by the marks. A sentinel
+    typed by the user becomes a mark too, but it cannot make any other markup"""
+    return html.escape(highlight).replace(_HIGHLIGHT_START_SENTINEL, SEARCH_HIGHLIGHT_START).replace(
+        _HIGHLIGHT_STOP_SENTINEL, SEARCH_HIGHLIGHT_STOP)
+
+
+@event.listens_for(Message, 'after_insert')
+def set_chat_last_message(mapper, connection: Connection, message: Message):
+    """Makes the inserted message the last one of its chat, unless the chat already has a newer message, and increments
+    the chat version. Executed in the same transaction as the insert, so the chat cannot point to a message which has
+    not been saved"""
+    is_last = or_(chats.c.last_message_at.is_(None), chats.c.last_message_at <= message.datetime_writing)
+    connection.execute(chats.update().where(chats.c.chat_id == message.chat_id).values(
+        last_message_id=case((is_last, message.message_id), else_=chats.c.last_message_id),
+        last_message_at=case((is_last, message.datetime_writing), else_=chats.c.last_message_at),
+        last_message_preview=case((is_last, message.text[:MESSAGE_PREVIEW_LENGTH]),
+                                  else_=chats.c.last_message_preview),
+        version=chats.c.version + 1))
+
+
+@event.listens_for(Message, 'after_update')
+def update_chat_last_message_preview(mapper, connection: Connection, message: Message):
+    """Updates the preview of the chat if its last message text was edited, and increments the chat version"""
+    is_last = chats.c.last_message_id == message.message_id
+    connection.execute(chats.update().where(chats.c.chat_id == message.chat_id).values(
+        last_message_preview=case((is_last, message.text[:MESSAGE_PREVIEW_LENGTH]), else_=chats.c.last_message_preview),
+        version=chats.c.version + 1))
+
+
+@event.listens_for(Message, 'after_delete')
+def replace_chat_last_message(mapper, connection: Connection, message: Message):
+    """Chooses a new last message for the chat if its last message was deleted. The chat version is incremented
+    anyway"""
+    last_message_id = connection.execute(
+        select(chats.c.last_message_id).where(chats.c.chat_id == message.chat_id)).scalar()
+    if last_message_id == message.message_id:
+        Message.refresh_chat_last_message(message.chat_id, connection)
+    else:
+        connection.execute(chats.update().where(chats.c.chat_id == message.chat_id).values(
+            version=chats.c.version + 1))
+
+
+# Postgres keeps the search vector of every message in a column filled by a trigger, so it is up to date whatever way
+# the message is inserted or edited. Sqlite keeps the texts in fts5 table by triggers. Both are created with the table
+# by create_all, existing postgres databases get the column by a migration, which fills it in batches.
+POSTGRES_SEARCH_DDL = (
+    'ALTER TABLE messages ADD COLUMN search_vector tsvector',
+    'CREATE FUNCTION messages_search_vector_update() RETURNS trigger AS $$ BEGIN '
+    f"NEW.search_vector := to_tsvector('{MESSAGES_SEARCH_CONFIG}', NEW.text); RETURN NEW; END $$ LANGUAGE plpgsql",
+    'CREATE TRIGGER messages_search_vector_update BEFORE INSERT OR UPDATE OF text ON messages '
+    'FOR EACH ROW EXECUTE PROCEDURE messages_search_vector_update()',
+    'CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector)',
+)
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='message_id')",
+    'CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN '
+    'INSERT INTO messages_fts(rowid, text) VALUES (new.message_id, new.text); END',
+    'CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN '
+    "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.message_id, old.text); END",
+    'CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN '
+    "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.message_id, old.text); "
+    'INSERT INTO messages_fts(rowid, text) VALUES (new.message_id, new.text); END',
+)
+for _statement in POSTGRES_SEARCH_DDL:
+    event.listen(Message.__table__, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+for _statement in SQLITE_SEARCH_DDL:
+    event.listen(Message.__table__, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+event.listen(Message.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS messages_fts').execute_if(dialect='sqlite'))
+event.listen(Message.__table__, 'after_drop',
+             DDL('DROP FUNCTION IF EXISTS messages_search_vector_update()').execute_if(dialect='postgresql'))
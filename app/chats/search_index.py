@@ -0,0 +1,350 @@
+"""In-process prefix index of users for the companion search (type-ahead of /chats/ajax-search).
+Lowercased usernames, names and the words of names are kept in sorted arrays together with user ids, so the users
+whose username or name starts with a search string are found by a binary search and read in the order of ranks:
+exact matches (rank 0), prefix matches of the username or the name (rank 1), prefix matches of other words of the name
+(rank 2). Users matched only in the middle of a word are added to short pages from the database by
+:func:`app.chats.utils.search_users_page`, and :func:`app.chats.utils.search_for_users_by` answers until the index is
+built.
+Every worker builds its own index in a background thread at start. Users registered, renamed or deleted by the worker
+are applied at once, when the transaction is committed. Users registered by other workers are loaded every
+USER_SEARCH_INDEX_REFRESH seconds by a cheap query of the new ids, and their renames and deletions are seen after the
+next full rebuild, which happens every USER_SEARCH_INDEX_REBUILD seconds. The rebuild sorts the tokens in chunks and
+lets other greenlets of an eventlet worker go on between them, so it does not block the hub.
+"""
+import bisect
+import sys
+import threading
+import time
+from array import array
+from collections import namedtuple
+from heapq import merge
+from typing import Iterator, List, Optional, Tuple
+
+from flask import Flask
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.authentication.models import User
+from app.stats import register_stats_provider
+from . import logger
+
+SearchResult = namedtuple('SearchResult', ['name', 'username', 'user_id', 'rank', 'key'])
+
+_INDEX_CHANGES = 'user_search_index_changes'
+# users loaded and tokens sorted between the switches to other greenlets
+_CHUNK_SIZE = 10000
+
+
+def _tokens(name: Optional[str], username: str) -> Tuple[List[str], List[str]]:
+    """
+    Returns lowercased tokens of the user: the username and the name, and the other words of the name. Equal tokens of
+    different users are interned to share the memory.
+    :rtype: tuple
+    """
+    full = [sys.intern(username.lower())]
+    words = []
+    if name:
+        full.append(sys.intern(name.lower()))
+        words = [sys.intern(word) for word in name.lower().split()[1:]]
+    return full, words
+
+
+class SortedTokens:
+    """
+    Sorted pairs of tokens and user ids in two parallel arrays. It is much more compact than a trie of python objects
+    and a range of tokens with a prefix is found by two binary searches.
+    """
+
+    def __init__(self, pairs: list = ()):
+        pairs = sorted(pairs)
+        self.keys = [key for key, _ in pairs]
+        self.ids = array('q', [user_id for _, user_id in pairs])
+
+    def add(self, key: str, user_id: int):
+        position = self._position(key, user_id)
+        if position < len(self.keys) and self.keys[position] == key and self.ids[position] == user_id:
+            return
+        self.keys.insert(position, key)
+        self.ids.insert(position, user_id)
+
+    def remove(self, key: str, user_id: int):
+        position = self._position(key, user_id)
+        if position < len(self.keys) and self.keys[position] == key and self.ids[position] == user_id:
+            del self.keys[position]
+            del self.ids[position]
+
+    def iterate(self, prefix: str, after: Tuple[str, int] = None) -> Iterator[Tuple[str, int]]:
+        """
+        Yields the pairs whose tokens start with the prefix in the ascending order.
+        :param prefix: the beginning of tokens
+        :type prefix: str
+        :param after: pair to start after, if it is given
+        :type after: tuple
+        """
+        if after is None or after[0] < prefix:
+            position = bisect.bisect_left(self.keys, prefix)
+        else:
+            low = bisect.bisect_left(self.keys, after[0])
+            high = bisect.bisect_right(self.keys, after[0], low)
+            position = bisect.bisect_right(self.ids, after[1], low, high)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            yield self.keys[position], self.ids[position]
+            position += 1
+
+    @classmethod
+    def sorted_cooperatively(cls, pairs: list) -> 'SortedTokens':
+        """
+        Makes sorted tokens from many pairs without blocking other greenlets for the whole sort: the chunks of the pairs
+        are sorted one by one and merged, and the thread sleeps for a moment after each chunk.
+        :param pairs: unsorted pairs of tokens and user ids
+        :type pairs: list
+        :rtype: SortedTokens
+        """
+        chunks = []
+        for start in range(0, len(pairs), _CHUNK_SIZE):
+            chunks.append(sorted(pairs[start:start + _CHUNK_SIZE]))
+            time.sleep(0)
+        tokens = cls()
+        for number, (key, user_id) in enumerate(merge(*chunks), 1):
+            tokens.keys.append(key)
+            tokens.ids.append(user_id)
+            if number % _CHUNK_SIZE == 0:
+                time.sleep(0)
+        return tokens
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _position(self, key: str, user_id: int) -> int:
+        low = bisect.bisect_left(self.keys, key)
+        high = bisect.bisect_right(self.keys, key, low)
+        return bisect.bisect_left(self.ids, user_id, low, high)
+
+
+class UserSearchIndex:
+    """
+    Flask extension which keeps the prefix index of users. It is cold (not ready) until the first build is finished.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.full = SortedTokens()
+        self.words = SortedTokens()
+        self.users = {}
+        self.ready = False
+        self.building = False
+        self.pending = []
+        self.build_time = 0
+        self.last_user_id = 0
+        self.searches = 0
+        self.fallbacks = 0
+        register_stats_provider('user_search_index', self.stats)
+
+    def init_app(self, app: Flask):
+        """Starts building the index in a background thread, if USER_SEARCH_INDEX is enabled"""
+        self.app = app
+        self.clear()
+        app.extensions['user_search_index'] = self
+        if app.config['USER_SEARCH_INDEX']:
+            threading.Thread(target=self._run, name='user-search-index', daemon=True).start()
+
+    def build(self):
+        """Loads all the users and replaces the index. Changes committed during the build are applied after it"""
+        start = time.perf_counter()
+        with self.lock:
+            self.building = True
+            self.pending = []
+        full_pairs, word_pairs, users = [], [], {}
+        try:
+            query = db.session.query(User.user_id, User.name, User.username).execution_options(
+                stream_results=True).yield_per(10000)
+            for number, (user_id, name, username) in enumerate(query, 1):
+                users[user_id] = (name, username)
+                full, words = _tokens(name, username)
+                full_pairs.extend((token, user_id) for token in full)
+                word_pairs.extend((token, user_id) for token in words)
+                if number % _CHUNK_SIZE == 0:
+                    # lets other greenlets of an eventlet worker go on
+                    time.sleep(0)
+            db.session.commit()
+            full, words = SortedTokens.sorted_cooperatively(full_pairs), SortedTokens.sorted_cooperatively(word_pairs)
+        except Exception:
+            with self.lock:
+                self.building = False
+            raise
+        with self.lock:
+            self.full, self.words, self.users = full, words, users
+            self.last_user_id = max(users, default=0)
+            for change in self.pending:
+                self._apply(*change)
+            self.pending = []
+            self.building = False
+            self.ready = True
+            self.build_time = time.perf_counter() - start
+        logger.info(f'User search index is built: {len(users)} users in {self.build_time:.2f}s')
+
+    def refresh(self):
+        """Adds the users registered after the last build or refresh, e.g. by other workers. Ids of users only grow, so
+        they are found by the primary key"""
+        query = db.session.query(User.user_id, User.name, User.username).filter(
+            User.user_id > self.last_user_id).order_by(User.user_id)
+        changes = [('add', user_id, name, username) for user_id, name, username in query]
+        db.session.commit()
+        if changes:
+            with self.lock:
+                for change in changes:
+                    self._apply(*change)
+                self.last_user_id = max(self.last_user_id, changes[-1][1])
+
+    def search(self, search_string: str, current_user_id: int = None, cursor: dict = None,
+               limit: int = 20) -> List[SearchResult]:
+        """
+        Returns users whose username or words of the name start with the strings of the search string, ordered by rank,
+        token and user id.
+        :param search_string: a string to search with, split by whitespaces
+        :type search_string: str
+        :param current_user_id: user's id to exclude
+        :type current_user_id: int
+        :param cursor: dict with 'rank', 'key' and 'user_id' of the last result from the previous page
+        :type cursor: dict
+        :param limit: the maximum number of results
+        :type limit: int
+        :rtype: list
+        """
+        strings = set(search_string.strip().lower().split())
+        after = (cursor['rank'], cursor['key'], cursor['user_id']) if cursor else None
+        results = []
+        with self.lock:
+            self.searches += 1
+            for item in merge(*[self._ranked(string, after) for string in strings]):
+                rank, key, user_id = item
+                # a user is matched by several tokens, he is returned only at the best of them
+                if user_id == current_user_id or item != self._best_match(user_id, strings):
+                    continue
+                name, username = self.users[user_id]
+                results.append(SearchResult(name, username, user_id, rank, key))
+                if len(results) == limit:
+                    break
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.full, self.words, self.users = SortedTokens(), SortedTokens(), {}
+            self.last_user_id = 0
+            self.ready = False
+            self.pending = []
+            self.searches = 0
+            self.fallbacks = 0
+
+    def stats(self) -> dict:
+        """Returns the state, sizes, build time and the number of searches answered by the index and by the database"""
+        return {'ready': self.ready,
+                'users': len(self.users),
+                'tokens': len(self.full) + len(self.words),
+                'build_ms': round(self.build_time * 1000, 3),
+                'searches': self.searches,
+                'fallbacks': self.fallbacks}
+
+    def apply_changes(self, changes: list):
+        """Adds and removes users committed by the current worker"""
+        with self.lock:
+            if self.building:
+                self.pending.extend(changes)
+            for change in changes:
+                self._apply(*change)
+
+    def _apply(self, action: str, user_id: int, name: Optional[str] = None, username: str = None):
+        """Removes the indexed tokens of the user and adds the new ones, unless the user is deleted"""
+        if user_id in self.users:
+            full, words = _tokens(*self.users.pop(user_id))
+            for token in full:
+                self.full.remove(token, user_id)
+            for token in words:
+                self.words.remove(token, user_id)
+        if action == 'delete':
+            return
+        self.users[user_id] = (name, username)
+        full, words = _tokens(name, username)
+        for token in full:
+            self.full.add(token, user_id)
+        for token in words:
+            self.words.add(token, user_id)
+
+    def _ranked(self, string: str, after: tuple = None) -> Iterator[Tuple[int, str, int]]:
+        """
+        Yields (rank, key, user_id) of the users matched by the string after the cursor in the ascending order. The
+        ranks do not decrease along the tokens with the prefix, so the arrays are read from the cursor position, if the
+        cursor has the same rank, and from the beginning of the prefix otherwise.
+        """
+        after_rank = after[0] if after else -1
+        if after_rank <= 1:
+            for key, user_id in self.full.iterate(string, after[1:] if after_rank == 1 else None):
+                item = (0 if key == string else 1), key, user_id
+                if after is None or item > after:
+                    yield item
+        for key, user_id in self.words.iterate(string, after[1:] if after_rank == 2 else None):
+            item = 2, key, user_id
+            if after is None or item > after:
+                yield item
+
+    def _best_match(self, user_id: int, strings: set) -> Tuple[int, str, int]:
+        """Returns the smallest (rank, key, user_id) of the user among all the search strings"""
+        full, words = _tokens(*self.users[user_id])
+        return min([((0 if key == string else 1), key, user_id) for key in full for string in strings
+                    if key.startswith(string)] +
+                   [(2, key, user_id) for key in words for string in strings if key.startswith(string)])
+
+    def _run(self):
+        """Builds the index, loads new users periodically and rebuilds the index much less often"""
+        next_build = 0
+        while True:
+            try:
+                with self.app.app_context():
+                    if not self.ready or time.monotonic() >= next_build:
+                        self.build()
+                        next_build = time.monotonic() + self.app.config['USER_SEARCH_INDEX_REBUILD']
+                    else:
+                        self.refresh()
+                    db.session.remove()
+            except Exception:
+                logger.exception('User search index cannot be built, the database is searched instead')
+            time.sleep(self.app.config['USER_SEARCH_INDEX_REFRESH'])
+
+
+def _record(session: Session, *change):
+    session.info.setdefault(_INDEX_CHANGES, []).append(change)
+
+
+@event.listens_for(User, 'after_insert')
+def index_registered_user(mapper, connection, user: User):
+    _record(object_session(user), 'add', user.user_id, user.name, user.username)
+
+
+@event.listens_for(User, 'after_update')
+def index_renamed_user(mapper, connection, user: User):
+    """Reindexes the user, if his name or username is changed. The old tokens are taken from the index"""
+    state = inspect(user)
+    if state.attrs.name.history.has_changes() or state.attrs.username.history.has_changes():
+        _record(object_session(user), 'update', user.user_id, user.name, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def unindex_deleted_user(mapper, connection, user: User):
+    _record(object_session(user), 'delete', user.user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_index_changes(session: Session):
+    changes = session.info.pop(_INDEX_CHANGES, None)
+    if changes and (user_search_index.ready or user_search_index.building):
+        user_search_index.apply_changes(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_index_changes(session: Session):
+    session.info.pop(_INDEX_CHANGES, None)
+
+
+user_search_index = UserSearchIndex()
@@ -1,12 +1,24 @@
 """Necessary utils for the chats blueprint"""
+import datetime
 import functools
+from collections import namedtuple
+from typing import Optional, Tuple
 
+from flask import current_app
 from flask_sqlalchemy import BaseQuery
-from sqlalchemy import or_, desc, case, func, and_
+from sqlalchemy import or_, desc, case, and_, tuple_, func, literal, not_
 
 from app import db
-from app.authentication.models import User
+from app.authentication.models import User, chats
+from app.cache import search_cache
 from app.chats.models import Message
+from app.chats.search_index import SearchResult, user_search_index
+from app.cursors import decode_cursor, encode_cursor
+from app.routing import reads_from_replica
+
+FoundUser = namedtuple('FoundUser', ['name', 'username', 'user_id', 'rank'])
+# rank of the users, who are matched only in the middle of a word, when the prefix index of users answers the search
+INSIDE_WORD_RANK = 3
 
 
 @functools.lru_cache(maxsize=256)
@@ -28,60 +40,264 @@ def get_users_unique_room_name(username1: str, username2: str) -> str:
     return '_'.join(sorted([username1.strip(), username2.strip()]))
 
 
+def get_chat_room_name(user1_id: int, user2_id: int) -> str:
+    """
+    Returns the name of the Socket.IO room where the participants of the chat talk. It is made of the participants'
+    ids, which are the unique key of the chat, so the name does not change when a user is renamed, it is known before
+    the chat is created and stays the same if the chat is deleted and made again. Ids can be given in an arbitrary
+    order. Raises ValueError if the ids are equal.
+    :param user1_id: id of a participant
+    :type user1_id: int
+    :param user2_id: id of the other participant
+    :type user2_id: int
+    :return: room's name
+    :rtype: str
+    """
+    if user1_id == user2_id:
+        raise ValueError('Given users ids are equal but they cannot be')
+    user1_id, user2_id = sorted([user1_id, user2_id])
+    return f'chat:{user1_id}:{user2_id}'
+
+
+def get_user_room_name(user_id: int) -> str:
+    """
+    Returns the name of the personal Socket.IO room of the user, every list page socket of the user is in it
+    :param user_id: id of the user
+    :type user_id: int
+    :return: room's name
+    :rtype: str
+    """
+    return f'user:{user_id}'
+
+
+def to_timestamp_milliseconds(datetime_writing: Optional[datetime.datetime]) -> Optional[float]:
+    """Returns the number of milliseconds since the epoch of the utc datetime, like javascript Date does"""
+    if datetime_writing is None:
+        return None
+    return datetime_writing.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+
+
 def get_user_chats_and_last_messages(user_id: int) -> BaseQuery:
     """
-    Takes a certain user id and makes one pretty complex SQL query. After executing we obtain a list, where each object
-    represents one chat user has already started. The object also contains a last message text and datetime_writing,
-    companion username and name. The sequence of chats is returned in descending order, from the newest one from the
-    oldest.
+    Takes a certain user id and makes an SQL query. After executing we obtain a list, where each object
+    represents one chat user has already started. The object also contains a last message text preview and
+    datetime_writing, companion username and name, and the chat id. The sequence of chats is returned in descending
+    order, from the newest one from the oldest. Chats without messages are skipped.
+    The last message is denormalized into the chats table (see app/chats/models.py), so the query reads only chats and
+    users and does not depend on the number of messages. Its ordering is served by the
+    (user1_id, last_message_at) and (user2_id, last_message_at) indexes.
     The sql query to execute is like:
-    # SELECT users.username, users.name, messages.text, messages.datetime_writing FROM messages JOIN (SELECT
-    MAX(datetime_writing) AS max_datetime FROM messages WHERE sender_id = [user_id] OR receiver_id = [user_id]
-    GROUP BY chat_id) AS max_dates ON messages.datetime_writing = max_dates.max_datetime JOIN users ON users.user_id =
-    (CASE WHEN messages.receiver_id = [user_id] THEN messages.sender_id ELSE messages.receiver_id END)
-    ORDER BY messages.datetime_writing;
-    If there is a way to make it easier, I won't be against to try it out.
+    # SELECT users.username, users.name, chats.last_message_preview, chats.last_message_at, chats.chat_id FROM chats
+    JOIN users ON users.user_id = (CASE WHEN chats.user1_id = [user_id] THEN chats.user2_id ELSE chats.user1_id END)
+    WHERE (chats.user1_id = [user_id] OR chats.user2_id = [user_id]) AND chats.last_message_at IS NOT NULL
+    ORDER BY chats.last_message_at DESC, chats.chat_id DESC;
     :param user_id: user id for a query
     :type user_id: int
     :return: return a :class:`BaseQuery` instance which has not been executed yet.
     :rtype: BaseQuery
     """
-    subquery = db.session.query(func.max(Message.datetime_writing).label('max_datetime')).filter(
-        or_(Message.sender_id == user_id, Message.receiver_id == user_id)).group_by(
-        Message.chat_id).subquery()
-
-    case_stmt = case((Message.receiver_id == user_id, Message.sender_id), else_=Message.receiver_id)
+    case_stmt = case((chats.c.user1_id == user_id, chats.c.user2_id), else_=chats.c.user1_id)
 
-    result = db.session.query(User.username, User.name, Message.text, Message.datetime_writing).join(
-        subquery,
-        Message.datetime_writing == subquery.c.max_datetime).join(User, User.user_id == case_stmt).order_by(
-        desc(Message.datetime_writing))
+    result = db.session.query(User.username, User.name, chats.c.last_message_preview.label('text'),
+                              chats.c.last_message_at.label('datetime_writing'),
+                              chats.c.chat_id).select_from(chats).join(User, User.user_id == case_stmt).filter(
+        or_(chats.c.user1_id == user_id, chats.c.user2_id == user_id), chats.c.last_message_at.isnot(None)).order_by(
+        desc(chats.c.last_message_at), desc(chats.c.chat_id))
     return result
 
 
-def search_for_users_by(search_string: str, current_user_id: int = None) -> BaseQuery:
+def _escape_like(string: str) -> str:
+    """Escapes the wildcards of LIKE patterns with a backslash"""
+    return string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_for_users_by(search_string: str, current_user_id: int = None, cursor: dict = None) -> BaseQuery:
     """
     Conducts a search for users. The given string is compared with all users' names and usernames.
     If there are some matches, users will be returned. If a search string contains whitespaces, it will be split by them
     and the search will be conducted with each output divided string.
     If 'current_user_id' is also given, this user is expected to be a searcher,
     so he will be excluded from the final result.
+    Users are ranked by relevance: exact matches of a name or a username go first (rank 0), then prefix matches
+    (rank 1), then the others (rank 2). Users with equal ranks are ordered from the newest one. Matches are looked up by
+    the trigram indexes on postgres, ranks are computed only for the matched users.
+    The sql query to execute is like:
+    # SELECT users.name, users.username, users.user_id, CASE WHEN lower(users.username) = [string] OR ... THEN 0
+    WHEN lower(users.username) LIKE [string%] OR ... THEN 1 ELSE 2 END AS rank FROM users
+    WHERE (users.name ILIKE [%string%] OR users.username ILIKE [%string%] OR ...) AND users.user_id != [user_id]
+    ORDER BY rank, users.user_id DESC;
     :param search_string: a string to search with
     :type search_string: str
     :param current_user_id: user's id to exclude
     :type current_user_id: int
-    :return: BaseQuery instance, so it needs to be executed after.
+    :param cursor: dict with 'rank' and 'user_id' of the last user from the previous page
+    :type cursor: dict
+    :return: BaseQuery instance with name, username, user_id and rank columns, so it needs to be limited and executed.
     :rtype: BaseQuery
     """
-    search_strings = search_string.strip().split()
-    or_params = []
+    search_strings = search_string.strip().lower().split()
+    or_params, exact_params, prefix_params = [], [], []
     for string in search_strings:
-        or_params.append(User.name.ilike(f'%{string}%'))
-        or_params.append(User.username.ilike(f'%{string}%'))
-    or_stmt = or_(*or_params)
-    if not current_user_id:
-        result = db.session.query(User.name, User.username).where(or_stmt).order_by(desc(User.date_joined))
+        string = _escape_like(string)
+        or_params.append(User.name.ilike(f'%{string}%', escape='\\'))
+        or_params.append(User.username.ilike(f'%{string}%', escape='\\'))
+        exact_params.append(func.lower(User.name).like(string, escape='\\'))
+        exact_params.append(func.lower(User.username).like(string, escape='\\'))
+        prefix_params.append(func.lower(User.name).like(f'{string}%', escape='\\'))
+        prefix_params.append(func.lower(User.username).like(f'{string}%', escape='\\'))
+    if not search_strings:
+        # every user matches with the same rank, and a constant cannot be used in ORDER BY
+        result = db.session.query(User.name, User.username, User.user_id, literal(2).label('rank')).order_by(
+            desc(User.user_id))
+        if cursor:
+            result = result.filter(User.user_id < cursor['user_id'])
     else:
-        result = db.session.query(User.name, User.username).where(
-            and_(or_stmt, User.user_id != current_user_id)).order_by(desc(User.date_joined))
+        rank = case((or_(*exact_params), 0), (or_(*prefix_params), 1), else_=2)
+        result = db.session.query(User.name, User.username, User.user_id, rank.label('rank')).filter(
+            or_(*or_params)).order_by(rank, desc(User.user_id))
+        if cursor:
+            result = result.filter(
+                or_(rank > cursor['rank'], and_(rank == cursor['rank'], User.user_id < cursor['user_id'])))
+    if current_user_id:
+        result = result.filter(User.user_id != current_user_id)
+    return result
+
+
+def search_for_users_inside_words(search_string: str, current_user_id: int = None,
+                                  after_user_id: int = None) -> BaseQuery:
+    """
+    Conducts a search for users, who are matched by the strings only in the middle of a word, so the prefix index of
+    users does not find them. The username, the name and the words of the name must not start with any of the strings.
+    Users are ordered from the newest one and have :data:`INSIDE_WORD_RANK`.
+    :param search_string: a non-empty string to search with
+    :type search_string: str
+    :param current_user_id: user's id to exclude
+    :type current_user_id: int
+    :param after_user_id: id of the last user from the previous page
+    :type after_user_id: int
+    :return: BaseQuery instance with name, username, user_id and rank columns, so it needs to be limited and executed.
+    :rtype: BaseQuery
+    """
+    # the name can be null, and NOT of a null condition would exclude the user
+    name = func.lower(func.coalesce(User.name, ''))
+    username = func.lower(User.username)
+    matched, prefixed = [], []
+    for string in set(search_string.strip().lower().split()):
+        string = _escape_like(string)
+        matched.append(User.name.ilike(f'%{string}%', escape='\\'))
+        matched.append(User.username.ilike(f'%{string}%', escape='\\'))
+        prefixed.append(name.like(f'{string}%', escape='\\'))
+        prefixed.append(name.like(f'% {string}%', escape='\\'))
+        prefixed.append(username.like(f'{string}%', escape='\\'))
+    result = db.session.query(User.name, User.username, User.user_id, literal(INSIDE_WORD_RANK).label('rank')).filter(
+        or_(*matched), not_(or_(*prefixed))).order_by(desc(User.user_id))
+    if after_user_id is not None:
+        result = result.filter(User.user_id < after_user_id)
+    if current_user_id:
+        result = result.filter(User.user_id != current_user_id)
     return result
+
+
+def search_users_cached(search_string: str, current_user_id: int = None, cursor: dict = None,
+                        limit: int = 20) -> list:
+    """
+    Returns at most limit users found by :func:`search_for_users_by` through search_cache. The search string is
+    normalized, so the strings which differ only in case, order or repetition of words share an entry. The entries are
+    shared by all the searchers and all the page sizes too: SEARCH_RESULTS_LIMIT + 1 users are searched without
+    excluding anybody and with one more row, and the current user is removed when the entry is read. Results read from
+    a replica are not cached, because they can be outdated.
+    :param search_string: a string to search with
+    :type search_string: str
+    :param current_user_id: user's id to exclude
+    :type current_user_id: int
+    :param cursor: dict with 'rank' and 'user_id' of the last user from the previous page
+    :type cursor: dict
+    :param limit: the maximum number of users
+    :type limit: int
+    :return: list of :class:`FoundUser`
+    :rtype: list
+    """
+    normalized = ' '.join(sorted(set(search_string.lower().split())))
+    after = f"{cursor['rank']}:{cursor['user_id']}" if cursor else ''
+    size = max(limit, current_app.config['SEARCH_RESULTS_LIMIT'] + 1) + 1
+    key = f'{size}:{after}:{normalized}'
+    rows = search_cache.get(key)
+    if rows is None:
+        rows = [FoundUser(*row) for row in search_for_users_by(normalized, cursor=cursor).limit(size)]
+        if not reads_from_replica(db.session):
+            search_cache.set(key, rows)
+    return [row for row in rows if row.user_id != current_user_id][:limit]
+
+
+def search_users_page(search_string: str, current_user_id: int = None, cursor: str = None,
+                      limit: int = None) -> Tuple[list, Optional[str]]:
+    """
+    Returns one page of the user search. It is answered by the prefix index of users, when it is built, and by
+    :func:`search_users_cached` otherwise. When the index has no more users for the page, it is filled by
+    :func:`search_for_users_inside_words`, so the index finds the same users as the database. The number of users is
+    never bigger than SEARCH_RESULTS_LIMIT. Raises ValueError if the cursor is not valid.
+    :param search_string: a string to search with
+    :type search_string: str
+    :param current_user_id: user's id to exclude
+    :type current_user_id: int
+    :param cursor: 'next_cursor' of the previous page or None for the first page
+    :type cursor: str
+    :param limit: the wanted number of users, SEARCH_RESULTS_LIMIT if it is not given
+    :type limit: int
+    :return: rows with name, username, user_id and rank, and the cursor of the next page or None if it is the last one
+    :rtype: tuple
+    """
+    max_limit = current_app.config['SEARCH_RESULTS_LIMIT']
+    limit = min(limit, max_limit) if limit and limit > 0 else max_limit
+    key = decode_cursor(cursor, 'rank', 'user_id', rank=int, user_id=int, key=str) if cursor else None
+    if user_search_index.ready and search_string.strip():
+        inside_words = key is not None and 'key' not in key
+        if inside_words and key['rank'] != INSIDE_WORD_RANK:
+            raise ValueError('Cursor is not valid')
+        rows = [] if inside_words else user_search_index.search(search_string, current_user_id, key, limit + 1)
+        if len(rows) <= limit:
+            after_user_id = key['user_id'] if inside_words else None
+            query = search_for_users_inside_words(search_string, current_user_id, after_user_id)
+            rows += [FoundUser(*row) for row in query.limit(limit + 1 - len(rows))]
+    else:
+        if current_app.config['USER_SEARCH_INDEX']:
+            user_search_index.fallbacks += 1
+        rows = search_users_cached(search_string, current_user_id, key, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        key = {'rank': last.rank, 'user_id': last.user_id}
+        if isinstance(last, SearchResult):
+            key['key'] = last.key
+        next_cursor = encode_cursor(key)
+    return rows, next_cursor
+
+
+def get_chat_messages_before(chat_id: int, datetime_writing: datetime.datetime = None,
+                             message_id: int = None) -> BaseQuery:
+    """
+    Makes a keyset (cursor) query for the messages of the given chat. Messages are returned from the newest one to the
+    oldest, and if a cursor is given - only the messages which are strictly older than the cursor message. The cursor
+    is a pair of the oldest message datetime_writing and message_id a client already has, so the database does not need
+    to walk and discard all the previous pages like with OFFSET. The query is resolved by the
+    (chat_id, datetime_writing, message_id) order, so its cost does not depend on the depth of scrolling.
+    The sql query to execute is like:
+    # SELECT messages.message_id, messages.sender_id, messages.text, messages.datetime_writing FROM messages
+    WHERE messages.chat_id = [chat_id] AND (messages.datetime_writing, messages.message_id) < ([datetime], [id])
+    ORDER BY messages.datetime_writing DESC, messages.message_id DESC;
+    :param chat_id: chat to take messages from
+    :type chat_id: int
+    :param datetime_writing: datetime_writing of the oldest message from the cursor
+    :type datetime_writing: datetime.datetime
+    :param message_id: message_id of the oldest message from the cursor
+    :type message_id: int
+    :return: return a :class:`BaseQuery` instance which has not been executed yet. It must be limited after.
+    :rtype: BaseQuery
+    """
+    result = db.session.query(Message.message_id, Message.sender_id, Message.text, Message.datetime_writing).filter(
+        Message.chat_id == chat_id)
+    if datetime_writing is not None and message_id is not None:
+        result = result.filter(
+            tuple_(Message.datetime_writing, Message.message_id) < tuple_(datetime_writing, message_id))
+    return result.order_by(desc(Message.datetime_writing), desc(Message.message_id))
@@ -2,7 +2,6 @@
 from flask import abort
 from flask import current_app
 from flask import g
-from flask import jsonify
 from flask import redirect
 from flask import render_template
 from flask import request
@@ -14,10 +13,12 @@ from app import db
 from app.authentication import User
 from app.authentication.decorators import login_required
 from app.chats import chats as chats_bp
-from app.chats.utils import search_for_users_by
+from app.routing import read_only
+from app.chats.utils import search_users_page
+from app.json_backend import json_backend
 from . import logger
 from .utils import get_user_chats_and_last_messages
-from .utils import get_users_unique_room_name
+from .utils import get_chat_room_name
 
 
 class UserSearchForChat(MethodView):
@@ -30,11 +31,15 @@ class UserSearchForChat(MethodView):
 
 @chats_bp.route('/ajax-search', methods=['GET'])
 @login_required
+@read_only
 def ajax_search():
     """
     The route is used when a certain user searches for the companion. It receives only ajax requests and returns list of
     dicts dumped in json format. Each dict represent information about one potential recipient. A string for searching
     is taken from requests url parameter: 'search-string'.
+    At most SEARCH_RESULTS_LIMIT users are returned, the most relevant first. If there are more, 'next_cursor' of the
+    response can be given in 'cursor' url parameter to get the next ones, otherwise it is null. 'limit' url parameter
+    makes the page smaller.
     If the request is not ajax, 404 error is raised.
     """
     x_requested_with = request.headers.get('X-Requested-With', default='')
@@ -44,13 +49,18 @@ def ajax_search():
 
     current_user_id = g.user.user_id
     search_string = request.args.get('search-string', default='')
-    result_data = search_for_users_by(search_string, current_user_id=current_user_id).all()
-    result_data = [row._asdict() for row in result_data]
-    return jsonify(data=result_data)
+    try:
+        rows, next_cursor = search_users_page(search_string, current_user_id=current_user_id,
+                                              cursor=request.args.get('cursor'),
+                                              limit=request.args.get('limit', type=int))
+    except ValueError:
+        abort(400, description='Cursor is not valid')
+    result_data = [{'name': row.name, 'username': row.username} for row in rows]
+    return json_backend.jsonify(data=result_data, next_cursor=next_cursor)
 
 
 class UserChatsList(MethodView):
-    decorators = [login_required, ]
+    decorators = [read_only, login_required]
 
     def get(self) -> str:
         """Return list of chats the current user has started and their last messages. The list is sorted by last
@@ -68,7 +78,7 @@ class UserChatBegin(MethodView):
     decorators = [login_required, ]
 
     def get(self, companion_username: str):
-        """Prepares the current user to communication, creates unique room name, based on names of users.
+        """Prepares the current user to communication, creates unique room name, based on ids of users.
         Saves data into session and redirects into chat room. If username is not valid, it means that the url was
         inputted directly, so, it is likely wrong. If it is so, returns page not found.
         :param companion_username: username of user, which the current user wants to talk to"""
@@ -76,9 +86,9 @@ class UserChatBegin(MethodView):
         companion = User.query.filter_by(username=companion_username).first_or_404()
         room_name = None
         try:
-            room_name = get_users_unique_room_name(user.username, companion_username)
+            room_name = get_chat_room_name(user.user_id, companion.user_id)
         except ValueError:
-            logger.error('Two equal usernames were given to get_users_unique_room_name function somehow')
+            logger.error('Two equal users ids were given to get_chat_room_name function somehow')
             abort(404)
         session['room_name'] = room_name
         session['user_name'] = user.name
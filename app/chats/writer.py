@@ -0,0 +1,284 @@
+"""Write-behind persistence of messages received by socket events. Instead of a transaction per message, messages are
+collected into a bounded queue and a background thread inserts them by multi-row INSERT statements, when the batch is
+full or the flush interval has passed since the first message of the batch. If the queue is full for a while, the
+message is written synchronously, so a slow database slows down senders instead of growing the memory. Messages which
+have been queued are flushed on the worker shutdown.
+If a batch is refused, its messages are written one by one, and the ones the database rejects are logged and dropped,
+so one bad message does not hold back the others. If the database is unavailable, at most
+MESSAGES_WRITE_BEHIND_MAX_PENDING messages wait to be written again, new messages stay in the queue meanwhile.
+Messages are emitted to the room before they are saved, so a process crash can lose messages of the last flush
+interval. That is why write-behind is off by default (MESSAGES_WRITE_BEHIND), and each message is saved in its own
+transaction.
+"""
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from flask import Flask
+from sqlalchemy import insert
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+
+from app import db
+from app.authentication.models import User
+from app.chats.exceptions import ChatAlreadyExistsError
+from app.stats import register_stats_provider
+from . import logger
+from .models import Message
+
+_STOP = object()
+
+
+class MessageWriter:
+    """
+    Flask extension which owns the write-behind queue and its flushing thread. The thread is started by the first
+    queued message, so applications which do not receive messages (cli commands, tests) do not run it.
+
+    :Example:
+        message_writer = MessageWriter()
+        message_writer.init_app(app)
+        message_writer.put(sender_id=1, receiver_id=2, text='Hello!', datetime_writing=datetime.utcnow())
+    """
+
+    def __init__(self, app: Flask = None):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 100
+        self.interval = 0.2
+        self.put_timeout = 0.05
+        self.max_pending = 1000
+        self.queue = queue.Queue()
+        self.thread = None
+        self.flush_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.pending = []
+        self.exit_handler_registered = False
+        self._reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        """Reads the settings from the application config. Messages queued for the previous application are flushed"""
+        self.stop()
+        self.app = app
+        self.enabled = app.config['MESSAGES_WRITE_BEHIND']
+        self.batch_size = app.config['MESSAGES_WRITE_BEHIND_BATCH_SIZE']
+        self.interval = app.config['MESSAGES_WRITE_BEHIND_INTERVAL'] / 1000
+        self.put_timeout = app.config['MESSAGES_WRITE_BEHIND_PUT_TIMEOUT']
+        self.max_pending = app.config['MESSAGES_WRITE_BEHIND_MAX_PENDING']
+        self.queue = queue.Queue(maxsize=app.config['MESSAGES_WRITE_BEHIND_QUEUE_SIZE'])
+        self._reset_stats()
+        app.extensions['message_writer'] = self
+
+    def put(self, sender_id: int, receiver_id: int, text: str, datetime_writing: datetime, chat_id: int = None):
+        """
+        Queues a message to be saved. If chat_id is not given, the chat between users is found (or created)
+        synchronously, so only the message insert is postponed. Must be executed inside the application context.
+        :param sender_id: id of the user who sent the message
+        :type sender_id: int
+        :param receiver_id: id of the companion
+        :type receiver_id: int
+        :param text: text of the message
+        :type text: str
+        :param datetime_writing: utc datetime of writing
+        :type datetime_writing: datetime
+        :param chat_id: the chat between users, if it has already been resolved
+        :type chat_id: int
+        """
+        if chat_id is None:
+            if not User.is_chat_between(sender_id, receiver_id):
+                logger.info('Message writer is making a chat between users')
+                try:
+                    User.create_chat(sender_id, receiver_id)
+                    db.session.commit()
+                except ChatAlreadyExistsError:
+                    # chat_cache was stale, another worker has made the chat
+                    pass
+            chat_id = User.get_chat_id_by_users_ids(sender_id, receiver_id)
+        row = {'chat_id': chat_id, 'sender_id': sender_id,
+               'receiver_id': receiver_id, 'text': text, 'datetime_writing': datetime_writing}
+        self._start()
+        try:
+            self.queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning('Message writer queue is full, the message is saved synchronously')
+            self.sync_writes += 1
+            with self.flush_lock:
+                if not self._save([row]):
+                    if len(self.pending) < self.max_pending:
+                        self.pending.append(row)
+                    else:
+                        self.dropped += 1
+                        logger.error(f'Message writer could not save the message of chat {chat_id} and dropped it, '
+                                     f'{len(self.pending)} messages are pending already')
+
+    def flush(self):
+        """Saves all the queued messages right now in the calling thread"""
+        with self.flush_lock:
+            while True:
+                try:
+                    row = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    if self.thread is None:
+                        # the thread has been stopped and is not waiting for it any more
+                        continue
+                    # the stopping thread must still receive it
+                    self.queue.put(_STOP)
+                    break
+                self.pending.append(row)
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                saved = self._save(batch)
+                del self.pending[:saved]
+                if saved < len(batch):
+                    break
+
+    def stop(self):
+        """Stops the flushing thread and saves the rest of the queued messages. It is called at the process exit"""
+        with self.start_lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(_STOP)
+            thread.join(timeout=30)
+        if self.app is not None:
+            self.flush()
+
+    def stats(self) -> dict:
+        """Returns the queue depth, counters of written messages and flush latencies in milliseconds"""
+        return {'enabled': self.enabled,
+                'queue_depth': self.queue.qsize(),
+                'pending': len(self.pending),
+                'written': self.written,
+                'flushes': self.flushes,
+                'sync_writes': self.sync_writes,
+                'errors': self.errors,
+                'rejected': self.rejected,
+                'dropped': self.dropped,
+                'last_flush_ms': round(self.last_flush_time * 1000, 3),
+                'max_flush_ms': round(self.max_flush_time * 1000, 3),
+                'avg_flush_ms': round(self.total_flush_time / self.flushes * 1000, 3) if self.flushes else 0}
+
+    def _reset_stats(self):
+        self.written = 0
+        self.flushes = 0
+        self.sync_writes = 0
+        self.errors = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.last_flush_time = 0
+        self.max_flush_time = 0
+        self.total_flush_time = 0
+
+    def _start(self):
+        if self.thread is not None:
+            return
+        with self.start_lock:
+            if self.thread is None:
+                # a daemon thread does not prevent the exit, the queue is flushed by atexit instead
+                self.thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self.thread.start()
+                if not self.exit_handler_registered:
+                    atexit.register(self.stop)
+                    self.exit_handler_registered = True
+
+    def _run(self):
+        deadline = None
+        failed = False
+        while True:
+            if self.thread is not threading.current_thread():
+                # stop() has been called
+                return
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if len(self.pending) >= self.max_pending:
+                # the database does not take the pending messages, so new ones are left in the queue, and put() writes
+                # synchronously when it is full
+                time.sleep(timeout if timeout is not None else self.interval)
+            else:
+                try:
+                    row = self.queue.get(timeout=timeout)
+                    with self.flush_lock:
+                        # takes what has already been queued without waiting, up to the batch size
+                        while row is not None:
+                            if row is _STOP:
+                                return
+                            self.pending.append(row)
+                            row = self.queue.get_nowait() if len(self.pending) < min(
+                                self.batch_size, self.max_pending) else None
+                except queue.Empty:
+                    pass
+            if self.pending and deadline is None:
+                deadline = time.monotonic() + self.interval
+            # after a failure even a full batch waits for the interval, not to retry in a busy loop
+            full = len(self.pending) >= self.batch_size and not failed
+            if full or (deadline is not None and time.monotonic() >= deadline):
+                with self.flush_lock:
+                    batch = self.pending[:self.batch_size]
+                    saved = self._save(batch) if batch else 0
+                    del self.pending[:saved]
+                    # the rest of a failed batch stays pending and is retried after the next interval
+                    failed = saved < len(batch)
+                    deadline = time.monotonic() + self.interval if self.pending else None
+
+    def _save(self, rows: List[dict]) -> int:
+        """
+        Writes the rows by one batch. If the database refuses the batch not because it is unavailable, the rows are
+        written one by one, and the rows which are rejected are logged and dropped.
+        :param rows: rows of the messages table
+        :type rows: list
+        :return: number of the first rows which are done with, saved or rejected. The rest must be written again
+        :rtype: int
+        """
+        error = self._write(rows)
+        if error is None:
+            return len(rows)
+        if self._is_unavailable(error):
+            return 0
+        if len(rows) > 1:
+            logger.warning(f'Message writer is saving {len(rows)} messages one by one')
+        for number, row in enumerate(rows):
+            error = self._write([row]) if len(rows) > 1 else error
+            if error is None:
+                continue
+            if self._is_unavailable(error):
+                return number
+            self.rejected += 1
+            logger.error(f'Message writer rejected the message {row!r}: {error}')
+        return len(rows)
+
+    @staticmethod
+    def _is_unavailable(error: Exception) -> bool:
+        """Tells whether the error is caused by the database connection rather than by the written rows"""
+        return isinstance(error, (OperationalError, InterfaceError, DisconnectionError)) or getattr(
+            error, 'connection_invalidated', False)
+
+    def _write(self, rows: List[dict]) -> Optional[Exception]:
+        """
+        Inserts the rows by one statement and updates the last messages of their chats in the same transaction.
+        :return: the error if the rows were not saved, otherwise None
+        :rtype: Exception
+        """
+        start = time.perf_counter()
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                connection.execute(insert(Message).values(rows))
+                for chat_id in {row['chat_id'] for row in rows}:
+                    Message.refresh_chat_last_message(chat_id, connection)
+        except Exception as error:
+            self.errors += 1
+            logger.exception(f'Message writer could not save {len(rows)} messages')
+            return error
+        flush_time = time.perf_counter() - start
+        self.written += len(rows)
+        self.flushes += 1
+        self.last_flush_time = flush_time
+        self.max_flush_time = max(self.max_flush_time, flush_time)
+        self.total_flush_time += flush_time
+        return None
+
+
+message_writer = MessageWriter()
+register_stats_provider('message_writer', message_writer.stats)
@@ -4,6 +4,7 @@ clearly to split application logic and understand it.
 import sys
 import unittest
 
+import click
 from flask import Blueprint
 from flask import current_app
 
@@ -30,3 +31,23 @@ def tests_command():  # pragma: no cover
     else:
         logger.warning('Tests were finished unsuccessfully')
         sys.exit(1)
+
+
+@cli_commands.cli.command('local-broker')
+@click.argument('path', required=False)
+@click.option('--store-size', default=1000000, help='The maximum number of keys kept for shared caches')
+def local_broker_command(path: str = None, store_size: int = 1000000):  # pragma: no cover
+    """Run the local Socket.IO message queue broker on a unix socket. It also serves shared caches. If the path is
+    not given, it is taken from SOCKETIO_MESSAGE_QUEUE config variable"""
+    from app.message_queue import LocalBroker
+    if not path:
+        url = current_app.config['SOCKETIO_MESSAGE_QUEUE'] or ''
+        if not url.startswith('unix://'):
+            raise click.UsageError('Give the socket path or set SOCKETIO_MESSAGE_QUEUE=unix:///path/to/socket')
+        path = url[len('unix://'):]
+    broker = LocalBroker(path, store_size)
+    logger.info(f'Local broker is listening on {path}')
+    try:
+        broker.serve_forever()
+    finally:
+        broker.server_close()
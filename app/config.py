@@ -18,6 +18,29 @@ class Config:
     DB_NAME = os.getenv('DB_NAME') or 'flask-simple-chats'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = f'postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+    # Options of the postgres engine (see app/database.py). Keys of SQLALCHEMY_ENGINE_OPTIONS take precedence over the
+    # DB_* settings. Connections are recycled after POOL_RECYCLE seconds, checked before use if POOL_PRE_PING, and
+    # statements running longer than STATEMENT_TIMEOUT milliseconds are cancelled (0 disables the timeout). Migrations
+    # run without the timeout
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE') or 5)
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW') or 10)
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT') or 30)
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE') or 1800)
+    DB_POOL_PRE_PING = (os.getenv('DB_POOL_PRE_PING') or 'true').lower() == 'true'
+    DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT') or 30000)
+    # Read replicas, which serve read only endpoints (see app/routing.py), comma separated in the environment variable.
+    # A failed replica is not used for REPLICA_RETRY_INTERVAL seconds
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in (os.getenv('SQLALCHEMY_REPLICA_URIS') or '').split(',') if uri]
+    REPLICA_RETRY_INTERVAL = int(os.getenv('REPLICA_RETRY_INTERVAL') or 30)
+    # Makes psycopg2 yield to the eventlet hub while it waits for postgres (see app/database.py): 'true', 'false' or
+    # 'auto', which enables it in processes monkey patched by eventlet. In the green mode many greenlets of a worker can
+    # query at once, so the pool is bigger than the default one; keep workers * (POOL_SIZE + MAX_OVERFLOW) below
+    # max_connections of postgres
+    DB_GREEN_DRIVER = os.getenv('DB_GREEN_DRIVER') or 'auto'
+    DB_GREEN_POOL_SIZE = int(os.getenv('DB_GREEN_POOL_SIZE') or 20)
+    DB_GREEN_MAX_OVERFLOW = int(os.getenv('DB_GREEN_MAX_OVERFLOW') or 10)
+    DB_GREEN_POOL_TIMEOUT = int(os.getenv('DB_GREEN_POOL_TIMEOUT') or 10)
     MAIL_SERVER = os.getenv('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = os.getenv('MAIL_PORT') or '587'
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
@@ -28,8 +51,77 @@ class Config:
     REQUIRED_MIN_PASSWORD_LENGTH = 8
     CHATS_PER_PAGE = 8
     MESSAGES_PER_LOAD_EVENT = 10
+    # The maximum number of missed messages returned to a reconnected socket, a client which has missed more reloads
+    # the history
+    MESSAGES_PER_SYNC_EVENT = 100
+    # The maximum number of users returned by one search request
+    SEARCH_RESULTS_LIMIT = 20
+    # Every worker can keep the prefix index of users for the search (see app/chats/search_index.py). It is built in the
+    # background at start, users registered by other workers are loaded every USER_SEARCH_INDEX_REFRESH seconds, and
+    # their renames and deletions are seen after the full rebuild every USER_SEARCH_INDEX_REBUILD seconds
+    USER_SEARCH_INDEX = (os.getenv('USER_SEARCH_INDEX') or 'false').lower() == 'true'
+    USER_SEARCH_INDEX_REFRESH = int(os.getenv('USER_SEARCH_INDEX_REFRESH') or 60)
+    USER_SEARCH_INDEX_REBUILD = int(os.getenv('USER_SEARCH_INDEX_REBUILD') or 3600)
     AUTHENTICATION_TOKEN_DEFAULT_EXPIRES_IN = 3600
     BUNDLE_ERRORS = True
+    # Encoder of Socket.IO packets, api responses and ajax views: auto (orjson if it is installed), orjson or json
+    JSON_BACKEND = os.getenv('JSON_BACKEND') or 'auto'
+    # Page sizes of the api lists: the default one and the maximum one a client can ask by 'limit' param
+    API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE') or 50)
+    API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE') or 500)
+    # Streamed lists (see app/api/streaming.py) are not bounded, their rows are read from the database by chunks
+    API_STREAM_CHUNK_SIZE = int(os.getenv('API_STREAM_CHUNK_SIZE') or 1000)
+    # Events of a chat (see app/api/events.py): seconds between comments of an idle event stream and the longest wait of
+    # a long polling request
+    API_EVENTS_KEEPALIVE = int(os.getenv('API_EVENTS_KEEPALIVE') or 15)
+    API_LONG_POLL_TIMEOUT = int(os.getenv('API_LONG_POLL_TIMEOUT') or 25)
+    # Pub/sub queue to share Socket.IO rooms between worker processes: redis://..., kafka://..., zmq+..., amqp://... or
+    # unix:///path/to/socket for the local broker (flask local-broker). If it is empty, only one worker can be used.
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    SOCKETIO_CHANNEL = os.getenv('SOCKETIO_CHANNEL') or 'flask-simple-chats'
+    # If it is true, messages from sockets are saved by batches in a background thread (see app/chats/writer.py), and a
+    # crash loses the messages of the last INTERVAL which have already been printed. A batch is written when it has
+    # BATCH_SIZE messages or INTERVAL milliseconds passed. When the queue is full for PUT_TIMEOUT seconds, a message is
+    # saved synchronously
+    MESSAGES_WRITE_BEHIND = (os.getenv('MESSAGES_WRITE_BEHIND') or 'false').lower() == 'true'
+    MESSAGES_WRITE_BEHIND_BATCH_SIZE = 100
+    MESSAGES_WRITE_BEHIND_INTERVAL = 200
+    MESSAGES_WRITE_BEHIND_QUEUE_SIZE = 10000
+    MESSAGES_WRITE_BEHIND_PUT_TIMEOUT = 0.05
+    # messages which wait to be written again while the database is unavailable
+    MESSAGES_WRITE_BEHIND_MAX_PENDING = 1000
+    # Cache of chats between users. If CHAT_CACHE_URL is empty, each worker has its own cache, whose entries are
+    # invalidated in other workers through SOCKETIO_MESSAGE_QUEUE after a chat is created or deleted. Without the queue
+    # they can be stale for CHAT_CACHE_TTL seconds, so the local cache is only safe for a single worker. To share the
+    # cache set it to redis://... or to the local broker url unix:///path/to/socket
+    CHAT_CACHE_URL = os.getenv('CHAT_CACHE_URL')
+    CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE') or 100000)
+    CHAT_CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL') or 300)
+    # Cache of logged in users, which are loaded on every request. It is invalidated when a user is updated
+    USER_CACHE_URL = os.getenv('USER_CACHE_URL')
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL') or 60)
+    # Cache of verified basic auth credentials, which allows to skip slow password hashing. Its keys include the stored
+    # password hash, which is read on every request, so a changed password stops working at once in every worker.
+    # Set the size to 0 to disable
+    CREDENTIALS_CACHE_URL = os.getenv('CREDENTIALS_CACHE_URL')
+    CREDENTIALS_CACHE_SIZE = int(os.getenv('CREDENTIALS_CACHE_SIZE') or 10000)
+    CREDENTIALS_CACHE_TTL = int(os.getenv('CREDENTIALS_CACHE_TTL') or 300)
+    # Revoked authentication tokens are sent to the other workers through SOCKETIO_MESSAGE_QUEUE. Set redis://... or the
+    # local broker url unix:///path/to/socket to keep them also in a shared store, so restarted workers know them
+    REVOKED_TOKENS_URL = os.getenv('REVOKED_TOKENS_URL')
+    # Users who have committed changes, they read from the primary database during TTL seconds, while replicas catch up.
+    # Share it between workers like the other caches
+    RECENT_WRITERS_CACHE_URL = os.getenv('RECENT_WRITERS_CACHE_URL')
+    RECENT_WRITERS_CACHE_SIZE = int(os.getenv('RECENT_WRITERS_CACHE_SIZE') or 100000)
+    RECENT_WRITERS_CACHE_TTL = int(os.getenv('RECENT_WRITERS_CACHE_TTL') or 5)
+    # Pages of the database user search by normalized search strings. They are shared by all the searchers and cleared
+    # when a user is registered, renamed or deleted, so the TTL only bounds staleness after changes of other workers
+    SEARCH_CACHE_URL = os.getenv('SEARCH_CACHE_URL')
+    SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE') or 10000)
+    SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL') or 30)
+    # Makes /stats return runtime statistics of the application components
+    STATS_ENABLED = (os.getenv('STATS_ENABLED') or 'false').lower() == 'true'
 
     LOGGING = True
     LOGGING_CONFIG = {
@@ -114,3 +206,6 @@ class TestConfig(Config):
     TEST_DB_NAME = os.getenv('TEST_DB_NAME') or 'chats_test_db.sqlite'
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{os.path.join(TEST_DB_PATH, TEST_DB_NAME)}'
     WTF_CSRF_ENABLED = False
+    MESSAGES_WRITE_BEHIND = False
+    USER_SEARCH_INDEX = False
+    STATS_ENABLED = True
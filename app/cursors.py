@@ -0,0 +1,41 @@
+"""Opaque cursors of keyset pagination. A cursor keeps the sort key of the last returned row, so the next page is taken
+by a predicate on the key instead of OFFSET. It is passed to clients as a url safe string."""
+import base64
+import json
+from typing import Tuple, Union
+
+
+def encode_cursor(key: dict) -> str:
+    """
+    Makes a cursor string from the sort key of the last row.
+    :param key: json serializable sort key
+    :type key: dict
+    :return: url safe string
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, *fields: str, **types: Union[type, Tuple[type, ...]]) -> dict:
+    """
+    Restores the sort key from the cursor string. Raises ValueError if the cursor is broken, has not the given fields
+    or their values have other types, so a forged cursor does not reach the queries.
+    :param cursor: string given by :func:`encode_cursor`
+    :type cursor: str
+    :param fields: required keys of the sort key
+    :type fields: str
+    :param types: expected types of the values by their keys, they are checked if the keys are in the sort key. Booleans
+                  are not taken for int and float
+    :return: sort key
+    :rtype: dict
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as error:
+        raise ValueError('Cursor is not valid') from error
+    if not isinstance(key, dict) or any(field not in key for field in fields):
+        raise ValueError('Cursor is not valid')
+    for field, expected in types.items():
+        if field in key and (isinstance(key[field], bool) or not isinstance(key[field], expected)):
+            raise ValueError('Cursor is not valid')
+    return key
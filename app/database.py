@@ -0,0 +1,195 @@
+"""Database engine settings and monitoring of its connection pool.
+The gunicorn eventlet worker runs every socket connection in a greenlet, but psycopg2 talks to postgres by the C
+library, whose sockets are not patched by eventlet. So a query blocks the hub and all the other connections of the
+worker wait for it. In the green mode psycopg2 gets a wait callback, which passes the control to the hub while the query
+is being executed, like psycogreen does.
+Pools of postgres engines are made from the DB_* settings and count the time spent to get a connection, so the pool of
+a worker can be sized by the statistics of :data:`pool_monitor`.
+"""
+import threading
+import time
+
+from flask import Flask, has_app_context
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool, QueuePool
+
+from . import db
+from . import logger
+from .stats import register_stats_provider
+
+try:
+    import eventlet
+    from eventlet import patcher
+    from eventlet.hubs import trampoline
+except ImportError:  # pragma: no cover
+    eventlet = None
+
+
+def eventlet_wait_callback(connection, timeout: float = None):
+    """
+    Waits for the asynchronous psycopg2 connection by the eventlet hub instead of blocking the process.
+    :param connection: psycopg2 connection
+    :param timeout: it is not used, but psycopg2 can pass it
+    """
+    from psycopg2 import OperationalError, extensions
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            trampoline(connection.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(connection.fileno(), write=True)
+        else:
+            raise OperationalError(f'Bad result from poll: {state}')
+
+
+def is_green_driver_required(app: Flask) -> bool:
+    """
+    Decides whether the green mode must be used according to DB_GREEN_DRIVER. If it is 'auto', the mode is used when
+    the process is monkey patched by eventlet, like in the gunicorn eventlet worker.
+    :param app: application
+    :type app: Flask
+    :rtype: bool
+    """
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        return False
+    mode = str(app.config['DB_GREEN_DRIVER']).lower()
+    if mode == 'auto':
+        return eventlet is not None and patcher.is_monkey_patched('socket')
+    return mode == 'true'
+
+
+def configure_green_driver(app: Flask) -> bool:
+    """
+    Makes psycopg2 cooperative, if it is required.
+    :param app: application
+    :type app: Flask
+    :return: whether the green mode is used
+    :rtype: bool
+    """
+    if not is_green_driver_required(app):
+        return False
+    if eventlet is None:
+        raise RuntimeError('Eventlet package is not installed (Run "pip install eventlet" in your virtualenv).')
+    from psycopg2 import extensions
+    extensions.set_wait_callback(eventlet_wait_callback)
+    return True
+
+
+def configure_engine_options(app: Flask):
+    """
+    Fills SQLALCHEMY_ENGINE_OPTIONS of a postgres engine from the DB_* settings. A green worker gets the DB_GREEN_* pool
+    sizes, because many greenlets can query at once. Options set explicitly in SQLALCHEMY_ENGINE_OPTIONS are not
+    overridden. Sqlite engines are left as they are.
+    :param app: application
+    :type app: Flask
+    """
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        return
+    prefix = 'DB_GREEN_' if configure_green_driver(app) else 'DB_'
+    engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    engine_options.setdefault('poolclass', MonitoredQueuePool)
+    engine_options.setdefault('pool_size', app.config[f'{prefix}POOL_SIZE'])
+    engine_options.setdefault('max_overflow', app.config[f'{prefix}MAX_OVERFLOW'])
+    engine_options.setdefault('pool_timeout', app.config[f'{prefix}POOL_TIMEOUT'])
+    engine_options.setdefault('pool_recycle', app.config['DB_POOL_RECYCLE'])
+    engine_options.setdefault('pool_pre_ping', app.config['DB_POOL_PRE_PING'])
+    if app.config['DB_STATEMENT_TIMEOUT']:
+        connect_args = dict(engine_options.get('connect_args') or {})
+        connect_args.setdefault('options', f'-c statement_timeout={app.config["DB_STATEMENT_TIMEOUT"]}')
+        engine_options['connect_args'] = connect_args
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    logger.info(f'Database pool size {engine_options["pool_size"]}, overflow {engine_options["max_overflow"]}'
+                f'{", green driver" if prefix == "DB_GREEN_" else ""}')
+
+
+class PoolMonitor:
+    """
+    Counts checkouts, connections in use, invalidations of all the connection pools of the process and the time spent
+    in :class:`MonitoredQueuePool` to get a connection, which includes waiting for a free one and connecting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset_stats()
+        event.listen(Pool, 'checkout', self.on_checkout)
+        event.listen(Pool, 'checkin', self.on_checkin)
+        event.listen(Pool, 'invalidate', self.on_invalidate)
+        event.listen(Pool, 'soft_invalidate', self.on_invalidate)
+        register_stats_provider('database_pool', self.stats)
+
+    def init_app(self, app: Flask):
+        self._reset_stats()
+        app.extensions['pool_monitor'] = self
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def record_wait(self, seconds: float, timeout: bool = False):
+        """
+        Saves the time of getting a connection from a pool.
+        :param seconds: time of waiting
+        :type seconds: float
+        :param timeout: whether the pool failed to give a connection in time
+        :type timeout: bool
+        """
+        with self.lock:
+            self.waits += 1
+            self.total_wait_time += seconds
+            self.max_wait_time = max(self.max_wait_time, seconds)
+            if timeout:
+                self.timeouts += 1
+
+    def stats(self) -> dict:
+        """Returns the counters and the state of the pool of the current application, if it is a queue pool"""
+        stats = {'checkouts': self.checkouts,
+                 'in_use': self.in_use,
+                 'max_in_use': self.max_in_use,
+                 'invalidations': self.invalidations,
+                 'timeouts': self.timeouts,
+                 'avg_wait_ms': round(self.total_wait_time / self.waits * 1000, 3) if self.waits else 0,
+                 'max_wait_ms': round(self.max_wait_time * 1000, 3)}
+        pool = db.engine.pool if has_app_context() else None
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                         overflow=pool.overflow())
+        return stats
+
+    def _reset_stats(self):
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+
+class MonitoredQueuePool(QueuePool):
+    """Queue pool which reports the time spent to get a connection to :data:`pool_monitor`"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_monitor.record_wait(time.perf_counter() - start, timeout=True)
+            raise
+        pool_monitor.record_wait(time.perf_counter() - start)
+        return connection
+
+
+pool_monitor = PoolMonitor()
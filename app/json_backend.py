@@ -0,0 +1,139 @@
+"""JSON backend used by all the encoders of the application: Socket.IO packets, the responses of the rest api and the
+ajax views. It is chosen by JSON_BACKEND setting:
+    - auto - orjson, if it is installed (pip install orjson), and the standard json module otherwise;
+    - orjson - orjson, it must be installed;
+    - json - the standard json module.
+Both backends encode datetimes in ISO 8601, naive ones are treated as UTC, like all the datetimes saved by the
+application, e.g. '2021-05-20T14:18:38+00:00'. Dates, UUIDs, decimals and markup are encoded as strings. orjson output
+is compact and not ASCII-escaped. Formatting it does not support, like an indent other than 2 or a custom encoder
+class, is done by the standard json module.
+"""
+import datetime
+import decimal
+import json
+import uuid
+from typing import Any
+
+from flask import Flask, Response, current_app
+
+from .stats import register_stats_provider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def encode_default(value: Any) -> Any:
+    """
+    Encodes the values which json cannot encode itself.
+    :param value: value of an unsupported type
+    :return: json serializable value
+    """
+    if isinstance(value, datetime.datetime):
+        return (value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)).isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, decimal.Decimal)):
+        return str(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class StandardJSON:
+    """The standard json module with :func:`encode_default`"""
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj: Any, **kwargs) -> str:
+        kwargs.setdefault('default', encode_default)
+        return json.dumps(obj, **kwargs)
+
+    @staticmethod
+    def loads(s, **kwargs) -> Any:
+        return json.loads(s, **kwargs)
+
+
+class OrjsonJSON:
+    """orjson with the options of :class:`StandardJSON`"""
+    name = 'orjson'
+    # arguments of json.dumps whose values orjson follows on its own way
+    ignored_arguments = {'separators', 'ensure_ascii'}
+
+    @staticmethod
+    def dumps(obj: Any, **kwargs) -> str:
+        sort_keys = kwargs.pop('sort_keys', False)
+        indent = kwargs.pop('indent', None)
+        if indent not in (None, 2) or set(kwargs) - OrjsonJSON.ignored_arguments:
+            return StandardJSON.dumps(obj, sort_keys=sort_keys, indent=indent, **kwargs)
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=encode_default, option=option).decode()
+        except TypeError:
+            # e.g. integers bigger than 64 bits, the standard module raises an error, if the value cannot be encoded
+            return StandardJSON.dumps(obj, sort_keys=sort_keys, indent=indent, **kwargs)
+
+    @staticmethod
+    def loads(s, **kwargs) -> Any:
+        if kwargs:
+            return StandardJSON.loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+class JSONBackend:
+    """
+    Flask extension which keeps the configured backend. It has dumps and loads functions like the json module, so it is
+    given to Socket.IO server as its json module.
+    """
+
+    def __init__(self):
+        self.backend = StandardJSON
+        register_stats_provider('json_backend', lambda: {'backend': self.backend.name})
+
+    def init_app(self, app: Flask):
+        """Chooses the backend by JSON_BACKEND setting"""
+        name = app.config['JSON_BACKEND']
+        if name == 'auto':
+            name = 'orjson' if orjson is not None else 'json'
+        if name == 'orjson':
+            if orjson is None:
+                raise RuntimeError('Orjson package is not installed (Run "pip install orjson" in your virtualenv).')
+            self.backend = OrjsonJSON
+        elif name == 'json':
+            self.backend = StandardJSON
+        else:
+            raise ValueError(f'Unknown json backend: {name}')
+        app.extensions['json_backend'] = self
+
+    @property
+    def name(self) -> str:
+        return self.backend.name
+
+    def dumps(self, obj: Any, **kwargs) -> str:
+        return self.backend.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs) -> Any:
+        return self.backend.loads(s, **kwargs)
+
+    def jsonify(self, *args, **kwargs) -> Response:
+        """
+        Makes a json response like :func:`flask.jsonify`: from one positional argument, several ones as a list or
+        keyword arguments as a dict. Keys are sorted by JSON_SORT_KEYS, and the output is indented in debug mode or by
+        JSONIFY_PRETTYPRINT_REGULAR.
+        :rtype: Response
+        """
+        if args and kwargs:
+            raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+        data = args[0] if len(args) == 1 else args or kwargs
+        indent = 2 if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug else None
+        return current_app.response_class(
+            self.dumps(data, indent=indent, sort_keys=current_app.config['JSON_SORT_KEYS']) + '\n',
+            mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+json_backend = JSONBackend()
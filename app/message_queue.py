@@ -0,0 +1,422 @@
+"""Message queue backends for the Socket.IO server. When a queue is configured, every emit to a room is published into a
+pub/sub channel and each worker process delivers it to its own connected clients, so users connected to different
+workers can talk to each other. Besides the queues supported by python-socketio (redis, kafka, zmq and kombu ones) a
+pure python local broker is implemented here. It listens on a unix socket and is enough to run several workers on one
+machine or in tests. The local broker also serves a key-value store, which is used by shared caches (see app/cache.py).
+Every client manager made here also gives the events it delivers to :data:`event_tap`, so code of the process (e.g.
+server-sent events of the api) can listen to rooms like Socket.IO clients do. Pub/sub managers also carry the
+invalidations of process local caches (see app/cache.py) to the other workers, as emits into a namespace which no
+client connects to.
+
+:Example:
+    $ flask local-broker /tmp/flask-simple-chats.sock
+    $ export SOCKETIO_MESSAGE_QUEUE=unix:///tmp/flask-simple-chats.sock
+    $ gunicorn --workers 4
+"""
+import functools
+import os
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Callable, Iterator, List, Optional
+
+import socketio
+
+from . import logger
+from .cache import LocalCache, apply_invalidation
+from .stats import register_stats_provider
+
+_FRAME_HEADER = struct.Struct('!I')
+_SUBSCRIBE = b'subscribe\n'
+_PUBLISH = b'publish'
+_SUBSCRIBED = b'subscribed'
+STORE = b'store'
+# namespace of the cache invalidations, its emits are applied by every worker instead of being sent to clients
+CACHE_INVALIDATION_NAMESPACE = '/cache-invalidation'
+# namespace of the revocations of authentication tokens, it is handled like the cache invalidations
+TOKEN_REVOCATION_NAMESPACE = '/token-revocation'
+
+
+def send_frame(sock: socket.socket, data: bytes):
+    """Sends data prefixed with its length, so the other side can read exactly one frame"""
+    sock.sendall(_FRAME_HEADER.pack(len(data)) + data)
+
+
+def receive_frame(sock: socket.socket) -> Optional[bytes]:
+    """Reads one frame sent by :func:`send_frame`. Returns None if the connection was closed"""
+    header = _receive_exactly(sock, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    return _receive_exactly(sock, _FRAME_HEADER.unpack(header)[0])
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def encode_parts(parts: List[bytes]) -> bytes:
+    """Packs several byte strings into one frame, each of them is prefixed with its length"""
+    return b''.join(_FRAME_HEADER.pack(len(part)) + part for part in parts)
+
+
+def decode_parts(data: bytes) -> List[bytes]:
+    """Unpacks byte strings packed by :func:`encode_parts`"""
+    parts = []
+    position = 0
+    while position < len(data):
+        size = _FRAME_HEADER.unpack_from(data, position)[0]
+        position += _FRAME_HEADER.size
+        parts.append(data[position:position + size])
+        position += size
+    return parts
+
+
+class _LocalBrokerHandler(socketserver.BaseRequestHandler):
+    """Serves one connection of the local broker. The first frame says whether the client is going to publish or to
+    subscribe for a channel or to use the store. Published frames are 'channel\\npayload' and subscribers receive only
+    payloads. Store commands are frames packed by :func:`encode_parts`: get key, set ttl key value, delete keys and
+    clear prefix. The answer starts with b'1' if the command found something, b'0' otherwise"""
+
+    def handle(self):
+        hello = receive_frame(self.request)
+        if hello is None:
+            return
+        if hello.startswith(_SUBSCRIBE):
+            channel = hello[len(_SUBSCRIBE):]
+            self.server.subscribe(channel, self.request)
+            try:
+                # subscribers never send anything, so the loop only waits for the connection to be closed
+                while self.request.recv(1024):
+                    pass
+            except OSError:
+                pass
+            finally:
+                self.server.unsubscribe(channel, self.request)
+        elif hello == _PUBLISH:
+            while True:
+                try:
+                    frame = receive_frame(self.request)
+                except OSError:
+                    break
+                if frame is None:
+                    break
+                channel, _, payload = frame.partition(b'\n')
+                self.server.publish(channel, payload)
+        elif hello == STORE:
+            while True:
+                try:
+                    frame = receive_frame(self.request)
+                    if frame is None:
+                        break
+                    send_frame(self.request, self.server.execute(*decode_parts(frame)))
+                except OSError:
+                    break
+
+
+class LocalBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Minimal pub/sub broker over a unix socket. Each published payload is sent to all the subscribers of its channel,
+    including the publisher process itself, like in redis. It also keeps a key-value store with LRU eviction and TTL.
+    :param path: file path of the unix socket. An existing file is replaced.
+    :type path: str
+    :param store_size: the maximum number of keys in the store
+    :type store_size: int
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str, store_size: int = 1000000):
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        self.store = LocalCache(store_size)
+        super().__init__(path, _LocalBrokerHandler)
+
+    def subscribe(self, channel: bytes, sock: socket.socket):
+        """Adds the connection to the channel subscribers and confirms it. The confirmation is sent under the
+        subscriber's lock, so it always comes before the first published payload"""
+        send_lock = threading.Lock()
+        with send_lock:
+            with self.subscribers_lock:
+                self.subscribers.setdefault(channel, {})[sock] = send_lock
+            send_frame(sock, _SUBSCRIBED)
+        logger.info('Local broker got a new subscriber')
+
+    def unsubscribe(self, channel: bytes, sock: socket.socket):
+        """Removes the connection from the channel subscribers"""
+        with self.subscribers_lock:
+            self.subscribers.get(channel, {}).pop(sock, None)
+
+    def publish(self, channel: bytes, payload: bytes):
+        """Sends the payload to all the channel subscribers. Frames from different publishers are not interleaved
+        because each subscriber has its own lock"""
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers.get(channel, {}).items())
+        for sock, send_lock in subscribers:
+            try:
+                with send_lock:
+                    send_frame(sock, payload)
+            except OSError:
+                self.unsubscribe(channel, sock)
+
+    def execute(self, command: bytes, *args: bytes) -> bytes:
+        """Executes a store command and returns the answer"""
+        if command == b'get':
+            value = self.store.get(args[0])
+            return b'0' if value is None else b'1' + value
+        if command == b'set':
+            ttl, key, value = args
+            self.store.set(key, value, float(ttl) if ttl else None)
+            return b'1'
+        if command == b'delete':
+            self.store.delete(*args)
+            return b'1'
+        if command == b'clear':
+            prefix = args[0]
+            with self.store.lock:
+                keys = [key for key in self.store.entries if key.startswith(prefix)]
+            self.store.delete(*keys)
+            return b'1'
+        return b'0'
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class EventTap:
+    """
+    In-process listeners of Socket.IO rooms. A listener is a queue which receives (event, data) of every event emitted
+    to its room, so it costs nothing while the room is silent. The events are published by the client manager when it
+    delivers them to its own clients, which is after the message queue, so events emitted by other workers come too.
+    If a listener does not read its queue and it is full, new events are dropped for this listener.
+    :param max_size: the maximum number of unread events of one listener
+    :type max_size: int
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.listeners = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        register_stats_provider('event_tap', self.stats)
+
+    def listen(self, namespace: str, room: str) -> queue.Queue:
+        """Returns a new listener of the room. It must be removed by :meth:`stop_listening`"""
+        listener = queue.Queue(self.max_size)
+        with self.lock:
+            self.listeners.setdefault((namespace, room), set()).add(listener)
+        return listener
+
+    def stop_listening(self, namespace: str, room: str, listener: queue.Queue):
+        """Removes the listener given by :meth:`listen`"""
+        with self.lock:
+            room_listeners = self.listeners.get((namespace, room), set())
+            room_listeners.discard(listener)
+            if not room_listeners:
+                self.listeners.pop((namespace, room), None)
+
+    def publish(self, event: str, data, namespace: str, room: str = None):
+        """Puts the event into the queues of the room's listeners. An event without a room is sent to all the listeners
+        of the namespace"""
+        if not self.listeners:
+            return
+        with self.lock:
+            if room is None:
+                listeners = [listener for (listened_namespace, _), room_listeners in self.listeners.items()
+                             if listened_namespace == namespace for listener in room_listeners]
+            else:
+                listeners = list(self.listeners.get((namespace, room), ()))
+        for listener in listeners:
+            try:
+                listener.put_nowait((event, data))
+            except queue.Full:
+                self.dropped += 1
+                logger.warning('Event listener is full, the event is dropped')
+
+    def stats(self) -> dict:
+        """Returns the numbers of listened rooms, listeners and dropped events"""
+        with self.lock:
+            return {'rooms': len(self.listeners), 'listeners': sum(map(len, self.listeners.values())),
+                    'dropped': self.dropped}
+
+
+event_tap = EventTap()
+
+
+class EventTapMixin:
+    """Publishes the events which a Socket.IO client manager delivers to the clients of this process into
+    :data:`event_tap`. Pub/sub managers deliver the events received from the queue, other ones - their own emits"""
+
+    def emit(self, event: str, data, namespace: str = None, room: str = None, skip_sid=None, callback=None, **kwargs):
+        if not isinstance(self, socketio.PubSubManager) or kwargs.get('ignore_queue'):
+            event_tap.publish(event, data, namespace or '/', room)
+        return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid, callback=callback,
+                            **kwargs)
+
+    def _handle_emit(self, message: dict):
+        if message.get('namespace') == CACHE_INVALIDATION_NAMESPACE:
+            apply_invalidation(message['data']['cache'], message['data']['keys'])
+            return
+        if message.get('namespace') == TOKEN_REVOCATION_NAMESPACE:
+            from .authentication.tokens import revoked_tokens
+            revoked_tokens.revoke(message['data']['token_id'], message['data']['expires_at'], publish=False)
+            return
+        event_tap.publish(message['event'], message['data'], message.get('namespace') or '/', message.get('room'))
+        super()._handle_emit(message)
+
+
+class TappedManager(EventTapMixin, socketio.BaseManager):
+    """Client manager which keeps clients only in memory of its own process, like the default one"""
+
+
+@functools.lru_cache(maxsize=None)
+def _tapped_class(queue_class: type) -> type:
+    """Returns a subclass of the client manager class which publishes into :data:`event_tap`"""
+    return type(queue_class.__name__, (EventTapMixin, queue_class), {'__doc__': queue_class.__doc__})
+
+
+class LocalBrokerManager(socketio.PubSubManager):
+    """
+    Socket.IO client manager which uses :class:`LocalBroker` as a message queue. Its url looks like
+    unix:///path/to/broker.sock
+    """
+    name = 'local'
+
+    def __init__(self, url: str = 'unix:///tmp/flask-simple-chats.sock', channel: str = 'socketio',
+                 write_only: bool = False, logger=None):
+        self.path = url[len('unix://'):]
+        self.publisher = None
+        self.publisher_lock = threading.Lock()
+        self.subscribed = threading.Event()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _connect(self, hello: bytes) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        send_frame(sock, hello)
+        return sock
+
+    def _publish(self, data: dict):
+        payload = self.channel.encode() + b'\n' + pickle.dumps(data)
+        with self.publisher_lock:
+            for retry in (True, False):
+                try:
+                    if self.publisher is None:
+                        self.publisher = self._connect(_PUBLISH)
+                    send_frame(self.publisher, payload)
+                    return
+                except OSError:
+                    self.publisher = None
+                    if not retry:
+                        logger.error('Cannot publish to the local broker')
+
+    def _listen(self) -> Iterator[bytes]:
+        retry_sleep = 1
+        while True:
+            try:
+                sock = self._connect(_SUBSCRIBE + self.channel.encode())
+                if receive_frame(sock) != _SUBSCRIBED:
+                    raise ConnectionError('Local broker did not confirm the subscription')
+                self.subscribed.set()
+                retry_sleep = 1
+                while True:
+                    frame = receive_frame(sock)
+                    if frame is None:
+                        break
+                    yield frame
+                self.subscribed.clear()
+            except OSError:
+                logger.error(f'Cannot receive from the local broker, retrying in {retry_sleep} secs')
+                self.subscribed.clear()
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+
+def make_invalidation_publisher(manager: socketio.BaseManager) -> Optional[Callable[[str, Optional[list]], None]]:
+    """
+    Returns the function which publishes cache invalidations through the message queue of the client manager, see
+    :func:`app.cache.set_invalidation_publisher`. If the manager has no queue, there is only one worker and None is
+    returned.
+    :param manager: Socket.IO client manager made by :func:`make_client_manager`
+    :type manager: socketio.BaseManager
+    """
+    if not isinstance(manager, socketio.PubSubManager):
+        return None
+
+    def publish(cache_name: str, keys: Optional[list]):
+        manager.emit('invalidate', {'cache': cache_name, 'keys': keys}, namespace=CACHE_INVALIDATION_NAMESPACE)
+
+    return publish
+
+
+def make_revocation_publisher(manager: socketio.BaseManager) -> Optional[Callable[[str, float], None]]:
+    """
+    Returns the function which publishes token revocations through the message queue of the client manager, see
+    :meth:`app.authentication.tokens.RevocationList.set_publisher`. If the manager has no queue, None is returned.
+    :param manager: Socket.IO client manager made by :func:`make_client_manager`
+    :type manager: socketio.BaseManager
+    """
+    if not isinstance(manager, socketio.PubSubManager):
+        return None
+
+    def publish(token_id: str, expires_at: float):
+        manager.emit('revoke', {'token_id': token_id, 'expires_at': expires_at}, namespace=TOKEN_REVOCATION_NAMESPACE)
+
+    return publish
+
+
+def start_listening(server: socketio.Server):
+    """
+    Starts listening to the message queue of the server's client manager. The server starts it only when the first
+    client connects, but the worker needs the cache invalidations and the events for :data:`event_tap` before that.
+    :param server: Socket.IO server of the worker
+    :type server: socketio.Server
+    """
+    if isinstance(server.manager, socketio.PubSubManager) and not server.manager_initialized:
+        server.manager_initialized = True
+        server.manager.initialize()
+
+
+def make_client_manager(url: str = None, channel: str = 'flask-socketio',
+                        write_only: bool = False) -> socketio.BaseManager:
+    """
+    Chooses the Socket.IO client manager according to the message queue url. It repeats the choice flask-socketio
+    makes by itself, but also knows about the local broker. The manager publishes delivered events into
+    :data:`event_tap`.
+    :param url: message queue url, like redis://localhost:6379/0 or unix:///tmp/flask-simple-chats.sock.
+                If it is empty, the server keeps clients only in memory of its own process.
+    :type url: str
+    :param channel: pub/sub channel name
+    :type channel: str
+    :param write_only: if it is true, the manager only emits and does not listen for events
+    :type write_only: bool
+    :return: client manager instance
+    """
+    if not url:
+        return TappedManager()
+    if url.startswith('unix://'):
+        queue_class = LocalBrokerManager
+    elif url.startswith(('redis://', 'rediss://')):
+        queue_class = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        queue_class = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        queue_class = socketio.ZmqManager
+    else:
+        queue_class = socketio.KombuManager
+    logger.info(f'Socket.IO uses {queue_class.__name__} as a message queue')
+    return _tapped_class(queue_class)(url, channel=channel, write_only=write_only)
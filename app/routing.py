@@ -0,0 +1,160 @@
+"""Routing of queries between the primary database and its read replicas.
+Replicas are listed in SQLALCHEMY_REPLICA_URIS and become binds 'replica0', 'replica1'... Queries go to the primary,
+except the ones made inside :func:`read_only` endpoints, which are sent to a replica. Flushes and insert, update and
+delete statements always go to the primary.
+Replicas lag behind the primary, so a user who has just written something reads from the primary during
+RECENT_WRITERS_CACHE_TTL seconds (read-your-writes), and data read from a replica is not saved into caches. If a replica
+fails, it is not used for REPLICA_RETRY_INTERVAL seconds, and the endpoint is repeated on the primary.
+
+:Example:
+    class ChatsList(Resource):
+        @authorization_required
+        @read_only
+        def get(self):
+            ...
+"""
+import functools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from flask import Flask, current_app, g, has_request_context, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+
+# the package logger cannot be imported, because the module is imported before it is created
+logger = logging.getLogger('app')
+
+_READ_ONLY = 'read_only'
+_REPLICA = 'replica'
+_WROTE = 'wrote'
+_unavailable_replicas = {}
+
+
+class RoutingSession(SignallingSession):
+    """Session which sends the queries of read only blocks to a replica"""
+
+    def __init__(self, db: SQLAlchemy, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info[_WROTE] = True
+        elif self.info.get(_READ_ONLY):
+            replica = self.info.get(_REPLICA) or choose_replica(self.app)
+            if replica is not None:
+                self.info[_REPLICA] = replica
+                return self.db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension which registers replicas as binds and makes :class:`RoutingSession` sessions"""
+
+    def init_app(self, app: Flask):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        replica_binds = []
+        for number, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS') or ()):
+            binds[f'replica{number}'] = uri
+            replica_binds.append(f'replica{number}')
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        app.config['SQLALCHEMY_REPLICA_BINDS'] = replica_binds
+        super().init_app(app)
+
+    def create_session(self, options: dict) -> orm.sessionmaker:
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def choose_replica(app: Flask) -> Optional[str]:
+    """
+    Returns the bind of a random available replica.
+    :param app: application
+    :type app: Flask
+    :return: bind key or None, if there are no available replicas
+    :rtype: str
+    """
+    now = time.monotonic()
+    replicas = [replica for replica in app.config['SQLALCHEMY_REPLICA_BINDS']
+                if _unavailable_replicas.get(replica, 0) <= now]
+    return random.choice(replicas) if replicas else None
+
+
+def mark_replica_unavailable(replica: str, seconds: float):
+    """Stops sending queries to the replica for the given number of seconds"""
+    _unavailable_replicas[replica] = time.monotonic() + seconds
+
+
+def reads_from_replica(db_session: orm.Session) -> bool:
+    """Checks whether the session sends queries to a replica at the moment, so the results can be outdated"""
+    return bool(db_session.info.get(_READ_ONLY)) and bool(current_app.config.get('SQLALCHEMY_REPLICA_BINDS'))
+
+
+def get_current_user_id() -> Optional[int]:
+    """Returns id of the user of the current request or socket event, if he is known"""
+    if not has_request_context():
+        return None
+    user = g.get('user')
+    if user is not None:
+        return user.user_id
+    return session.get('current_user_id')
+
+
+@contextmanager
+def reading(db_session: orm.Session):
+    """
+    Sends the queries of the block to a replica, unless the current user has written something recently.
+    :param db_session: session of the block
+    :type db_session: Session
+    """
+    from .cache import recent_writers_cache
+    previous_read_only, previous_replica = db_session.info.get(_READ_ONLY), db_session.info.pop(_REPLICA, None)
+    user_id = get_current_user_id()
+    db_session.info[_READ_ONLY] = user_id is None or recent_writers_cache.get(user_id) is None
+    try:
+        yield
+    finally:
+        db_session.info[_READ_ONLY] = previous_read_only
+        db_session.info.pop(_REPLICA, None)
+        if previous_replica is not None:
+            db_session.info[_REPLICA] = previous_replica
+
+
+def read_only(func):
+    """
+    Decorator of endpoints and socket event handlers which only read the database. Their queries are sent to a replica.
+    If the replica fails, the function is called once more with the primary database.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        db = current_app.extensions['sqlalchemy'].db
+        db_session = db.session()
+        with reading(db_session):
+            try:
+                return func(*args, **kwargs)
+            except (exc.OperationalError, exc.InterfaceError):
+                replica = db_session.info.get(_REPLICA)
+                if replica is None:
+                    raise
+                logger.exception(f'Replica {replica} failed, the primary database is used')
+                mark_replica_unavailable(replica, current_app.config['REPLICA_RETRY_INTERVAL'])
+                db_session.rollback()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def remember_writer(db_session: orm.Session):
+    """Makes the user, who has committed changes, read from the primary for a while"""
+    if db_session.info.pop(_WROTE, False):
+        user_id = get_current_user_id()
+        if user_id is not None:
+            from .cache import recent_writers_cache
+            recent_writers_cache.set(user_id, True)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_writes(db_session: orm.Session):
+    db_session.info.pop(_WROTE, None)
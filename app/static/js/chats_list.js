@@ -0,0 +1,67 @@
+// Applies chat_updated events to the chats list, so new messages are shown without reloading the page.
+// A chat with a new last message goes up to its place by time, a chat without messages is removed. Chats which are not
+// on the page are added only to the first page, other pages are kept as they were loaded.
+let chats_list;
+let page;
+let per_page;
+
+document.addEventListener('DOMContentLoaded', () => {
+    chats_list = document.querySelector('#chats-list');
+    page = parseInt(chats_list.dataset.page);
+    per_page = parseInt(chats_list.dataset.perPage);
+    // only websocket transport, because long-polling requests could be balanced to different workers
+    let socket = io(window.location.origin + '/chats/list', {transports: ['websocket']});
+
+    socket.on('status', function (data) {
+        console.log(data.message);
+    });
+
+    socket.on('chat_updated', function (data) {
+        update_chat(data);
+        document.querySelector('#chats-title').innerText = chats_list.children.length !== 0 ?
+            'Continue your chat with:' : 'You have not begun any chats yet.';
+    });
+});
+
+function get_chat_li(data) {
+    let li = document.createElement('li');
+    let link = document.createElement('a');
+    let div_chat = document.createElement('div');
+    let div_name = document.createElement('div');
+    let div_last_message = document.createElement('div');
+    li.dataset.chatId = data['chat_id'];
+    link.href = `/chats/begin/${data['companion_username']}`;
+    div_chat.classList.add('content__user_chat_link');
+    div_name.classList.add('user_chat_link_name');
+    div_name.innerText = data['companion_name'];
+    div_last_message.classList.add('user_chat_link_last_message');
+    div_chat.append(div_name, div_last_message);
+    link.append(div_chat);
+    li.append(link);
+    return li;
+}
+
+function update_chat(data) {
+    let li = chats_list.querySelector(`li[data-chat-id="${data['chat_id']}"]`);
+    if (data['preview'] === null) {
+        if (li)
+            li.remove();
+        return;
+    }
+    if (!li) {
+        if (page !== 1)
+            return;
+        li = get_chat_li(data);
+    }
+    li.querySelector('.user_chat_link_last_message').innerText = data['preview'];
+    li.dataset.timestamp = data['timestamp_milliseconds'];
+    if (page !== 1 && li.parentNode)
+        return;
+    // the list is sorted from the newest last message to the oldest one
+    li.remove();
+    let next = Array.from(chats_list.children).find(
+        other => parseFloat(other.dataset.timestamp) < data['timestamp_milliseconds']);
+    chats_list.insertBefore(li, next || null);
+    while (chats_list.children.length > per_page)
+        chats_list.lastElementChild.remove();
+}
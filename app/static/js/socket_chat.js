@@ -9,17 +9,34 @@ function uuidv4() {
 let socket;
 let messages;
 let current_user_uuid = uuidv4();
-let messages_offset = 0;
+// cursor of the oldest loaded message. It is null before the first loading.
+let next_cursor = null;
+let first_loading = true;
+let all_messages_loaded = false;
+// id of the newest message got from the server, it is sent by the sync event after reconnecting
+let last_message_id = 0;
+// messages printed by print_message events have no ids, they are kept until sync returns them, to be skipped
+let printed_messages = new Set();
+let connected_before = false;
+// the server can ask to sync once more after a reconnection, when other workers may have not saved messages yet
+let follow_up_sync_allowed = false;
 
 document.addEventListener('DOMContentLoaded', () => {
-    socket = io(window.location.href); // /chats/going
+    // only websocket transport, because long-polling requests could be balanced to different workers
+    socket = io(window.location.href, {transports: ['websocket']}); // /chats/going
     messages = document.querySelector('.content__messages');
     let send_message_form = document.querySelector('#send_message_form');
     // Initial loading messages.
-    socket.emit('get_more_messages', {'messages_offset': messages_offset});
+    socket.emit('get_more_messages', {'cursor': next_cursor});
 
     socket.on('connect', function () {
         socket.emit('enter_room');
+        // only the messages missed while the socket was disconnected are requested
+        if (connected_before) {
+            follow_up_sync_allowed = true;
+            socket.emit('sync', {'last_message_id': last_message_id});
+        }
+        connected_before = true;
     });
 
     socket.on('status', function (data) {
@@ -28,8 +45,6 @@ document.addEventListener('DOMContentLoaded', () => {
 
     socket.on('print_message', function (data) {
         print_message(data);
-        // increase not to obtain from db duplicates of messages.
-        messages_offset++;
         // to stay down after sending messages.
         messages.scrollTop = messages.scrollHeight;
     });
@@ -38,15 +53,44 @@ document.addEventListener('DOMContentLoaded', () => {
         let scrollHeightOld = messages.scrollHeight;
         if (data['messages_number'] !== 0)
             load_more_messages(data);
-        if (messages_offset === 0) {
+        if (first_loading) {
             //to stay down after the first request to the server
             messages.scrollTop = messages.scrollHeight;
+            first_loading = false;
         } else {
             //not to move up after loading addition messages
             messages.scrollTop = messages.scrollHeight - scrollHeightOld;
         }
-        // increase not to obtain from db duplicates of messages.
-        messages_offset += data['messages_number']
+        // the next page starts right after the oldest loaded message, so new messages do not shift it.
+        next_cursor = data['next_cursor'];
+        all_messages_loaded = next_cursor === null;
+        for (let message of data['messages'])
+            last_message_id = Math.max(last_message_id, message['message_id']);
+    });
+
+    socket.on('sync_messages', function (data) {
+        if (data['error']) {
+            console.log(data['error']);
+            return;
+        }
+        if (data['too_far_behind']) {
+            // too many messages have been missed, the history is loaded from the beginning
+            messages.innerHTML = '';
+            next_cursor = null;
+            first_loading = true;
+            all_messages_loaded = false;
+            last_message_id = 0;
+            printed_messages.clear();
+            socket.emit('get_more_messages', {'cursor': next_cursor});
+            return;
+        }
+        sync_messages(data);
+        last_message_id = Math.max(last_message_id, data['last_message_id']);
+        messages.scrollTop = messages.scrollHeight;
+        if (data['sync_again_in'] !== null && follow_up_sync_allowed) {
+            follow_up_sync_allowed = false;
+            setTimeout(() => socket.emit('sync', {'last_message_id': last_message_id}), data['sync_again_in']);
+        }
     });
 
     send_message_form.addEventListener('submit', (event) => {
@@ -62,8 +106,8 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
     messages.addEventListener('scroll', () => {
-        if (messages.scrollTop === 0) {
-            socket.emit('get_more_messages', {'messages_offset': messages_offset});
+        if (messages.scrollTop === 0 && !all_messages_loaded) {
+            socket.emit('get_more_messages', {'cursor': next_cursor});
         }
     })
 
@@ -97,7 +141,12 @@ function leave_room() {
     });
 }
 
+function get_printed_message_key(message_text, timestamp_milliseconds) {
+    return `${Math.round(timestamp_milliseconds)}:${message_text}`;
+}
+
 function print_message(data) {
+    printed_messages.add(get_printed_message_key(data.message, data.timestamp_milliseconds));
     if (data['uuid'] === current_user_uuid) {
         messages.append(get_message_div('current_user', data.message, data.timestamp_milliseconds));
     } else {
@@ -114,3 +163,14 @@ function load_more_messages(data) {
         }
     }
 }
+
+function sync_messages(data) {
+    for (let message of data['messages']) {
+        let key = get_printed_message_key(message['message_text'], message['timestamp_milliseconds']);
+        // the message has got its id, so it is not returned again and its key is not needed any more
+        if (printed_messages.delete(key))
+            continue;
+        let user_type = message['is_current_user'] ? 'current_user' : 'companion';
+        messages.append(get_message_div(user_type, message['message_text'], message['timestamp_milliseconds']));
+    }
+}
@@ -0,0 +1,25 @@
+"""Registry of runtime statistics. Components register functions which return their current counters and
+:func:`collect_stats` gathers all of them, for example, for the /stats view."""
+from typing import Callable, Dict
+
+_stats_providers: Dict[str, Callable[[], dict]] = {}
+
+
+def register_stats_provider(name: str, provider: Callable[[], dict]):
+    """
+    Registers a function which returns statistics of some component. A provider with the same name is replaced.
+    :param name: name of the component, it becomes a key in the collected statistics
+    :type name: str
+    :param provider: function without arguments which returns a json serializable dict
+    :type provider: Callable
+    """
+    _stats_providers[name] = provider
+
+
+def collect_stats() -> dict:
+    """
+    Calls all the registered providers.
+    :return: dict, where keys are names of components and values are their statistics
+    :rtype: dict
+    """
+    return {name: provider() for name, provider in _stats_providers.items()}
@@ -3,10 +3,14 @@ typical :func:`app.route` in order to work with application factory properly"""
 from typing import Tuple
 
 from flask import Blueprint
+from flask import current_app
 from flask import render_template
+from flask import Response
 from werkzeug.exceptions import NotFound
 
 from . import logger
+from .json_backend import json_backend
+from .stats import collect_stats
 
 view = Blueprint('view', __name__)
 
@@ -19,6 +23,16 @@ def index() -> str:
     return render_template('index.html')
 
 
+@view.route('/stats')
+def stats() -> Response:
+    """
+    Returns runtime statistics of the application components as json. It is available only if STATS_ENABLED is set.
+    """
+    if not current_app.config['STATS_ENABLED']:
+        raise NotFound
+    return json_backend.jsonify(collect_stats())
+
+
 @view.app_errorhandler(NotFound)
 def page_not_found(error: NotFound) -> Tuple[str, int]:
     """
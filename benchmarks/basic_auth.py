@@ -0,0 +1,57 @@
+"""Measures requests per second of GET /api/chats with basic authorization, when every request hashes the password
+(CREDENTIALS_CACHE_SIZE = 0) and when verified credentials are cached.
+All the tables in the given database are dropped, so never point it to a real database. A temporary sqlite file is
+used by default.
+
+:Example:
+    $ python -m benchmarks.basic_auth --requests 200
+"""
+import argparse
+import base64
+import os
+import tempfile
+import time
+
+from app import db
+from app import make_app
+from app.authentication import User
+from app.config import TestConfig
+
+
+def measure(config: type, requests: int) -> float:
+    """Registers a user and returns requests per second of GET /api/chats made with his basic credentials"""
+    app = make_app(config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(email='user@gmail.com', username='user', name='name')
+        user.set_password('12345678')
+        db.session.add(user)
+        db.session.commit()
+        client = app.test_client()
+        headers = {'Authorization': f'Basic {base64.b64encode(b"user@gmail.com:12345678").decode()}'}
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = client.get('/api/chats', headers=headers)
+            assert response.status_code == 200, response.status_code
+        elapsed = time.perf_counter() - start
+        db.session.remove()
+        db.drop_all()
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database_uri', nargs='?', help='uri of a scratch database, its tables will be dropped')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.sqlite')}"
+
+    for name, cache_size in (('without credentials cache', 0), ('with credentials cache', 10000)):
+        config = type('BenchmarkConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': database_uri,
+                                                         'CREDENTIALS_CACHE_SIZE': cache_size})
+        print(f'{name:30} {measure(config, args.requests):.1f} requests/s')
+
+
+if __name__ == '__main__':
+    main()
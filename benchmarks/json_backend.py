@@ -0,0 +1,68 @@
+"""Measures the cost of encoding one event by every available json backend (app/json_backend.py): Socket.IO packets of
+print_message and load_more_messages events, as the server encodes them for every emit, and a page of the messages
+list of the rest api.
+
+:Example:
+    $ python -m benchmarks.json_backend --number 100000
+"""
+import argparse
+import datetime
+import time
+
+from socketio import packet
+
+from app.json_backend import OrjsonJSON, StandardJSON, orjson
+
+
+def make_events(page_size: int) -> dict:
+    """Returns the payloads like the ones the application sends"""
+    now = datetime.datetime.utcnow()
+    timestamp = now.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+    load_more_messages = {'messages_number': 10,
+                          'messages': [{'message_id': 1000 - i, 'is_current_user': i % 2 == 0,
+                                        'message_text': f'Message number {i}, which is not very long',
+                                        'timestamp_milliseconds': timestamp - i * 1000} for i in range(10)],
+                          'next_cursor': {'datetime_writing': now.isoformat(), 'message_id': 991}}
+    messages_page = {'user_id': 1, 'chat_id': 1,
+                     'data': [{'message_id': i, 'datetime_writing': 'Thu, 20 May 2021 14:18:38 -0000',
+                               'text': f'Message number {i}, which is not very long', 'sender_id': 1,
+                               'receiver_id': 2} for i in range(page_size)],
+                     'next': 'eyJvcmRlciI6WyJkYXRldGltZV93cml0aW5nIl19', 'has_more': True}
+    return {
+        'print_message': ('socketio', ['print_message', {'message': 'Hello, how are you?',
+                                                         'timestamp_milliseconds': timestamp}]),
+        'load_more_messages': ('socketio', ['load_more_messages', load_more_messages]),
+        'event with datetime': ('socketio', ['status', {'message': 'connected', 'server_time': now}]),
+        f'api page of {page_size}': ('api', messages_page),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000, help='encodings of every event')
+    parser.add_argument('--page-size', type=int, default=50)
+    args = parser.parse_args()
+    backends = [StandardJSON] + ([OrjsonJSON] if orjson is not None else [])
+    events = make_events(args.page_size)
+
+    print(f'{"event":24}' + ''.join(f'{backend.name + " us":>12}' for backend in backends))
+    for name, (kind, data) in events.items():
+        times = []
+        for backend in backends:
+            packet.Packet.json = backend
+            if kind == 'socketio':
+                event = packet.Packet(packet.EVENT, data=data, namespace='/chats/going')
+                encode = event.encode
+            else:
+                def encode():
+                    return backend.dumps(data) + '\n'
+            number = args.number if kind == 'socketio' else max(args.number // args.page_size, 1)
+            start = time.perf_counter()
+            for _ in range(number):
+                encode()
+            times.append((time.perf_counter() - start) / number)
+        print(f'{name:24}' + ''.join(f'{elapsed * 1e6:12.2f}' for elapsed in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Measures the prefix index of users: the time to build it, the memory it takes and the latency of searches compared
+with the database search.
+All the tables in the given database are dropped, so never point it to a real database. A temporary sqlite file is
+used by default.
+
+:Example:
+    $ python -m benchmarks.search_index --users 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from app import db
+from app import make_app
+from app.chats.search_index import user_search_index
+from app.chats.utils import search_for_users_by
+from app.config import TestConfig
+from benchmarks.user_search import fill_users
+
+SEARCHES = ('a', 'an', 'ann', 'anna smith', 'zq', 'user12345')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database_uri', nargs='?', help='uri of a scratch database, its tables will be dropped')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=100, help='runs of every search')
+    args = parser.parse_args()
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.sqlite')}"
+    config = type('BenchmarkConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': database_uri})
+
+    app = make_app(config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        fill_users(args.users)
+
+        tracemalloc.start()
+        user_search_index.build()
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = user_search_index.stats()
+        print(f'{stats["users"]} users, {stats["tokens"]} tokens, built in {stats["build_ms"] / 1000:.2f}s, '
+              f'{memory / 2 ** 20:.1f} MiB, {memory / stats["users"]:.0f} bytes per user')
+
+        limit = app.config['SEARCH_RESULTS_LIMIT']
+        print(f'{"search":12} {"index ms":>9} {"database ms":>12}')
+        for search in SEARCHES:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                user_search_index.search(search, 1, limit=limit + 1)
+            index_time = (time.perf_counter() - start) / args.repeat
+            start = time.perf_counter()
+            search_for_users_by(search, 1).limit(limit + 1).all()
+            database_time = time.perf_counter() - start
+            print(f'{search:12} {index_time * 1000:9.3f} {database_time * 1000:12.2f}')
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Compares flask_restful marshal with the compiled serializers (app/api/serializers.py) on the messages list: model
+instances, like ChatMessagesList returns, and rows of a query of columns. The rows are loaded once, only the
+serialization is timed, and the json of both ways is checked to be the same.
+
+:Example:
+    $ python -m benchmarks.serializers --rows 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from flask_restful import marshal
+
+from app import db
+from app import make_app
+from app.api.resources.messages import messages_list_fields
+from app.api.serializers import Serializer
+from app.authentication.models import User
+from app.chats.models import Message
+from app.config import TestConfig
+
+
+def measure(function, repeat: int) -> float:
+    """Returns the best time of the function in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every way, the best one is printed')
+    args = parser.parse_args()
+    database_uri = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.sqlite')}"
+    config = type('BenchmarkConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': database_uri})
+
+    app = make_app(config)
+    with app.app_context():
+        db.create_all()
+        for number in (1, 2):
+            db.session.add(User(email=f'user{number}@gmail.com', username=f'user{number}', name=f'user{number}',
+                                password_hash='-'))
+        db.session.commit()
+        User.create_chat(1, 2)
+        chunk = 10000
+        for start in range(0, args.rows, chunk):
+            Message.create_many(1, 1, 2, [f'message {i}' for i in range(start, min(start + chunk, args.rows))])
+        db.session.commit()
+
+        serializer = Serializer(messages_list_fields)
+        loaded = {
+            'models': Message.query.all(),
+            'rows': db.session.query(Message.message_id, Message.datetime_writing, Message.text, Message.sender_id,
+                                     Message.receiver_id).all(),
+        }
+        print(f'{"data":8} {"marshal s":>10} {"compiled s":>11} {"speedup":>8}')
+        for name, data in loaded.items():
+            envelope = {'user_id': 1, 'chat_id': 1, 'data': data, 'next': None, 'has_more': False}
+            if json.dumps(serializer(envelope)) != json.dumps(marshal(envelope, messages_list_fields)):
+                raise AssertionError(f'The json of {name} differs')
+            marshal_time = measure(lambda: marshal(envelope, messages_list_fields), args.repeat)
+            compiled_time = measure(lambda: serializer(envelope), args.repeat)
+            print(f'{name:8} {marshal_time:10.3f} {compiled_time:11.3f} {marshal_time / compiled_time:7.1f}x')
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,13 @@
+import os
+
 bind = "0.0.0.0:8000"
 worker_class = 'eventlet'
 wsgi_app = 'app:make_app()'
+# More than one worker requires SOCKETIO_MESSAGE_QUEUE, otherwise users on different workers do not see each other
+workers = int(os.getenv('GUNICORN_WORKERS') or 1)
+
+
+def worker_exit(server, worker):
+    """Saves messages which are still waiting in the write-behind queue of the stopping worker"""
+    from app.chats.writer import message_writer
+    message_writer.stop()
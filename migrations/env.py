@@ -6,6 +6,7 @@ from logging.config import fileConfig
 from flask import current_app
 
 from alembic import context
+from sqlalchemy import text
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -73,6 +74,10 @@ def run_migrations_online():
     connectable = current_app.extensions['migrate'].db.engine
 
     with connectable.connect() as connection:
+        # DB_STATEMENT_TIMEOUT is meant for requests, migrations, e.g. building indexes, may run much longer
+        timeout_disabled = connection.dialect.name == 'postgresql'
+        if timeout_disabled:
+            connection.exec_driver_sql('SET statement_timeout = 0')
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
@@ -80,8 +85,13 @@ def run_migrations_online():
             **current_app.extensions['migrate'].configure_args
         )
 
-        with context.begin_transaction():
-            context.run_migrations()
+        try:
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            if timeout_disabled:
+                # the connection goes back to the pool with the configured timeout
+                connection.execute(text('RESET statement_timeout').execution_options(autocommit=True))
 
 
 if context.is_offline_mode():
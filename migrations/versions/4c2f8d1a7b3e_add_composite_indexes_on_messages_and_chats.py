@@ -0,0 +1,60 @@
+"""Add composite indexes on messages and chats
+
+Revision ID: 4c2f8d1a7b3e
+Revises: ac141622b2da
+Create Date: 2026-10-18 10:12:31.402518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c2f8d1a7b3e'
+down_revision = 'ac141622b2da'
+branch_labels = None
+depends_on = None
+
+
+# The indexes are built concurrently, so the messages table is not locked against writes while they are being built.
+# CREATE INDEX CONCURRENTLY cannot run inside a transaction, so the migration runs in an autocommit block. If it is
+# interrupted, an invalid index may be left, drop it and run the migration again.
+def upgrade():
+    # chats made twice for the same users by concurrent requests would fail the unique index, so every group of them is
+    # merged into the chat with the lowest chat_id: the messages are moved into it and the other chats are deleted
+    op.execute('UPDATE messages SET chat_id = ('
+               'SELECT MIN(kept.chat_id) FROM chats AS kept JOIN chats AS duplicate '
+               'ON kept.user1_id = duplicate.user1_id AND kept.user2_id = duplicate.user2_id '
+               'WHERE duplicate.chat_id = messages.chat_id) '
+               'WHERE chat_id IN ('
+               'SELECT duplicate.chat_id FROM chats AS duplicate JOIN chats AS kept '
+               'ON kept.user1_id = duplicate.user1_id AND kept.user2_id = duplicate.user2_id '
+               'AND kept.chat_id < duplicate.chat_id)')
+    op.execute('DELETE FROM chats WHERE EXISTS ('
+               'SELECT 1 FROM chats AS kept WHERE kept.user1_id = chats.user1_id AND kept.user2_id = chats.user2_id '
+               'AND kept.chat_id < chats.chat_id)')
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_chat_id_datetime_writing_message_id', 'messages',
+                        ['chat_id', sa.text('datetime_writing DESC'), sa.text('message_id DESC')],
+                        unique=False,
+                        postgresql_concurrently=True)
+        op.create_index(op.f('ix_messages_sender_id'), 'messages', ['sender_id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index(op.f('ix_messages_receiver_id'), 'messages', ['receiver_id'], unique=False,
+                        postgresql_concurrently=True)
+        # the unique constraint takes over the index built concurrently instead of building its own one
+        op.create_index('uq_chats_user1_id_user2_id', 'chats', ['user1_id', 'user2_id'], unique=True,
+                        postgresql_concurrently=True)
+        op.execute('ALTER TABLE chats ADD CONSTRAINT uq_chats_user1_id_user2_id UNIQUE USING INDEX '
+                   'uq_chats_user1_id_user2_id')
+        op.create_index(op.f('ix_chats_user2_id'), 'chats', ['user2_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_constraint('uq_chats_user1_id_user2_id', 'chats', type_='unique')
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_chats_user2_id'), table_name='chats', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_messages_receiver_id'), table_name='messages', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_messages_sender_id'), table_name='messages', postgresql_concurrently=True)
+        op.drop_index('ix_messages_chat_id_datetime_writing_message_id', table_name='messages',
+                      postgresql_concurrently=True)
@@ -0,0 +1,42 @@
+"""Add last message into chats table
+
+Revision ID: 9e1b7c3f5a20
+Revises: 4c2f8d1a7b3e
+Create Date: 2026-10-18 11:40:05.117952
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e1b7c3f5a20'
+down_revision = '4c2f8d1a7b3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_at', sa.DateTime(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_preview', sa.String(length=100), nullable=True))
+    op.execute("""
+        UPDATE chats SET last_message_id = last_messages.message_id,
+                         last_message_at = last_messages.datetime_writing,
+                         last_message_preview = left(last_messages.text, 100)
+        FROM (SELECT DISTINCT ON (chat_id) chat_id, message_id, datetime_writing, text FROM messages
+              ORDER BY chat_id, datetime_writing DESC, message_id DESC) AS last_messages
+        WHERE chats.chat_id = last_messages.chat_id
+    """)
+    op.drop_index(op.f('ix_chats_user2_id'), table_name='chats')
+    op.create_index('ix_chats_user1_id_last_message_at', 'chats', ['user1_id', 'last_message_at'], unique=False)
+    op.create_index('ix_chats_user2_id_last_message_at', 'chats', ['user2_id', 'last_message_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_chats_user2_id_last_message_at', table_name='chats')
+    op.drop_index('ix_chats_user1_id_last_message_at', table_name='chats')
+    op.create_index(op.f('ix_chats_user2_id'), 'chats', ['user2_id'], unique=False)
+    op.drop_column('chats', 'last_message_preview')
+    op.drop_column('chats', 'last_message_at')
+    op.drop_column('chats', 'last_message_id')
@@ -0,0 +1,36 @@
+"""Add search indexes on users
+
+Revision ID: b7e4d2a91c60
+Revises: 9e1b7c3f5a20
+Create Date: 2026-10-18 14:05:47.620394
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4d2a91c60'
+down_revision = '9e1b7c3f5a20'
+branch_labels = None
+depends_on = None
+
+
+# The indexes are built concurrently, so the users table is not locked against writes while they are being built. If
+# the migration is interrupted, an invalid index may be left, drop it and run the migration again.
+def upgrade():
+    # trigram indexes serve ILIKE '%string%' of the user search, sqlite does not have them. Exact and prefix ranks are
+    # computed only for the matched users, so they need no indexes of their own
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        with op.get_context().autocommit_block():
+            op.create_index('ix_users_username_trgm', 'users', ['username'], unique=False, postgresql_using='gin',
+                            postgresql_ops={'username': 'gin_trgm_ops'}, postgresql_concurrently=True)
+            op.create_index('ix_users_name_trgm', 'users', ['name'], unique=False, postgresql_using='gin',
+                            postgresql_ops={'name': 'gin_trgm_ops'}, postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index('ix_users_name_trgm', table_name='users', postgresql_concurrently=True)
+            op.drop_index('ix_users_username_trgm', table_name='users', postgresql_concurrently=True)
@@ -0,0 +1,54 @@
+"""Add full-text search of messages
+
+Revision ID: d3f8a6c21e94
+Revises: b7e4d2a91c60
+Create Date: 2026-10-18 20:32:11.408127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f8a6c21e94'
+down_revision = 'b7e4d2a91c60'
+branch_labels = None
+depends_on = None
+
+# messages filled by one transaction of the backfill, every batch holds the row locks only until its commit
+BACKFILL_BATCH_SIZE = 5000
+
+
+# The column is added as nullable without a default, which does not rewrite the table. The trigger fills it for new
+# and edited messages, the existing ones are filled in batches, and the index is built concurrently, so the messages
+# table is not locked against writes. If the migration is interrupted, an invalid index may be left, drop it and run
+# the migration again.
+def upgrade():
+    # sqlite gets messages_fts table from the events of the model (app/chats/models.py), the migrations run on postgres
+    if op.get_bind().dialect.name == 'postgresql':
+        op.add_column('messages', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+        op.execute('CREATE FUNCTION messages_search_vector_update() RETURNS trigger AS $$ BEGIN '
+                   "NEW.search_vector := to_tsvector('simple', NEW.text); RETURN NEW; END $$ LANGUAGE plpgsql")
+        op.execute('CREATE TRIGGER messages_search_vector_update BEFORE INSERT OR UPDATE OF text ON messages '
+                   'FOR EACH ROW EXECUTE PROCEDURE messages_search_vector_update()')
+        with op.get_context().autocommit_block():
+            if op.get_context().as_sql:
+                # the rows affected by a statement are not known while the sql script is being generated
+                op.execute("UPDATE messages SET search_vector = to_tsvector('simple', text) WHERE search_vector IS NULL")
+            else:
+                backfill = sa.text("UPDATE messages SET search_vector = to_tsvector('simple', text) WHERE message_id "
+                                   'IN (SELECT message_id FROM messages WHERE search_vector IS NULL LIMIT :size)')
+                while op.get_bind().execute(backfill, {'size': BACKFILL_BATCH_SIZE}).rowcount == BACKFILL_BATCH_SIZE:
+                    pass
+            op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False,
+                            postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index('ix_messages_search_vector', table_name='messages', postgresql_concurrently=True)
+        op.execute('DROP TRIGGER messages_search_vector_update ON messages')
+        op.execute('DROP FUNCTION messages_search_vector_update()')
+        op.drop_column('messages', 'search_vector')
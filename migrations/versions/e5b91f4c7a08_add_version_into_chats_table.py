@@ -0,0 +1,24 @@
+"""Add version into chats table
+
+Revision ID: e5b91f4c7a08
+Revises: d3f8a6c21e94
+Create Date: 2026-10-18 21:04:52.117386
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b91f4c7a08'
+down_revision = 'd3f8a6c21e94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chats', sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('chats', 'version')
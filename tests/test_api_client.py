@@ -1,16 +1,27 @@
 import base64
+import json
 import re
+import threading
 import time
 import unittest
+from unittest import mock
 
-from flask import current_app
+from flask import current_app, g
+from sqlalchemy import event, inspect
+from werkzeug.security import check_password_hash, generate_password_hash
 
 from app import db
 from app import mail
 from app import make_app
 from app.authentication.models import User, chats
+from app.api.events import ChatEvents, event_stream_response
+from app.api.resources.messages import message_serializer
+from app.authentication.tokens import revoked_tokens
+from app.cache import chat_cache, credentials_cache, user_cache
+from app.chats.events import emit_to_chat
 from app.chats.models import Message
 from app.config import TestConfig
+from app.message_queue import event_tap
 
 
 class ApiClientTestCase(unittest.TestCase):
@@ -30,8 +41,7 @@ class ApiClientTestCase(unittest.TestCase):
         self.bearer_auth_header = {'Authorization': f'Bearer {token}'}
 
     def setUp(self) -> None:
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         self.app = make_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
@@ -39,8 +49,8 @@ class ApiClientTestCase(unittest.TestCase):
         db.create_all()
 
     def tearDown(self) -> None:
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
+        revoked_tokens.clear()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
@@ -116,6 +126,41 @@ class ApiClientTestCase(unittest.TestCase):
         self.assertEqual(response_without_auth.json['message'],
                          'To access use Basic (base64) or Bearer (jwt) http authorization')
 
+    def test_basic_credentials_cache(self):
+        self.init_main_user()
+        basic_username = {'Authorization': f'Basic {base64.b64encode(b"main_username:12345678").decode()}'}
+        with mock.patch('app.authentication.models.check_password_hash', wraps=check_password_hash) as check:
+            credentials_cache.clear()
+            self.assertEqual(self.test_client.get('/api/chats', headers=self.basic_auth_header).status_code, 200)
+            self.assertEqual(self.test_client.get('/api/chats', headers=self.basic_auth_header).status_code, 200)
+            self.assertEqual(self.test_client.get('/api/chats', headers=basic_username).status_code, 200)
+            self.assertEqual(self.test_client.get('/api/chats', headers=basic_username).status_code, 200)
+            self.assertEqual(check.call_count, 2)
+
+            # the username is changed, so the old one does not work even with the cached password
+            response = self.test_client.post('/api/update', json={'username': 'new_username'},
+                                             headers=self.basic_auth_header)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(self.test_client.get('/api/chats', headers=basic_username).status_code, 401)
+
+            # the password is changed, so the cached credentials are not valid anymore
+            user = User.get_user_by_id(1)
+            user.set_password('87654321')
+            db.session.commit()
+            self.assertEqual(self.test_client.get('/api/chats', headers=self.basic_auth_header).status_code, 401)
+            basic_new_password = {
+                'Authorization': f'Basic {base64.b64encode(b"main@gmail.com:87654321").decode()}'}
+            check.reset_mock()
+            self.assertEqual(self.test_client.get('/api/chats', headers=basic_new_password).status_code, 200)
+            self.assertEqual(self.test_client.get('/api/chats', headers=basic_new_password).status_code, 200)
+            self.assertEqual(check.call_count, 1)
+
+            # the password is changed by another worker, whose invalidations never come here
+            db.session.execute(User.__table__.update().where(User.user_id == 1).values(
+                password_hash=generate_password_hash('12121212')))
+            db.session.commit()
+            self.assertEqual(self.test_client.get('/api/chats', headers=basic_new_password).status_code, 401)
+
     def test_token(self):
         self.test_client.post('/api/register', json={'email': 'test@gmail.com', 'username': 'test_username',
                                                      'name': 'test_name', 'password': '12345678'})
@@ -128,6 +173,36 @@ class ApiClientTestCase(unittest.TestCase):
         response = self.test_client.get('/api/token', headers={'Authorization': f'Bearer {data["token"]}'})
         self.assertEqual(response.status_code, 200)
 
+    def test_token_revoke(self):
+        self.init_main_user()
+        response = self.test_client.delete('/api/token', headers=self.basic_auth_header)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'], 'Only a bearer token can be revoked')
+        other_token = self.test_client.get('/api/token', headers=self.basic_auth_header).json['token']
+        response = self.test_client.delete('/api/token', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(revoked_tokens), 1)
+        response = self.test_client.get('/api/chats', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json['message'], 'Authentication token has been revoked')
+        # other tokens of the user are still valid
+        response = self.test_client.get('/api/chats', headers={'Authorization': f'Bearer {other_token}'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_user_is_not_loaded(self):
+        self.init_main_user()
+        user_cache.clear()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', before_cursor_execute)
+        response = self.test_client.get('/api/chats', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([statement for statement in statements if 'FROM users' in statement])
+
     def test_forgot_reset_password(self):
         self.init_main_user()
         user = User.get_user_by_id(1)
@@ -228,6 +303,22 @@ class ApiClientTestCase(unittest.TestCase):
             self.assertEqual(user['username'], f'username{i + 1}')
             self.assertEqual(user['name'], f'name{i + 1}')
             self.assertFalse(user.get('date_joined') is None)
+        self.assertFalse(data['has_more'])
+        self.assertIsNone(data['next'])
+
+        response = self.test_client.get('/api/users?limit=4', headers=self.basic_auth_header)
+        self.assertTrue(response.json['has_more'])
+        response = self.test_client.get(f"/api/users?limit=4&cursor={response.json['next']}",
+                                        headers=self.basic_auth_header)
+        self.assertEqual([user['user_id'] for user in response.json['data']], [5, 6])
+        self.assertFalse(response.json['has_more'])
+
+        response = self.test_client.get('/api/users?limit=many', headers=self.basic_auth_header)
+        self.assertEqual(response.status_code, 400)
+        response = self.test_client.get('/api/users?ordered-by=name', headers=self.basic_auth_header)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'],
+                         'Results can be ordered only by the indexed columns: user_id, username')
 
     def test_user_single(self):
         self.register_users(2)
@@ -339,6 +430,281 @@ class ApiClientTestCase(unittest.TestCase):
         self.assertEqual(len(messages), 2)
         self.assertTrue(messages[0]['text'] == 'bla5' and messages[1]['text'] == 'bla6')
 
+    def test_chat_messages_list_stream(self):
+        self.init_main_user()
+        self.register_users(1)
+        User.create_chat(1, 2)
+        Message.create_many(1, 1, 2, [f'text{i}' for i in range(5)])
+        db.session.commit()
+        self.app.config['API_STREAM_CHUNK_SIZE'] = 2
+
+        for params in ('', '?limit=3', '?ordered-by-desc=message_id&limit=10'):
+            page = self.test_client.get(f'/api/chats/1/messages{params}', headers=self.bearer_auth_header)
+            separator = '&' if params else '?'
+            streamed = self.test_client.get(f'/api/chats/1/messages{params}{separator}stream=true',
+                                            headers=self.bearer_auth_header)
+            self.assertTrue(streamed.is_streamed)
+            # the same bytes as the page
+            self.assertEqual(streamed.data, page.data)
+
+        # all the messages are streamed without limit
+        self.app.config['API_PAGE_SIZE'] = 2
+        response = self.test_client.get('/api/chats/1/messages?stream=1', headers=self.bearer_auth_header)
+        self.assertEqual([message['text'] for message in response.json['data']], [f'text{i}' for i in range(5)])
+        self.assertFalse(response.json['has_more'])
+
+        headers = dict(self.bearer_auth_header, Accept='application/x-ndjson')
+        response = self.test_client.get('/api/chats/1/messages?ordered-by-desc=message_id', headers=headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode().splitlines()
+        self.assertEqual([json.loads(line)['message_id'] for line in lines], [5, 4, 3, 2, 1])
+
+        response = self.test_client.get('/api/users?stream=true', headers=self.bearer_auth_header)
+        self.assertEqual([user['user_id'] for user in response.json['data']], [1, 2])
+        self.assertEqual(response.json['user_id'], 1)
+
+    def test_messages_search(self):
+        self.init_main_user()
+        self.register_users(2)
+        User.create_chat(1, 2)
+        User.create_chat(1, 3)
+        User.create_chat(2, 3)
+        Message.create_many(1, 1, 2, ['Where is the report?', 'The report is ready', 'ok'])
+        Message.create_many(2, 3, 1, ['Send me the report, please'])
+        Message.create_many(3, 2, 3, ['A report of others'])
+        db.session.commit()
+
+        response = self.test_client.get('/api/chats/1/messages/search?q=report', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 200)
+        data = response.json
+        self.assertEqual((data['user_id'], data['chat_id'], data['q'], data['has_more']), (1, 1, 'report', False))
+        self.assertEqual([message['message_id'] for message in data['data']], [2, 1])
+        self.assertEqual(data['data'][0]['highlight'], 'The <mark>report</mark> is ready')
+        self.assertEqual(data['data'][0]['text'], 'The report is ready')
+
+        # messages of all the chats of the user, page by page
+        found = []
+        cursor = ''
+        while True:
+            response = self.test_client.get(f'/api/messages/search?q=REPORT&limit=1{cursor}',
+                                            headers=self.basic_auth_header)
+            self.assertEqual(response.status_code, 200)
+            found.extend(message['message_id'] for message in response.json['data'])
+            if not response.json['has_more']:
+                break
+            cursor = f"&cursor={response.json['next']}"
+        self.assertEqual(sorted(found), [1, 2, 4])
+        self.assertEqual(len(found), 3)
+        self.assertIsNone(response.json['next'])
+
+        response = self.test_client.get('/api/chats/3/messages/search?q=report', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 403)
+        for params in ('', '?q=%20', '?q=report&limit=0', '?q=report&cursor=broken'):
+            response = self.test_client.get(f'/api/messages/search{params}', headers=self.bearer_auth_header)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_conditional_get(self):
+        self.init_main_user()
+        self.register_users(2)
+        User.create_chat(1, 2)
+        Message.create_many(1, 1, 2, ['first', 'second'])
+        db.session.commit()
+
+        def get(url: str, etag: str = None):
+            headers = dict(self.bearer_auth_header, **({'If-None-Match': etag} if etag else {}))
+            return self.test_client.get(url, headers=headers)
+
+        for url in ('/api/chats', '/api/chats/1/messages', '/api/chats/1/messages?limit=1',
+                    '/api/chats/1/messages?stream=true', '/api/chats/1/messages/1'):
+            response = get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            self.assertTrue(etag.startswith('W/"'), url)
+            response = get(url, etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+        # other params, another user and another chat have other tags
+        etag = get('/api/chats/1/messages').headers['ETag']
+        self.assertEqual(get('/api/chats/1/messages?limit=1', etag).status_code, 200)
+        self.assertNotEqual(get('/api/chats/1/messages/2').headers['ETag'],
+                            get('/api/chats/1/messages/1').headers['ETag'])
+        response = self.test_client.get('/api/chats/1/messages', headers={
+            'Authorization': f'Basic {base64.b64encode(b"user1@gmail.com:12345678").decode()}', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # the messages are not queried, if the client has the current version
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        self.assertEqual(get('/api/chats/1/messages', etag).status_code, 304)
+        self.assertFalse([statement for statement in statements if 'FROM messages' in statement])
+
+        # sent, edited and deleted messages change the version of the chat
+        chats_etag = get('/api/chats').headers['ETag']
+        message_etag = get('/api/chats/1/messages/1').headers['ETag']
+        self.test_client.post('/api/chats/1/messages', json={'texts': ['third']}, headers=self.bearer_auth_header)
+        response = get('/api/chats/1/messages', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['data']), 3)
+        self.assertEqual(get('/api/chats/1/messages/1', message_etag).status_code, 200)
+        etag = response.headers['ETag']
+        self.test_client.put('/api/chats/1/messages/1', json={'text': 'edited'}, headers=self.bearer_auth_header)
+        response = get('/api/chats/1/messages', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data'][0]['text'], 'edited')
+        etag = response.headers['ETag']
+        self.test_client.delete('/api/chats/1/messages/2', headers=self.bearer_auth_header)
+        response = get('/api/chats/1/messages', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['data']), 2)
+        # the list of chats is the same
+        self.assertEqual(get('/api/chats', chats_etag).status_code, 304)
+        self.test_client.post('/api/chats', json={'companion_id': 3}, headers=self.bearer_auth_header)
+        self.assertEqual(get('/api/chats', chats_etag).status_code, 200)
+
+    def test_chat_messages_events_long_poll(self):
+        self.init_main_user()
+        self.register_users(2)
+        User.create_chat(1, 2)
+        User.create_chat(2, 3)
+        Message.create_many(1, 1, 2, ['first', 'second'])
+        db.session.commit()
+        self.app.config['API_LONG_POLL_TIMEOUT'] = 0
+
+        # the messages after 'since' are returned at once
+        response = self.test_client.get('/api/chats/1/events?since=1', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['user_id'], response.json['chat_id'], response.json['since']), (1, 1, 2))
+        self.assertEqual([(event['event'], event['data']['text']) for event in response.json['events']],
+                         [('print_message', 'second')])
+        # by default only new messages are returned
+        response = self.test_client.get('/api/chats/1/events', headers=self.bearer_auth_header)
+        self.assertEqual((response.json['since'], response.json['events']), (2, []))
+
+        # a request waits for the events of the chat
+        self.app.config['API_LONG_POLL_TIMEOUT'] = 10
+
+        def change_messages():
+            while not event_tap.listeners:
+                time.sleep(0.01)
+            with self.app.app_context():
+                client = self.app.test_client()
+                client.put('/api/chats/1/messages/1', json={'text': 'edited'}, headers=self.bearer_auth_header)
+                client.post('/api/chats/1/messages', json={'texts': ['third']}, headers=self.bearer_auth_header)
+
+        thread = threading.Thread(target=change_messages)
+        thread.start()
+        start = time.monotonic()
+        response = self.test_client.get('/api/chats/1/events?since=2', headers=self.bearer_auth_header)
+        thread.join()
+        self.assertLess(time.monotonic() - start, 5)
+        events = response.json['events']
+        self.assertEqual(events[0], {'event': 'edit_message', 'data': {'message_id': 1, 'text': 'edited'}})
+        if len(events) == 1:
+            # the post came after the response
+            events = self.test_client.get(f"/api/chats/1/events?since={response.json['since']}",
+                                          headers=self.bearer_auth_header).json['events']
+        else:
+            events = events[1:]
+        self.assertEqual([(event['event'], event['data']['message_id'], event['data']['text']) for event in events],
+                         [('print_message', 3, 'third')])
+        self.assertEqual(event_tap.stats()['listeners'], 0)
+
+        self.assertEqual(self.test_client.get('/api/chats/2/events', headers=self.bearer_auth_header).status_code, 403)
+        response = self.test_client.get('/api/chats/1/events?since=last', headers=self.bearer_auth_header)
+        self.assertEqual(response.status_code, 400)
+
+    def test_chat_events_listener(self):
+        self.init_main_user()
+        self.register_users(1)
+        User.create_chat(1, 2)
+        Message.create_many(1, 1, 2, ['first'])
+        db.session.commit()
+        with self.app.test_request_context():
+            g.user = User.get_user_by_id(1)
+            chat = db.session.query(chats).filter(chats.c.chat_id == 1).first()
+            chat_events = ChatEvents(chat, 0, message_serializer, 1)
+            try:
+                self.assertEqual([name for name, _ in chat_events.wait(0)], ['print_message'])
+                # the messages are read by their own connection, the user of the request stays in the session
+                self.assertFalse(inspect(g.user).detached)
+                # the room does not depend on usernames, so a renamed user is still heard
+                g.user.username = 'renamed_username'
+                db.session.commit()
+                emit_to_chat(chat, 'edit_message', {'message_id': 1, 'text': 'edited'})
+                self.assertEqual(chat_events.wait(1), [('edit_message', {'message_id': 1, 'text': 'edited'})])
+            finally:
+                chat_events.close()
+
+    def test_chat_messages_events_stream(self):
+        self.init_main_user()
+        self.register_users(1)
+        User.create_chat(1, 2)
+        Message.create_many(1, 1, 2, ['first', 'second'])
+        db.session.commit()
+        self.app.config['API_EVENTS_KEEPALIVE'] = 0.1
+
+        headers = dict(self.bearer_auth_header, Accept='text/event-stream', **{'Last-Event-ID': '1'})
+        response = self.test_client.get('/api/chats/1/events', headers=headers, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        event = next(chunks).decode()
+        self.assertTrue(event.startswith('id: 2\nevent: print_message\ndata: '))
+        self.assertEqual(json.loads(event.splitlines()[2][len('data: '):])['text'], 'second')
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+
+        self.test_client.delete('/api/chats/1/messages/2', headers=self.bearer_auth_header)
+        self.test_client.post('/api/chats/1/messages', json={'texts': ['third']}, headers=self.bearer_auth_header)
+        received = [next(chunks).decode() for _ in range(2)]
+        self.assertTrue(received[0].startswith('event: delete_message\ndata: '))
+        self.assertEqual(json.loads(received[0].splitlines()[1][len('data: '):]), {'message_id': 2})
+        self.assertTrue(received[1].startswith('id: 3\nevent: print_message\n'))
+        response.close()
+        self.assertEqual(event_tap.stats()['listeners'], 0)
+
+    def test_chat_messages_events_stream_ends_without_authorization(self):
+        self.init_main_user()
+        self.register_users(1)
+        User.create_chat(1, 2)
+        db.session.commit()
+        self.app.config['API_EVENTS_KEEPALIVE'] = 0.1
+
+        # the token is revoked while the stream is open
+        headers = dict(self.bearer_auth_header, Accept='text/event-stream')
+        response = self.test_client.get('/api/chats/1/events', headers=headers, buffered=False)
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        self.assertEqual(self.test_client.delete('/api/token', headers=self.bearer_auth_header).status_code, 200)
+        self.assertEqual(list(chunks), [])
+        self.assertEqual(event_tap.stats()['listeners'], 0)
+
+        # the chat is deleted while the stream is open
+        headers = dict(self.basic_auth_header, Accept='text/event-stream')
+        response = self.test_client.get('/api/chats/1/events', headers=headers, buffered=False)
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        self.assertEqual(self.test_client.delete('/api/chats/1', headers=self.basic_auth_header).status_code, 200)
+        self.assertEqual(list(chunks), [])
+        self.assertEqual(event_tap.stats()['listeners'], 0)
+
+        # the stream ends when the token expires, before the next keepalive
+        User.create_chat(1, 2)
+        db.session.commit()
+        self.app.config['API_EVENTS_KEEPALIVE'] = 10
+        with self.app.test_request_context():
+            chat = db.session.query(chats).first()
+            chat_events = ChatEvents(chat, 0, message_serializer, 1, {'jti': 'a', 'exp': time.time() + 0.2})
+            response = event_stream_response(chat_events)
+            start = time.monotonic()
+            self.assertEqual(list(response.response), [])
+            self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(event_tap.stats()['listeners'], 0)
+
     def test_chat_messages_list_post(self):
         self.init_main_user()
         self.register_users(1)
@@ -365,6 +731,49 @@ class ApiClientTestCase(unittest.TestCase):
         self.assertTrue(
             new_messages[0].text == 'second' and new_messages[1].text == 'third' and new_messages[2].text == 'fourth')
 
+    def test_chat_updated_events(self):
+        self.init_main_user()
+        self.register_users(1)
+        User.create_chat(1, 2)
+        db.session.commit()
+        listeners = [event_tap.listen('/chats/list', f'user:{user_id}') for user_id in (1, 2)]
+
+        def get_updates() -> list:
+            updates = []
+            for listener in listeners:
+                while not listener.empty():
+                    name, data = listener.get_nowait()
+                    self.assertEqual(name, 'chat_updated')
+                    updates.append(data)
+            return updates
+
+        try:
+            self.test_client.post('/api/chats/1/messages', json={'texts': ['first', 'second']},
+                                  headers=self.bearer_auth_header)
+            updates = get_updates()
+            self.assertEqual(len(updates), 2)
+            self.assertEqual([update['companion_username'] for update in updates], ['username1', 'main_username'])
+            self.assertTrue(all(update['chat_id'] == 1 and update['preview'] == 'second' for update in updates))
+            self.assertIsNotNone(updates[0]['timestamp_milliseconds'])
+
+            # only the changes of the last message change the lists
+            self.test_client.put('/api/chats/1/messages/1', json={'text': 'first edited'},
+                                 headers=self.bearer_auth_header)
+            self.assertEqual(get_updates(), [])
+            self.test_client.put('/api/chats/1/messages/2', json={'text': 'edited'}, headers=self.bearer_auth_header)
+            self.assertEqual([update['preview'] for update in get_updates()], ['edited'] * 2)
+            self.test_client.delete('/api/chats/1/messages/2', headers=self.bearer_auth_header)
+            self.assertEqual([update['preview'] for update in get_updates()], ['first edited'] * 2)
+
+            self.test_client.delete('/api/chats/1', headers=self.bearer_auth_header)
+            updates = get_updates()
+            self.assertEqual(len(updates), 2)
+            self.assertTrue(all(update['preview'] is None and update['timestamp_milliseconds'] is None
+                                for update in updates))
+        finally:
+            for user_id, listener in zip((1, 2), listeners):
+                event_tap.stop_listening('/chats/list', f'user:{user_id}', listener)
+
     def test_chat_message_single(self):
         self.init_main_user()
         self.register_users(1)
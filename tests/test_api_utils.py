@@ -1,15 +1,16 @@
 import unittest
 from typing import List
 
-from werkzeug.exceptions import NotFound, Forbidden
+from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 
 from app import db
 from app import make_app
 from app.api.utils import abort_if_not_own, abort_if_not_a_participant, abort_if_not_from_a_chat
-from app.api.utils import longer_than_zero
+from app.api.utils import get_orderable_columns, longer_than_zero, paginate_by_get_params
 from app.api.utils import model_filter_by_get_params as mod_fil
 from app.api.utils import return_chat_or_abort, return_user_or_abort, return_message_or_abort
 from app.authentication.models import User
+from app.cache import chat_cache
 from app.chats.models import Message
 from app.config import TestConfig
 from tests.test_user_model import init_users
@@ -19,8 +20,7 @@ class ApiUtilsTestCase(unittest.TestCase):
     """Tests utils from api blueprint"""
 
     def setUp(self) -> None:
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         self.app = make_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
@@ -31,8 +31,7 @@ class ApiUtilsTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
 
     def test_return_chat_or_abort(self):
         users = init_users(2)
@@ -127,9 +126,12 @@ class ApiUtilsTestCase(unittest.TestCase):
         self.assertEqual(mod_fil(User, users_simple_query, {'username-like': 'user1'}).all(), users[0:1])
 
         # 'ordered-by' and 'ordered-by-desc' stmts:
-        self.assertEqual(mod_fil(User, users_simple_query, {'ordered-by': 'date_joined'}).all(), users)
-        self.assertEqual(mod_fil(User, users_simple_query, {'ordered-by-desc': 'date_joined'}).all(),
+        self.assertEqual(mod_fil(User, users_simple_query, {'ordered-by': 'user_id'}).all(), users)
+        self.assertEqual(mod_fil(User, users_simple_query, {'ordered-by-desc': 'user_id'}).all(),
                          list(reversed(users)))
+        # there is no index on date_joined
+        with self.assertRaises(BadRequest):
+            mod_fil(User, users_simple_query, {'ordered-by': 'date_joined'})
         self.assertEqual(mod_fil(User, users_simple_query, {'ordered-by-desc': 'username'}).all(),
                          list(reversed(users)))
 
@@ -141,7 +143,7 @@ class ApiUtilsTestCase(unittest.TestCase):
 
         # some queries combinations:
         self.assertEqual(
-            mod_fil(User, users_simple_query, {'ordered-by-desc': 'date_joined', 'offset': 1, 'limit': 2}).all(),
+            mod_fil(User, users_simple_query, {'ordered-by-desc': 'user_id', 'offset': 1, 'limit': 2}).all(),
             list(reversed(users))[1:3])
         self.assertEqual(
             mod_fil(User, users_simple_query, {'ordered-by-desc': 'username', 'offset': 4}).all(),
@@ -156,8 +158,48 @@ class ApiUtilsTestCase(unittest.TestCase):
         # invalid values:
         self.assertEqual(mod_fil(User, users_simple_query, {'invalid': 'value'}).all(), users)
         self.assertEqual(
-            mod_fil(User, users_simple_query, {'invalid': 'value', 'ordered-by-desc': 'date_joined'}).all(),
+            mod_fil(User, users_simple_query, {'invalid': 'value', 'ordered-by-desc': 'user_id'}).all(),
             list(reversed(users)))
+        for args in ({'limit': 'ten'}, {'limit': 0}, {'offset': -1}):
+            with self.assertRaises(BadRequest):
+                mod_fil(User, users_simple_query, args)
+
+        # default and maximum page sizes:
+        self.app.config['API_PAGE_SIZE'] = 2
+        self.app.config['API_MAX_PAGE_SIZE'] = 3
+        self.assertEqual(mod_fil(User, users_simple_query, {}).all(), users[:2])
+        self.assertEqual(mod_fil(User, users_simple_query, {'limit': 100}).all(), users[:3])
+
+    def test_paginate_by_get_params(self):
+        users = init_users(5)
+        users[3].name = users[4].name = 'name3'
+        db.session.add_all(users)
+        db.session.commit()
+        query = db.session.query(User.user_id, User.name)
+        self.assertEqual(get_orderable_columns(User, query), ['user_id'])
+        self.assertEqual(get_orderable_columns(User, User.query), ['email', 'user_id', 'username'])
+
+        found = []
+        args = {'ordered-by-desc': 'username', 'limit': 2}
+        while True:
+            page = paginate_by_get_params(User, User.query, args)
+            found.extend(user.user_id for user in page['data'])
+            if not page['has_more']:
+                self.assertIsNone(page['next'])
+                break
+            args['cursor'] = page['next']
+        self.assertEqual(found, [5, 4, 3, 2, 1])
+
+        page = paginate_by_get_params(User, query, {'name': 'name3', 'limit': 1})
+        self.assertEqual([row.user_id for row in page['data']], [3])
+        page = paginate_by_get_params(User, query, {'name': 'name3', 'limit': 1, 'cursor': page['next']})
+        self.assertEqual([row.user_id for row in page['data']], [4])
+        self.assertTrue(page['has_more'])
+        # a cursor is valid only for the ordering it was made with
+        with self.assertRaises(BadRequest):
+            paginate_by_get_params(User, User.query, {'ordered-by': 'username', 'cursor': page['next']})
+        with self.assertRaises(BadRequest):
+            paginate_by_get_params(User, User.query, {'cursor': 'broken'})
 
     def test_longer_than_zero(self):
         with self.assertRaises(ValueError):
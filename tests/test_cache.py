@@ -0,0 +1,196 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from app import db
+from app import make_app
+from app.authentication.models import User, chats
+from app.cache import BrokerCache, LocalCache, apply_invalidation, chat_cache, make_cache_backend, \
+    set_invalidation_publisher
+from app.chats.exceptions import ChatAlreadyExistsError
+from app.config import TestConfig
+from app.message_queue import LocalBroker
+from tests.test_user_model import init_users
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    """Tests the process local LRU cache"""
+
+    def test_lru(self):
+        cache = LocalCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        cache.delete('a', 'unknown')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.evictions, 1)
+        cache.reset_stats()
+        self.assertEqual(cache.evictions, 0)
+
+    def test_ttl(self):
+        cache = LocalCache(ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=10)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_make_cache_backend(self):
+        self.assertIsInstance(make_cache_backend(None), LocalCache)
+        self.assertIsInstance(make_cache_backend('unix:///tmp/broker.sock'), BrokerCache)
+        with self.assertRaises(ValueError):
+            make_cache_backend('memcached://localhost')
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    """Tests the cache which is shared between processes through the local broker"""
+
+    def setUp(self) -> None:
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        self.broker = LocalBroker(self.socket_path)
+        threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+        config = type('SharedCacheTestConfig', (TestConfig,), {'CHAT_CACHE_URL': f'unix://{self.socket_path}'})
+        self.app = make_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        # the cache of another worker process
+        self.other_cache = BrokerCache(f'unix://{self.socket_path}', prefix='chat_cache:')
+
+    def tearDown(self) -> None:
+        chat_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.broker.shutdown()
+        self.broker.server_close()
+
+    def test_shared_values(self):
+        chat_cache.set('key', {'value': [1, 2]})
+        self.assertEqual(self.other_cache.get('key'), {'value': [1, 2]})
+        chat_cache.set('short', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.other_cache.get('short'))
+        self.other_cache.delete('key')
+        self.assertIsNone(chat_cache.get('key'))
+        chat_cache.set('key', 1)
+        self.broker.store.set(b'another:key', b'1')
+        chat_cache.clear()
+        self.assertIsNone(self.other_cache.get('key'))
+        self.assertEqual(self.broker.store.get(b'another:key'), b'1')
+
+    def test_invalidation_between_workers(self):
+        db.session.add_all(init_users(2))
+        db.session.commit()
+        self.assertFalse(User.is_chat_between(1, 2))
+        self.assertEqual(self.other_cache.get('1:2'), 0)
+        User.create_chat(1, 2)
+        db.session.commit()
+        self.assertIsNone(self.other_cache.get('1:2'))
+        self.assertEqual(User.get_chat_id_by_users_ids(2, 1), 1)
+        self.assertEqual(self.other_cache.get('1:2'), 1)
+        User.delete_chat(chat_id=1)
+        db.session.commit()
+        self.assertIsNone(self.other_cache.get('1:2'))
+
+    def test_invalidation_after_rollback(self):
+        db.session.add_all(init_users(2))
+        db.session.commit()
+        User.create_chat(1, 2)
+        # the chat is seen inside the transaction and cached
+        self.assertTrue(User.is_chat_between(1, 2))
+        db.session.rollback()
+        self.assertFalse(User.is_chat_between(1, 2))
+
+    def test_stats(self):
+        chat_cache.get('key')
+        chat_cache.set('key', 1)
+        chat_cache.get('key')
+        chat_cache.get('key')
+        self.assertEqual(chat_cache.stats(), {'backend': 'local-broker', 'hits': 2, 'misses': 1, 'hit_rate': 0.6667,
+                                              'size': None, 'evictions': None, 'expirations': None})
+
+    def test_broker_is_not_available(self):
+        self.broker.shutdown()
+        self.broker.server_close()
+        db.session.add_all(init_users(2))
+        db.session.commit()
+        User.create_chat(1, 2)
+        db.session.commit()
+        self.assertTrue(User.is_chat_between(1, 2))
+        # create_chat relies on the unique constraint, so only is_chat_between reads the cache
+        self.assertEqual(chat_cache.stats()['misses'], 1)
+
+
+class LocalCacheInvalidationTestCase(unittest.TestCase):
+    """Tests sending the invalidations of process local caches to other workers"""
+
+    def setUp(self) -> None:
+        self.app = make_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add_all(init_users(2))
+        db.session.commit()
+        self.published = []
+        set_invalidation_publisher(lambda cache_name, keys: self.published.append((cache_name, keys)))
+
+    def tearDown(self) -> None:
+        set_invalidation_publisher(None)
+        chat_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_invalidation_is_published_after_commit(self):
+        User.create_chat(1, 2)
+        self.assertEqual(self.published, [])
+        db.session.commit()
+        self.assertEqual(self.published, [('CHAT_CACHE', ['1:2'])])
+        User.delete_chat(chat_id=1)
+        db.session.rollback()
+        self.assertEqual(len(self.published), 1)
+
+    def test_apply_invalidation(self):
+        chat_cache.set('1:2', 1)
+        chat_cache.set('3:4', 2)
+        apply_invalidation('CHAT_CACHE', ['1:2'])
+        self.assertIsNone(chat_cache.get('1:2'))
+        self.assertEqual(chat_cache.get('3:4'), 2)
+        apply_invalidation('UNKNOWN_CACHE', ['3:4'])
+        apply_invalidation('CHAT_CACHE', None)
+        self.assertIsNone(chat_cache.get('3:4'))
+
+    def test_invalidate_all_keeps_stats(self):
+        chat_cache.set('1:2', 1)
+        chat_cache.get('1:2')
+        chat_cache.backend.evictions = 2
+        chat_cache.invalidate_all(db.session)
+        db.session.commit()
+        self.assertEqual(len(chat_cache.backend), 0)
+        self.assertEqual((chat_cache.stats()['hits'], chat_cache.stats()['evictions']), (1, 2))
+        chat_cache.clear()
+        self.assertEqual((chat_cache.stats()['hits'], chat_cache.stats()['evictions']), (0, 0))
+
+    def test_create_chat_with_stale_cache(self):
+        self.assertFalse(User.is_chat_between(1, 2))
+        # another worker makes the chat, but its invalidation has not come yet
+        db.session.execute(chats.insert().values(user1_id=1, user2_id=2))
+        db.session.commit()
+        self.assertFalse(User.is_chat_between(1, 2))
+        with self.assertRaises(ChatAlreadyExistsError):
+            User.create_chat(2, 1)
+        self.assertTrue(User.is_chat_between(1, 2))
+        self.assertEqual(User.get_chat_id_by_users_ids(1, 2), 1)
@@ -4,15 +4,18 @@ import unittest
 
 from flask import get_flashed_messages
 from flask import session
+from sqlalchemy import event
 from sqlalchemy.sql import exists
 
 from app import db
 from app import mail
 from app import make_app
 from app.authentication.models import User
+from app.cache import user_cache
 from app.chats.models import Message
-from app.chats.utils import get_users_unique_room_name
+from app.chats.utils import get_chat_room_name
 from app.config import TestConfig
+from app.cursors import encode_cursor
 
 
 class ClientTestCase(unittest.TestCase):
@@ -140,6 +143,54 @@ class ClientTestCase(unittest.TestCase):
         self.assertEqual(response_not_existing_email.status_code, 200)
         self.assertTrue("User with such an e-mail does not exist" in response_not_existing_email.data.decode())
 
+    def test_user_queries_per_request(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', before_cursor_execute)
+        with self.test_client as client:
+            client.post('/authentication/register',
+                        data={'email': 'test@gmail.com', 'username': 'test_user',
+                              'name': 'Ann', 'password1': 'Who am I', 'password2': 'Who am I'})
+            client.post('/authentication/login', data={'email': 'test@gmail.com', 'password': 'Who am I'})
+
+            # without the cached user, the user is queried by each page view
+            user_cache.clear()
+            statements.clear()
+            response = client.get('/')
+            self.assertTrue('Log out' in response.data.decode())
+            self.assertEqual(len(statements), 1)
+            self.assertTrue('FROM users' in statements[0])
+
+            statements.clear()
+            response = client.get('/')
+            self.assertTrue('Log out' in response.data.decode())
+            self.assertEqual(len(statements), 0)
+
+            user_cache.clear()
+            statements.clear()
+            client.get('/static/css/style.css').close()
+            client.get('/api/chats')
+            self.assertEqual(len(statements), 0)
+            # the user is loaded only when the template of the not found page is rendered
+            response = client.get('/not-existing-page')
+            self.assertTrue('Log out' in response.data.decode())
+            self.assertEqual(len(statements), 1)
+
+            user = User.get_cached_user_by_id(session['current_user_id'])
+            self.assertEqual(user.name, 'Ann')
+            self.assertTrue(user.verify_password('Who am I'))
+            user.name = 'Anna'
+            db.session.commit()
+            self.assertIsNone(user_cache.get(user.user_id))
+            self.assertEqual(User.get_cached_user_by_id(user.user_id).name, 'Anna')
+            user.set_password('New password')
+            db.session.commit()
+            self.assertIsNone(user_cache.get(user.user_id))
+
     def test_login_required(self):
         with self.test_client as client:
             response = client.get('/chats/search')
@@ -215,6 +266,9 @@ class ClientTestCase(unittest.TestCase):
             self.assertTrue('test_text' in response_data)
             self.assertTrue('Ann2' in response_data)
             self.assertTrue('test_user2' in response_data)
+            # the list page marks chats to apply chat_updated events to them
+            self.assertIn('data-chat-id="1"', response_data)
+            self.assertIn('js/chats_list.js', response_data)
 
     def test_user_chat_begin_end(self):
         with self.test_client as client:
@@ -232,7 +286,7 @@ class ClientTestCase(unittest.TestCase):
             self.assertEqual(session['current_user_id'], 1)
             response = client.get('/chats/begin/test_user2')
             self.assertEqual(response.status_code, 302)
-            self.assertEqual(session['room_name'], get_users_unique_room_name('test_user1', 'test_user2'))
+            self.assertEqual(session['room_name'], get_chat_room_name(1, 2))
             self.assertEqual(session['user_name'], 'Ann1')
             self.assertEqual(session['companion_id'], 2)
 
@@ -325,3 +379,9 @@ class ClientTestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             json = response.json
             self.assertEqual(json['data'], [])
+
+            response = client.get('/chats/ajax-search?search-string=test&cursor=broken', headers=headers)
+            self.assertEqual(response.status_code, 400)
+            cursor = encode_cursor({'rank': 'x', 'user_id': 1})
+            response = client.get(f'/chats/ajax-search?search-string=test&cursor={cursor}', headers=headers)
+            self.assertEqual(response.status_code, 400)
@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import time
+import unittest
+
+from flask import Flask
+from sqlalchemy import exc, text
+
+from app import db
+from app import make_app
+from app import socket_io
+from app.cache import chat_cache
+from app.config import TestConfig
+from app.database import MonitoredQueuePool, configure_engine_options, is_green_driver_required, pool_monitor
+from tests import test_socketio_events
+
+try:
+    import eventlet
+    import psycopg2
+except ImportError:
+    eventlet = psycopg2 = None
+
+# a scratch postgres database, its tables are dropped
+TEST_POSTGRES_URI = os.getenv('TEST_POSTGRES_URI')
+
+
+class GreenDriverModeTestCase(unittest.TestCase):
+    """Tests the choice of the green driver mode"""
+
+    def make_app(self, uri: str, mode: str) -> Flask:
+        app = Flask(__name__)
+        app.config.update(SQLALCHEMY_DATABASE_URI=uri, DB_GREEN_DRIVER=mode)
+        return app
+
+    def test_is_green_driver_required(self):
+        self.assertFalse(is_green_driver_required(self.make_app('sqlite:///test.sqlite', 'true')))
+        self.assertFalse(is_green_driver_required(self.make_app('postgresql://localhost/chats', 'false')))
+        self.assertTrue(is_green_driver_required(self.make_app('postgresql://localhost/chats', 'true')))
+        # the tests are not monkey patched
+        self.assertFalse(is_green_driver_required(self.make_app('postgresql://localhost/chats', 'auto')))
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+    """Tests the engine options made from the settings"""
+
+    def make_config(self, uri: str, **settings) -> dict:
+        app = Flask(__name__)
+        app.config.from_object(TestConfig)
+        app.config.update(SQLALCHEMY_DATABASE_URI=uri, DB_GREEN_DRIVER='false', **settings)
+        configure_engine_options(app)
+        return app.config
+
+    def test_postgres_options(self):
+        config = self.make_config('postgresql://localhost/chats', DB_POOL_SIZE=7, DB_STATEMENT_TIMEOUT=5000,
+                                  SQLALCHEMY_ENGINE_OPTIONS={'max_overflow': 0})
+        options = config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual(options['pool_size'], 7)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertEqual(options['pool_recycle'], TestConfig.DB_POOL_RECYCLE)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIs(options['poolclass'], MonitoredQueuePool)
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+        # the settings class is not changed
+        self.assertEqual(TestConfig.SQLALCHEMY_ENGINE_OPTIONS, {})
+
+    def test_sqlite_options(self):
+        config = self.make_config('sqlite:///test.sqlite')
+        self.assertEqual(config['SQLALCHEMY_ENGINE_OPTIONS'], {})
+
+
+class PoolMonitorTestCase(unittest.TestCase):
+    """Tests the statistics of connection pools"""
+
+    def setUp(self) -> None:
+        self.app = make_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_checkouts_and_invalidations(self):
+        db.session.execute(text('SELECT 1'))
+        self.assertEqual(pool_monitor.stats()['in_use'], 1)
+        db.session.connection().invalidate()
+        db.session.remove()
+        stats = pool_monitor.stats()
+        self.assertGreaterEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['max_in_use'], 1)
+        self.assertEqual(stats['invalidations'], 1)
+        response = self.app.test_client().get('/stats')
+        self.assertEqual(response.json['database_pool']['invalidations'], 1)
+
+    def test_checkout_wait(self):
+        pool = MonitoredQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.1)
+        connection = pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        connection.close()
+        pool.connect().close()
+        stats = pool_monitor.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_wait_ms'], 100)
+        self.assertEqual(stats['in_use'], 0)
+        pool.dispose()
+
+
+@unittest.skipUnless(eventlet and psycopg2 and TEST_POSTGRES_URI, 'Requires eventlet, psycopg2 and TEST_POSTGRES_URI')
+class GreenDatabaseTestCase(unittest.TestCase):
+    """Runs slow queries concurrently with socket events on postgres"""
+
+    def setUp(self) -> None:
+        self.events_namespace = '/chats/going'
+        config = type('GreenTestConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': TEST_POSTGRES_URI,
+                                                        'DB_GREEN_DRIVER': 'true'})
+        self.app = make_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        chat_cache.clear()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self) -> None:
+        psycopg2.extensions.set_wait_callback(None)
+        chat_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        db.get_engine().dispose()
+        self.app_context.pop()
+
+    def slow_query(self):
+        with self.app.app_context():
+            db.session.execute(text('SELECT pg_sleep(1)'))
+            db.session.remove()
+
+    def test_slow_queries_do_not_block_socket_events(self):
+        with self.app.test_client() as client1, self.app.test_client() as client2:
+            test_socketio_events.SocketIOEventsTestCase.init_two_clients(client1, client2)
+            socket_io_client1 = socket_io.test_client(self.app, namespace=self.events_namespace,
+                                                      flask_test_client=client1)
+            socket_io_client1.emit('enter_room', namespace=self.events_namespace)
+            socket_io_client1.get_received(self.events_namespace)
+
+            start = time.monotonic()
+            pool = eventlet.GreenPool()
+            for _ in range(5):
+                pool.spawn(self.slow_query)
+            # the queries are sent and wait for postgres
+            eventlet.sleep(0.1)
+            for i in range(10):
+                socket_io_client1.emit('put_data', {'message': f'message {i}',
+                                                    'timestamp_milliseconds': time.time() * 1000},
+                                       namespace=self.events_namespace)
+            received = socket_io_client1.get_received(self.events_namespace)
+            self.assertEqual(len(received), 10)
+            # the events were handled while the queries were still running
+            self.assertLess(time.monotonic() - start, 1)
+            pool.waitall()
+            # the queries were executed at the same time
+            self.assertLess(time.monotonic() - start, 2.5)
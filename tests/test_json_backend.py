@@ -0,0 +1,63 @@
+import datetime
+import json
+import unittest
+import uuid
+from unittest import mock
+
+from app import make_app
+from app import json_backend as json_backend_module
+from app.config import TestConfig
+from app.json_backend import OrjsonJSON, StandardJSON, json_backend
+
+
+class JSONBackendTestCase(unittest.TestCase):
+    """Tests the configurable json backend"""
+
+    def setUp(self) -> None:
+        self.data = {'naive': datetime.datetime(2021, 5, 20, 14, 18, 38),
+                     'aware': datetime.datetime(2021, 5, 20, 14, 18, 38, 500,
+                                                tzinfo=datetime.timezone(datetime.timedelta(hours=3))),
+                     'date': datetime.date(2021, 5, 20),
+                     'uuid': uuid.UUID(int=1),
+                     1: 'non string key',
+                     'text': 'Привіт'}
+        self.expected = {'naive': '2021-05-20T14:18:38+00:00',
+                         'aware': '2021-05-20T14:18:38.000500+03:00',
+                         'date': '2021-05-20',
+                         'uuid': '00000000-0000-0000-0000-000000000001',
+                         '1': 'non string key',
+                         'text': 'Привіт'}
+
+    def test_standard_json(self):
+        self.assertEqual(json.loads(StandardJSON.dumps(self.data)), self.expected)
+        with self.assertRaises(TypeError):
+            StandardJSON.dumps({'value': object()})
+
+    @unittest.skipIf(json_backend_module.orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        self.assertEqual(json.loads(OrjsonJSON.dumps(self.data)), self.expected)
+        self.assertEqual(OrjsonJSON.dumps({'b': 1, 'a': [1, 2]}, sort_keys=True, separators=(',', ':')),
+                         '{"a":[1,2],"b":1}')
+        # formatting which orjson does not support and values it cannot encode
+        self.assertEqual(OrjsonJSON.dumps({'a': 1}, indent=4), '{\n    "a": 1\n}')
+        self.assertEqual(OrjsonJSON.dumps([2 ** 70]), f'[{2 ** 70}]')
+        self.assertEqual(OrjsonJSON.loads('{"a": [1]}'), {'a': [1]})
+        with self.assertRaises(TypeError):
+            OrjsonJSON.dumps({'value': object()})
+
+    def test_init_app(self):
+        config = type('StandardJSONTestConfig', (TestConfig,), {'JSON_BACKEND': 'json'})
+        app = make_app(config)
+        self.assertEqual(json_backend.name, 'json')
+        with app.app_context():
+            response = json_backend.jsonify(b=1, a=datetime.datetime(2021, 5, 20))
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertEqual(response.data, b'{"a": "2021-05-20T00:00:00+00:00", "b": 1}\n')
+
+        with mock.patch.object(json_backend_module, 'orjson', None):
+            make_app(type('AutoJSONTestConfig', (TestConfig,), {'JSON_BACKEND': 'auto'}))
+            self.assertEqual(json_backend.name, 'json')
+            with self.assertRaises(RuntimeError):
+                make_app(type('OrjsonTestConfig', (TestConfig,), {'JSON_BACKEND': 'orjson'}))
+        with self.assertRaises(ValueError):
+            make_app(type('UnknownJSONTestConfig', (TestConfig,), {'JSON_BACKEND': 'yaml'}))
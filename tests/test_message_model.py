@@ -1,14 +1,15 @@
 import unittest
 from datetime import datetime
 
-from sqlalchemy import select
+from sqlalchemy import event, select
 
 from app import db
 from app import make_app
 from app.authentication import User
 from app.authentication.models import chats
+from app.cache import chat_cache
 from app.chats import Message
-from app.chats.exceptions import MessageNotFoundByIndexError
+from app.chats.exceptions import ChatNotFoundByIndexesError, MessageNotFoundByIndexError
 from app.config import TestConfig
 from tests.test_user_model import init_users
 
@@ -17,8 +18,7 @@ class MessageModelTestCase(unittest.TestCase):
     """Tests Message class methods"""
 
     def setUp(self) -> None:
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         self.app = make_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
@@ -28,8 +28,18 @@ class MessageModelTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
+
+    def record_statements(self) -> list:
+        """Returns a list, which will contain all the sql statements executed until the end of the test"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
 
     def test_message_init(self):
         db.session.add_all(init_users(2))
@@ -44,6 +54,43 @@ class MessageModelTestCase(unittest.TestCase):
         with self.assertRaises(AssertionError):
             Message(text='blabla', datetime_writing=datetime.now(), sender_id=1, receiver_id=2, chat_id=3)
 
+    def test_message_init_trusts_chat_id(self):
+        db.session.add_all(init_users(2))
+        db.session.commit()
+        User.create_chat(1, 2)
+        db.session.commit()
+        statements = self.record_statements()
+        message = Message(text='blabla', sender_id=1, receiver_id=2, chat_id=1, verify_chat=False)
+        self.assertEqual(statements, [])
+        self.assertEqual(message.chat_id, 1)
+        # without chat_id the chat is still looked up
+        message = Message(text='blabla', sender_id=2, receiver_id=1, verify_chat=False)
+        self.assertEqual(message.chat_id, 1)
+
+    def test_create_many(self):
+        db.session.add_all(init_users(3))
+        db.session.commit()
+        User.create_chat(1, 2)
+        db.session.commit()
+        statements = self.record_statements()
+        Message.create_many(1, 2, 1, ['first', 'second', 'third'], datetime_writing=datetime(2021, 5, 1, 10))
+        db.session.commit()
+        # verifying the chat, the insert, selecting and updating the last message of the chat
+        self.assertEqual(len(statements), 4)
+        messages = Message.query.order_by(Message.message_id).all()
+        self.assertEqual([message.text for message in messages], ['first', 'second', 'third'])
+        self.assertTrue(all(message.sender_id == 2 and message.receiver_id == 1 and message.chat_id == 1 and
+                            message.datetime_writing == datetime(2021, 5, 1, 10) for message in messages))
+        last_message = db.session.execute(select(chats.c.last_message_id, chats.c.last_message_preview)).one()
+        self.assertEqual(tuple(last_message), (3, 'third'))
+
+        with self.assertRaises(ChatNotFoundByIndexesError):
+            Message.create_many(1, 1, 3, ['wrong chat'])
+        with self.assertRaises(ChatNotFoundByIndexesError):
+            Message.create_many(2, 1, 2, ['no chat'])
+        Message.create_many(1, 1, 2, [])
+        self.assertEqual(len(Message.query.all()), 3)
+
     def test_delete_messages(self):
         users = init_users(3)
         m1 = Message(text='blabla', sender_id=2, receiver_id=1)
@@ -73,3 +120,118 @@ class MessageModelTestCase(unittest.TestCase):
         self.assertEqual(Message.get_message_by_id(2), m2)
         with self.assertRaises(MessageNotFoundByIndexError):
             Message.get_message_by_id(3)
+
+    def test_chat_last_message(self):
+        def get_last_message(chat_id: int) -> tuple:
+            return tuple(db.session.execute(
+                select(chats.c.last_message_id, chats.c.last_message_at, chats.c.last_message_preview).where(
+                    chats.c.chat_id == chat_id)).one())
+
+        db.session.add_all(init_users(3))
+        db.session.commit()
+        m1 = Message(text='first', sender_id=1, receiver_id=2, datetime_writing=datetime(2021, 5, 1, 10))
+        m2 = Message(text='second', sender_id=2, receiver_id=1, datetime_writing=datetime(2021, 5, 1, 11))
+        # was written earlier but is saved later, so it must not become the last message
+        m3 = Message(text='delayed', sender_id=1, receiver_id=2, datetime_writing=datetime(2021, 5, 1, 9))
+        m4 = Message(text='x' * 150, sender_id=1, receiver_id=3, datetime_writing=datetime(2021, 5, 1, 12))
+        db.session.add_all([m1, m2, m3, m4])
+        db.session.commit()
+        self.assertEqual(get_last_message(1), (2, datetime(2021, 5, 1, 11), 'second'))
+        self.assertEqual(get_last_message(2), (4, datetime(2021, 5, 1, 12), 'x' * 100))
+
+        m2.text = 'edited'
+        m1.text = 'edited too'
+        db.session.commit()
+        self.assertEqual(get_last_message(1), (2, datetime(2021, 5, 1, 11), 'edited'))
+
+        db.session.delete(m2)
+        db.session.commit()
+        self.assertEqual(get_last_message(1), (1, datetime(2021, 5, 1, 10), 'edited too'))
+
+        db.session.delete(m3)
+        db.session.commit()
+        self.assertEqual(get_last_message(1), (1, datetime(2021, 5, 1, 10), 'edited too'))
+
+        Message.delete_messages(chat_id=1)
+        db.session.commit()
+        self.assertEqual(get_last_message(1), (None, None, None))
+        self.assertEqual(get_last_message(2), (4, datetime(2021, 5, 1, 12), 'x' * 100))
+
+    def test_chat_version(self):
+        def get_version(chat_id: int) -> int:
+            return db.session.execute(select(chats.c.version).where(chats.c.chat_id == chat_id)).scalar()
+
+        db.session.add_all(init_users(3))
+        db.session.commit()
+        User.create_chat(1, 2)
+        User.create_chat(1, 3)
+        db.session.commit()
+        self.assertEqual(get_version(1), 0)
+        message = Message(text='first', sender_id=1, receiver_id=2)
+        # an older message does not become the last one, but the chat is changed
+        old_message = Message(text='old', sender_id=2, receiver_id=1, datetime_writing=datetime(2021, 1, 1))
+        db.session.add_all([message, old_message])
+        db.session.commit()
+        self.assertEqual(get_version(1), 2)
+        self.assertEqual(get_version(2), 0)
+        Message.create_many(1, 1, 2, ['second', 'third'])
+        db.session.commit()
+        self.assertEqual(get_version(1), 3)
+        message.text = 'edited'
+        db.session.commit()
+        self.assertEqual(get_version(1), 4)
+        db.session.delete(message)
+        db.session.commit()
+        self.assertEqual(get_version(1), 5)
+        db.session.delete(Message.get_message_by_id(4))
+        db.session.commit()
+        self.assertEqual(get_version(1), 6)
+        Message.delete_messages(chat_id=1)
+        db.session.commit()
+        self.assertEqual(get_version(1), 7)
+        self.assertEqual(get_version(2), 0)
+
+    def test_search(self):
+        db.session.add_all(init_users(3))
+        db.session.commit()
+        User.create_chat(1, 2)
+        User.create_chat(1, 3)
+        Message.create_many(1, 1, 2, ['Hello world', 'hello there, hello', 'nothing'])
+        db.session.add(Message(text='HELLO, World!', sender_id=3, receiver_id=1))
+        db.session.commit()
+
+        found = Message.search('hello')
+        # more occurrences give a bigger rank, the newer message is the first of equal ones
+        self.assertEqual([row.message_id for row in found], [2, 4, 1])
+        self.assertEqual(found[0].highlight, '<mark>hello</mark> there, <mark>hello</mark>')
+        self.assertEqual(found[0].chat_id, 1)
+        self.assertGreater(found[0].rank, found[1].rank)
+        self.assertEqual([row.message_id for row in Message.search('world HELLO')], [4, 1])
+        self.assertEqual([row.message_id for row in Message.search('hello', chat_id=2)], [4])
+        self.assertEqual([row.message_id for row in Message.search('hello', user_id=2)], [2, 1])
+        self.assertEqual([row.message_id for row in Message.search('hello', after=(found[0].rank, 2), limit=1)], [4])
+        for search_string in ('', '  ', 'absent', 'hello OR nothing', 'NEAR(hello world)'):
+            self.assertEqual(Message.search(search_string), [], search_string)
+        # the search string is not parsed as a query syntax
+        self.assertEqual(Message.search('"hello*'), found)
+
+        # the index follows edited and deleted messages
+        message = Message.get_message_by_id(3)
+        message.text = 'hello again'
+        db.session.delete(Message.get_message_by_id(1))
+        db.session.commit()
+        self.assertEqual([row.message_id for row in Message.search('hello')], [2, 4, 3])
+        Message.delete_messages(chat_id=1)
+        db.session.commit()
+        self.assertEqual([row.message_id for row in Message.search('hello')], [4])
+
+    def test_search_highlight_is_escaped(self):
+        db.session.add_all(init_users(2))
+        db.session.commit()
+        User.create_chat(1, 2)
+        Message.create_many(1, 1, 2, ['<img src=x onerror=alert(1)> hello & "bye"'])
+        db.session.commit()
+        found = Message.search('hello')
+        self.assertEqual(found[0].highlight,
+                         '&lt;img src=x onerror=alert(1)&gt; <mark>hello</mark> &amp; &quot;bye&quot;')
+        self.assertEqual(found[0].text, '<img src=x onerror=alert(1)> hello & "bye"')
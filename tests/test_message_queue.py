@@ -0,0 +1,165 @@
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+from app import make_app
+from app import socket_io
+from app.cache import chat_cache
+from app.config import TestConfig
+from app.authentication.tokens import revoked_tokens
+from app.message_queue import CACHE_INVALIDATION_NAMESPACE, TOKEN_REVOCATION_NAMESPACE, EventTap, LocalBroker, \
+    LocalBrokerManager, TappedManager, event_tap, make_client_manager, make_invalidation_publisher, \
+    make_revocation_publisher
+
+NAMESPACE = '/chats/going'
+ROOM = 'test_user1_test_user2'
+
+
+def run_worker(name: str, socket_path: str, ready, go, received):
+    """Imitates one gunicorn worker: creates the application with the local message queue, registers a client and an
+    event tap listener in the room and reports every event they receive. The first worker also emits print_message
+    into the room."""
+    config = type('QueueTestConfig', (TestConfig,), {'SOCKETIO_MESSAGE_QUEUE': f'unix://{socket_path}'})
+    app = make_app(config)
+    server = socket_io.server
+    server.manager_initialized = True
+    server.manager.initialize()
+    server.manager.subscribed.wait(5)
+    sid = server.manager.connect(uuid.uuid4().hex, NAMESPACE)
+    server.manager.enter_room(sid, NAMESPACE, ROOM)
+    server._send_packet = lambda eio_sid, pkt: received.put((name, pkt.data))
+    listener = event_tap.listen(NAMESPACE, ROOM)
+    threading.Thread(target=lambda: received.put((f'{name} tap', list(listener.get()))), daemon=True).start()
+    ready.set()
+    if go.wait(5) and name == 'worker1':
+        with app.app_context():
+            socket_io.emit('print_message', {'message': 'Hello!', 'timestamp_milliseconds': 1}, room=ROOM,
+                           namespace=NAMESPACE)
+
+
+class MessageQueueTestCase(unittest.TestCase):
+    """Tries out the local broker and sharing Socket.IO rooms between processes"""
+
+    def setUp(self) -> None:
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        self.broker = LocalBroker(self.socket_path)
+        threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.broker.shutdown()
+        self.broker.server_close()
+
+    def test_make_client_manager(self):
+        self.assertIsInstance(make_client_manager(None), TappedManager)
+        self.assertIsInstance(make_client_manager(''), TappedManager)
+        manager = make_client_manager(f'unix://{self.socket_path}', channel='test')
+        self.assertIsInstance(manager, LocalBrokerManager)
+        self.assertEqual(manager.path, self.socket_path)
+        self.assertEqual(manager.channel, 'test')
+
+    def test_default_app_has_no_queue(self):
+        make_app(TestConfig)
+        self.assertNotIsInstance(socket_io.server.manager, LocalBrokerManager)
+
+    def test_local_broker_channels(self):
+        received = queue.Queue()
+        managers = [LocalBrokerManager(f'unix://{self.socket_path}', channel=channel)
+                    for channel in ('first', 'first', 'second')]
+
+        def listen(number: int, manager: LocalBrokerManager):
+            for message in manager._listen():
+                received.put((number, message))
+
+        for number, manager in enumerate(managers):
+            threading.Thread(target=listen, args=(number, manager), daemon=True).start()
+            self.assertTrue(manager.subscribed.wait(5))
+
+        managers[0]._publish({'method': 'emit', 'data': 'to the first'})
+        managers[2]._publish({'method': 'emit', 'data': 'to the second'})
+        results = sorted(received.get(timeout=5) for _ in range(3))
+        self.assertEqual([number for number, _ in results], [0, 1, 2])
+        self.assertTrue(b'to the first' in results[0][1] and b'to the first' in results[1][1])
+        self.assertTrue(b'to the second' in results[2][1])
+        with self.assertRaises(queue.Empty):
+            received.get(timeout=0.2)
+
+    def test_two_workers_exchange_print_message(self):
+        context = multiprocessing.get_context('spawn')
+        go = context.Event()
+        received = context.Queue()
+        workers = []
+        for name in ('worker1', 'worker2'):
+            ready = context.Event()
+            worker = context.Process(target=run_worker, args=(name, self.socket_path, ready, go, received),
+                                     daemon=True)
+            worker.start()
+            workers.append(worker)
+            self.assertTrue(ready.wait(30))
+        go.set()
+
+        results = sorted(received.get(timeout=10) for _ in range(len(workers) * 2))
+        # queue listeners are not daemon threads, so workers live until they are stopped like gunicorn does
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        self.assertEqual([name for name, _ in results], ['worker1', 'worker1 tap', 'worker2', 'worker2 tap'])
+        for _, data in results:
+            self.assertEqual(data, ['print_message', {'message': 'Hello!', 'timestamp_milliseconds': 1}])
+
+    def test_event_tap(self):
+        tap = EventTap(max_size=2)
+        listener = tap.listen(NAMESPACE, ROOM)
+        other_room_listener = tap.listen(NAMESPACE, 'other_room')
+        tap.publish('print_message', {'message': 'Hello!'}, NAMESPACE, ROOM)
+        tap.publish('status', {'message': 'to everyone'}, NAMESPACE)
+        tap.publish('status', {'message': 'to another namespace'}, '/', ROOM)
+        self.assertEqual(listener.get_nowait(), ('print_message', {'message': 'Hello!'}))
+        self.assertEqual(listener.get_nowait(), ('status', {'message': 'to everyone'}))
+        self.assertTrue(listener.empty())
+        self.assertEqual(other_room_listener.get_nowait(), ('status', {'message': 'to everyone'}))
+        for _ in range(3):
+            tap.publish('print_message', {}, NAMESPACE, ROOM)
+        self.assertEqual(tap.stats(), {'rooms': 2, 'listeners': 2, 'dropped': 1})
+        tap.stop_listening(NAMESPACE, ROOM, listener)
+        tap.stop_listening(NAMESPACE, 'other_room', other_room_listener)
+        self.assertEqual(tap.stats()['rooms'], 0)
+
+    def test_default_manager_publishes_into_event_tap(self):
+        app = make_app(TestConfig)
+        listener = event_tap.listen(NAMESPACE, ROOM)
+        self.addCleanup(event_tap.stop_listening, NAMESPACE, ROOM, listener)
+        with app.app_context():
+            socket_io.emit('print_message', {'message': 'Hello!'}, room=ROOM, namespace=NAMESPACE)
+        self.assertEqual(listener.get(timeout=1), ('print_message', {'message': 'Hello!'}))
+
+    def test_cache_invalidation(self):
+        self.assertIsNone(make_invalidation_publisher(make_client_manager(None)))
+        manager = make_client_manager(f'unix://{self.socket_path}')
+        published = []
+        manager._publish = published.append
+        make_invalidation_publisher(manager)('CHAT_CACHE', ['1:2'])
+        self.assertEqual(published[0]['namespace'], CACHE_INVALIDATION_NAMESPACE)
+        self.addCleanup(chat_cache.clear)
+        chat_cache.set('1:2', 0)
+        listener = event_tap.listen(CACHE_INVALIDATION_NAMESPACE, ROOM)
+        self.addCleanup(event_tap.stop_listening, CACHE_INVALIDATION_NAMESPACE, ROOM, listener)
+        manager._handle_emit(published[0])
+        self.assertIsNone(chat_cache.get('1:2'))
+        self.assertTrue(listener.empty())
+
+    def test_token_revocation(self):
+        self.assertIsNone(make_revocation_publisher(make_client_manager(None)))
+        manager = make_client_manager(f'unix://{self.socket_path}')
+        published = []
+        manager._publish = published.append
+        make_revocation_publisher(manager)('a', time.time() + 60)
+        self.assertEqual(published[0]['namespace'], TOKEN_REVOCATION_NAMESPACE)
+        self.addCleanup(revoked_tokens.clear)
+        self.assertFalse(revoked_tokens.is_revoked('a'))
+        manager._handle_emit(published[0])
+        self.assertTrue(revoked_tokens.is_revoked('a'))
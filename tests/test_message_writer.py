@@ -0,0 +1,138 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app import make_app
+from app.authentication import User
+from app.authentication.models import chats
+from app.cache import chat_cache
+from app.chats import Message
+from app.chats.writer import message_writer
+from app.config import TestConfig
+from tests.test_user_model import init_users
+
+
+class WriteBehindTestConfig(TestConfig):
+    MESSAGES_WRITE_BEHIND = True
+    MESSAGES_WRITE_BEHIND_BATCH_SIZE = 5
+    MESSAGES_WRITE_BEHIND_INTERVAL = 10000
+
+
+class MessageWriterTestCase(unittest.TestCase):
+    """Tests write-behind saving of messages"""
+
+    def setUp(self) -> None:
+        chat_cache.clear()
+        self.app = make_app(WriteBehindTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add_all(init_users(2))
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        message_writer.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        chat_cache.clear()
+
+    def put_messages(self, number: int):
+        for figure in range(number):
+            message_writer.put(sender_id=1 + figure % 2, receiver_id=2 - figure % 2, text=str(figure),
+                               datetime_writing=datetime(2021, 5, 1, 12, figure))
+
+    def wait_written(self, number: int, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while message_writer.written < number and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_flush(self):
+        self.put_messages(3)
+        self.assertTrue(User.is_chat_between(1, 2))
+        self.assertEqual(len(Message.query.all()), 0)
+        message_writer.flush()
+        self.assertEqual([message.text for message in Message.query.order_by(Message.message_id)], ['0', '1', '2'])
+        chat = db.session.execute(select(chats)).one()
+        self.assertEqual(chat.last_message_preview, '2')
+        self.assertEqual(chat.last_message_at, datetime(2021, 5, 1, 12, 2))
+        stats = message_writer.stats()
+        self.assertEqual(stats['written'], 3)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_full_batch_is_written(self):
+        self.put_messages(7)
+        self.wait_written(5)
+        self.assertEqual(message_writer.written, 5)
+        self.assertEqual(message_writer.flushes, 1)
+        self.assertEqual(len(Message.query.all()), 5)
+
+    def test_interval(self):
+        message_writer.interval = 0.05
+        self.put_messages(2)
+        self.wait_written(2)
+        self.assertEqual(len(Message.query.all()), 2)
+
+    def test_full_queue_writes_synchronously(self):
+        message_writer.queue.maxsize = 1
+        message_writer.put_timeout = 0.01
+        message_writer.flush_lock.acquire()
+        threading.Timer(0.5, message_writer.flush_lock.release).start()
+        self.put_messages(1)
+        # the writer thread has taken the first message and waits for the lock, so the second message fills the queue
+        # and the third one is saved synchronously as soon as the lock is released
+        time.sleep(0.1)
+        self.put_messages(2)
+        self.assertEqual(message_writer.sync_writes, 1)
+        self.assertEqual(message_writer.written, 1)
+        message_writer.flush()
+        self.assertEqual(len(Message.query.all()), 3)
+
+    def test_rejected_message_does_not_block_others(self):
+        message_writer.put(sender_id=1, receiver_id=2, text=None, datetime_writing=datetime(2021, 5, 1, 11))
+        self.put_messages(5)
+        # the first batch is refused, and its four valid messages are saved one by one
+        self.wait_written(4)
+        self.assertEqual(message_writer.written, 4)
+        self.assertEqual(message_writer.rejected, 1)
+        # the fifth one waits for the interval
+        self.assertEqual([row['text'] for row in message_writer.pending], ['4'])
+        message_writer.stop()
+        self.assertEqual(len(Message.query.all()), 5)
+        self.assertEqual(message_writer.stats()['rejected'], 1)
+
+    def test_max_pending(self):
+        message_writer.max_pending = 3
+        message_writer.interval = 0.01
+        unavailable = OperationalError('INSERT', {}, Exception('the database is unavailable'))
+        with mock.patch.object(message_writer, '_write', return_value=unavailable):
+            self.put_messages(6)
+            time.sleep(0.2)
+            # the pending messages are kept to be written again, the others wait in the queue
+            self.assertEqual(len(message_writer.pending), 3)
+            self.assertEqual(message_writer.queue.qsize(), 3)
+            self.assertEqual(message_writer.rejected, 0)
+        message_writer.stop()
+        self.assertEqual(len(Message.query.all()), 6)
+
+    def test_stop(self):
+        self.put_messages(3)
+        message_writer.stop()
+        self.assertIsNone(message_writer.thread)
+        self.assertEqual(len(Message.query.all()), 3)
+
+    def test_stats_view(self):
+        self.put_messages(1)
+        message_writer.flush()
+        response = self.app.test_client().get('/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['message_writer']['written'], 1)
+        self.app.config['STATS_ENABLED'] = False
+        self.assertEqual(self.app.test_client().get('/stats').status_code, 404)
@@ -0,0 +1,105 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from app import db
+from app import make_app
+from app.authentication.models import User
+from app.cache import chat_cache, recent_writers_cache, search_cache
+from app.chats.utils import search_users_cached
+from app.config import TestConfig
+from app.routing import choose_replica, mark_replica_unavailable, reading
+
+
+class RoutingTestCase(unittest.TestCase):
+    """Tests routing of queries between two sqlite files, the primary one and the replica"""
+
+    def basic_auth_header(self, name: str) -> dict:
+        return {'Authorization': f'Basic {base64.b64encode(f"{name}@gmail.com:12345678".encode()).decode()}'}
+
+    def make_app(self, replica_uri: str):
+        config = type('RoutingTestConfig', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.primary_path}',
+            'SQLALCHEMY_REPLICA_URIS': [replica_uri],
+            'RECENT_WRITERS_CACHE_TTL': 0.5})
+        self.app = make_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.test_client = self.app.test_client()
+
+    def setUp(self) -> None:
+        directory = tempfile.mkdtemp()
+        self.primary_path = os.path.join(directory, 'primary.sqlite')
+        self.replica_path = os.path.join(directory, 'replica.sqlite')
+        self.make_app(f'sqlite:///{self.replica_path}')
+        chat_cache.clear()
+        db.create_all()
+        for name in ('main', 'companion'):
+            self.test_client.post('/api/register', json={'email': f'{name}@gmail.com', 'username': f'{name}_username',
+                                                         'name': f'{name}_name', 'password': '12345678'})
+        db.session.remove()
+        # the replica is in sync with the primary at the moment
+        shutil.copy(self.primary_path, self.replica_path)
+
+    def tearDown(self) -> None:
+        mark_replica_unavailable('replica0', 0)
+        chat_cache.clear()
+        recent_writers_cache.clear()
+        search_cache.clear()
+        db.session.remove()
+        # only the primary, because a replica can be unavailable
+        db.drop_all(bind=None)
+        self.app_context.pop()
+        shutil.rmtree(os.path.dirname(self.primary_path))
+
+    def get_chats(self, name: str) -> list:
+        response = self.test_client.get('/api/chats', headers=self.basic_auth_header(name))
+        self.assertEqual(response.status_code, 200)
+        return response.json['data']
+
+    def test_reads_from_replica(self):
+        response = self.test_client.post('/api/chats', json={'companion_id': 2}, headers=self.basic_auth_header('main'))
+        self.assertEqual(response.status_code, 201)
+        # the replica has not received the chat yet
+        self.assertEqual(self.get_chats('companion'), [])
+
+    def test_read_your_writes(self):
+        self.test_client.post('/api/chats', json={'companion_id': 2}, headers=self.basic_auth_header('main'))
+        self.assertEqual(len(self.get_chats('main')), 1)
+        time.sleep(0.6)
+        self.assertEqual(self.get_chats('main'), [])
+
+    def test_writes_go_to_primary(self):
+        with reading(db.session()):
+            User.create_chat(1, 2)
+            db.session.add(User(email='new@gmail.com', username='new_username', name='new_name', password_hash='-'))
+            db.session.commit()
+        self.assertTrue(User.is_chat_between(1, 2))
+        self.assertIsNotNone(User.query.filter_by(username='new_username').first())
+
+    def test_replica_data_is_not_cached(self):
+        User.create_chat(1, 2)
+        db.session.commit()
+        with reading(db.session()):
+            self.assertFalse(User.is_chat_between(1, 2))
+        self.assertIsNone(chat_cache.get('1:2'))
+        self.assertTrue(User.is_chat_between(1, 2))
+
+        db.session.add(User(email='new@gmail.com', username='new_username', name='new_name', password_hash='-'))
+        db.session.commit()
+        with reading(db.session()):
+            self.assertEqual(search_users_cached('new'), [])
+        self.assertEqual(len(search_cache.backend), 0)
+        self.assertEqual([user.username for user in search_users_cached('new')], ['new_username'])
+
+    def test_fallback_to_primary(self):
+        self.app_context.pop()
+        self.make_app('sqlite:////not/existing/directory/replica.sqlite')
+        self.test_client.post('/api/chats', json={'companion_id': 2}, headers=self.basic_auth_header('main'))
+        self.assertEqual(len(self.get_chats('companion')), 1)
+        # the replica is not used until REPLICA_RETRY_INTERVAL passes
+        self.assertIsNone(choose_replica(self.app))
+        self.assertEqual(len(self.get_chats('companion')), 1)
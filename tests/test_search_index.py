@@ -0,0 +1,145 @@
+import unittest
+from unittest import mock
+
+from app import db
+from app import make_app
+from app.authentication.models import User
+from app.chats.search_index import SortedTokens, user_search_index
+from app.chats.utils import INSIDE_WORD_RANK, search_for_users_by, search_users_page
+from app.config import TestConfig
+from tests.test_user_model import init_users
+
+
+class SortedTokensTestCase(unittest.TestCase):
+    """Tests the sorted arrays of tokens"""
+
+    def test_add_remove_iterate(self):
+        tokens = SortedTokens([('anna', 2), ('ann', 1), ('bob', 3)])
+        tokens.add('annabel', 4)
+        tokens.add('ann', 5)
+        tokens.add('ann', 5)
+        self.assertEqual(list(tokens.iterate('ann')), [('ann', 1), ('ann', 5), ('anna', 2), ('annabel', 4)])
+        self.assertEqual(list(tokens.iterate('ann', ('ann', 5))), [('anna', 2), ('annabel', 4)])
+        tokens.remove('anna', 2)
+        tokens.remove('anna', 7)
+        self.assertEqual(list(tokens.iterate('anna')), [('annabel', 4)])
+        self.assertEqual(list(tokens.iterate('c')), [])
+        self.assertEqual(len(tokens), 4)
+
+    def test_sorted_cooperatively(self):
+        pairs = [('bob', 3), ('ann', 5), ('anna', 2), ('ann', 1), ('annabel', 4)]
+        with mock.patch('app.chats.search_index._CHUNK_SIZE', 2), mock.patch('time.sleep') as sleep:
+            tokens = SortedTokens.sorted_cooperatively(pairs)
+        self.assertEqual(list(zip(tokens.keys, tokens.ids)), sorted(pairs))
+        self.assertEqual(sleep.call_count, 5)
+
+
+class UserSearchIndexTestCase(unittest.TestCase):
+    """Tests the prefix index of users"""
+
+    def setUp(self) -> None:
+        self.app = make_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = init_users(6)
+        users[0].username, users[0].name = 'annabel', 'Bell'
+        users[1].username, users[1].name = 'joe', 'Jo Anna'
+        users[2].username, users[2].name = 'ann', 'Anna'
+        users[3].username, users[3].name = 'bob', 'Ann'
+        users[4].username, users[4].name = 'ann_s', 'Sam'
+        users[5].username, users[5].name = 'maks', 'Maxim Ruslanovich'
+        db.session.add_all(users)
+        db.session.commit()
+        user_search_index.build()
+
+    def tearDown(self) -> None:
+        user_search_index.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def search(self, search_string: str, **kwargs) -> list:
+        return [result.username for result in user_search_index.search(search_string, **kwargs)]
+
+    def test_search(self):
+        self.assertTrue(user_search_index.ready)
+        results = user_search_index.search('Ann')
+        self.assertEqual([(result.username, result.rank) for result in results],
+                         [('ann', 0), ('bob', 0), ('ann_s', 1), ('annabel', 1), ('joe', 2)])
+        # the same users as the database search finds by prefixes
+        self.assertEqual(set(self.search('ann')), {row.username for row in search_for_users_by('ann').all()})
+        self.assertEqual(self.search('ann', current_user_id=3), ['bob', 'ann_s', 'annabel', 'joe'])
+        self.assertEqual(self.search('bob ruslan'), ['bob', 'maks'])
+        self.assertEqual(self.search('nna'), [])
+        self.assertEqual(user_search_index.stats()['users'], 6)
+
+    def test_search_pages(self):
+        found = []
+        cursor = None
+        while True:
+            rows, cursor = search_users_page('ann jo', cursor=cursor, limit=2)
+            found.extend(row.username for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(found, ['ann', 'bob', 'ann_s', 'annabel', 'joe'])
+        self.assertEqual(user_search_index.stats()['fallbacks'], 0)
+
+    def test_committed_changes(self):
+        user = User(email='new@gmail.com', username='annette', name='Annette')
+        user.set_password('12345678')
+        db.session.add(user)
+        db.session.commit()
+        self.assertIn('annette', self.search('anne'))
+
+        user.username, user.name = 'nette', 'Nette'
+        db.session.commit()
+        self.assertEqual(self.search('anne'), [])
+        self.assertEqual(self.search('nette'), ['nette'])
+
+        user.name = 'Annie'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.search('annie'), [])
+
+        db.session.delete(User.get_user_by_id(4))
+        db.session.commit()
+        self.assertNotIn('bob', self.search('ann'))
+
+    def test_search_pages_inside_words(self):
+        found = []
+        cursor = None
+        while True:
+            rows, cursor = search_users_page('an', cursor=cursor, limit=2)
+            found.extend(row for row in rows)
+            if cursor is None:
+                break
+        # maks is matched only inside "ruslanovich", so he is found by the database after all the prefix matches
+        self.assertEqual([row.username for row in found][-1], 'maks')
+        self.assertEqual(found[-1].rank, INSIDE_WORD_RANK)
+        self.assertEqual(sorted(row.username for row in found),
+                         sorted(row.username for row in search_for_users_by('an').all()))
+
+        rows, cursor = search_users_page('nna', limit=2)
+        self.assertEqual([row.username for row in rows], ['ann', 'joe'])
+        rows, cursor = search_users_page('nna', cursor=cursor, limit=2)
+        self.assertEqual([row.username for row in rows], ['annabel'])
+        self.assertIsNone(cursor)
+        self.assertEqual(user_search_index.stats()['fallbacks'], 0)
+
+    def test_refresh(self):
+        # a user registered by another worker, the index of this one does not know about him
+        db.session.execute(User.__table__.insert().values(email='new@gmail.com', username='annette', name=None,
+                                                          password_hash='-'))
+        db.session.commit()
+        self.assertNotIn('annette', self.search('anne'))
+        user_search_index.refresh()
+        self.assertIn('annette', self.search('anne'))
+        self.assertEqual(user_search_index.last_user_id, 7)
+
+    def test_cold_index(self):
+        user_search_index.clear()
+        self.app.config['USER_SEARCH_INDEX'] = True
+        rows, _ = search_users_page('ich')
+        self.assertEqual([row.username for row in rows], ['maks'])
+        self.assertEqual(user_search_index.stats()['fallbacks'], 1)
@@ -0,0 +1,80 @@
+import datetime
+import json
+import unittest
+
+from flask_restful import fields, marshal
+
+from app import db
+from app import make_app
+from app.api.resources.messages import message_fields, messages_list_fields
+from app.api.resources.users import user_fields, users_list_fields
+from app.api.serializers import Serializer, format_rfc822
+from app.authentication.models import User
+from app.chats.models import Message
+from app.config import TestConfig
+from tests.test_user_model import init_users
+
+
+class SerializerTestCase(unittest.TestCase):
+    """Checks that the compiled serializers give the same json as flask_restful marshal"""
+
+    def setUp(self) -> None:
+        self.app = make_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertSameJson(self, data, fields_dict: dict):
+        self.assertEqual(json.dumps(Serializer(fields_dict)(data)), json.dumps(marshal(data, fields_dict)))
+
+    def test_format_rfc822(self):
+        for value in (datetime.datetime(2021, 5, 20, 14, 18, 38, 123), datetime.datetime(1, 1, 1),
+                      datetime.datetime(2024, 2, 29, 23, 59, 59)):
+            self.assertEqual(format_rfc822(value), fields.DateTime().format(value))
+
+    def test_rows_and_models(self):
+        users = init_users(3)
+        users[2].name = None
+        db.session.add_all(users)
+        db.session.commit()
+        User.create_chat(1, 2)
+        Message.create_many(1, 1, 2, ['first', 'second'])
+        db.session.commit()
+
+        rows = db.session.query(User.user_id, User.username, User.name, User.date_joined).all()
+        self.assertSameJson({'user_id': 1, 'data': rows, 'next': 'cursor', 'has_more': True}, users_list_fields)
+        # the columns are in another order
+        rows = db.session.query(User.date_joined, User.name, User.user_id).all()
+        self.assertSameJson({'user_id': 1, 'data': rows}, users_list_fields)
+        self.assertSameJson(User.query.all(), user_fields)
+        self.assertSameJson({'user_id': 1, 'chat_id': 1, 'data': Message.query.all()}, messages_list_fields)
+        self.assertSameJson(Message.query.first(), message_fields)
+
+    def test_values(self):
+        aware = datetime.datetime(2021, 5, 20, 14, 18, 38, tzinfo=datetime.timezone(datetime.timedelta(hours=3)))
+        fields_dict = {
+            'id': fields.Integer,
+            'flag': fields.Boolean(default=False),
+            'text': fields.String(default='none'),
+            'number': fields.Integer(attribute='count'),
+            'date': fields.DateTime(),
+            'iso_date': fields.DateTime(dt_format='iso8601'),
+            'raw': fields.Raw,
+            'float': fields.Float,
+            'nested': {'id': fields.Integer},
+            'items': fields.List(fields.Nested({'id': fields.Integer})),
+            'nullable_items': fields.List(fields.Nested({'id': fields.Integer}, allow_null=True)),
+            'single': fields.Nested({'id': fields.Integer}, allow_null=True),
+        }
+        self.assertSameJson({'id': '3', 'flag': 1, 'text': 5, 'count': 7, 'date': aware,
+                             'iso_date': datetime.datetime(2021, 5, 20), 'raw': [1], 'float': '1.5',
+                             'items': [{'id': 1}, None], 'nullable_items': [None, {'id': 2}], 'single': None},
+                            fields_dict)
+        self.assertSameJson({}, fields_dict)
+        self.assertSameJson([{'id': 1}, {'id': 2}], fields_dict)
+        self.assertSameJson({'items': {'id': 1}}, fields_dict)
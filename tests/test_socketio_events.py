@@ -1,6 +1,6 @@
 import time
 import unittest
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Tuple
 
 from flask.testing import FlaskClient
@@ -11,7 +11,9 @@ from app import db
 from app import make_app
 from app import socket_io
 from app.authentication.models import chats, User
+from app.cache import chat_cache
 from app.chats import Message
+from app.chats.writer import message_writer
 from app.config import TestConfig
 
 
@@ -21,13 +23,11 @@ class SocketIOEventsTestCase(unittest.TestCase):
         self.app = make_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         db.create_all()
 
     def tearDown(self) -> None:
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
@@ -79,6 +79,54 @@ class SocketIOEventsTestCase(unittest.TestCase):
         socket_io_client.disconnect(self.events_namespace)
         self.assertFalse(socket_io_client.is_connected(self.events_namespace))
 
+    def test_chats_list_namespace(self):
+        chats_list_namespace = '/chats/list'
+        anonymous_socket_io_client = socket_io.test_client(self.app, namespace=chats_list_namespace)
+        self.assertFalse(anonymous_socket_io_client.is_connected(chats_list_namespace))
+
+        with self.app.test_client() as client1, self.app.test_client() as client2:
+            self.init_two_clients(client1, client2)
+            list_client1, list_client2 = [
+                socket_io.test_client(self.app, namespace=chats_list_namespace, flask_test_client=client) for client in
+                (client1, client2)]
+            self.assertTrue(list_client1.is_connected(chats_list_namespace))
+            self.assertEqual(list_client1.get_received(chats_list_namespace)[0]['args'], [{'message': 'connected'}])
+            list_client2.get_received(chats_list_namespace)
+
+            socket_io_client1, socket_io_client2 = self.get_socket_io_clients(client1, client2)
+            socket_io_client1.emit('enter_room', namespace=self.events_namespace)
+            message_time = datetime(2021, 5, 20, 14, 18, 38)
+            timestamp = message_time.replace(tzinfo=timezone.utc).timestamp() * 1000
+            socket_io_client1.emit('put_data', {'message': 'Hello!' * 50, 'timestamp_milliseconds': timestamp},
+                                   namespace=self.events_namespace)
+
+            # the chat sockets get only the messages, the list sockets get the compact update with the companion
+            self.assertNotIn('chat_updated', [event['name'] for event in
+                                              socket_io_client2.get_received(self.events_namespace)])
+            received1 = list_client1.get_received(chats_list_namespace)
+            received2 = list_client2.get_received(chats_list_namespace)
+            self.assertEqual([event['name'] for event in received1 + received2], ['chat_updated'] * 2)
+            expected = {'chat_id': 1, 'preview': ('Hello!' * 50)[:100], 'timestamp_milliseconds': timestamp}
+            self.assertEqual(received1[0]['args'][0],
+                             {**expected, 'companion_username': 'test_user2', 'companion_name': 'Ann2'})
+            self.assertEqual(received2[0]['args'][0],
+                             {**expected, 'companion_username': 'test_user1', 'companion_name': 'Ann1'})
+
+            # the chats of other users are not sent to their lists
+            with self.app.test_client() as client3:
+                client3.post('/authentication/register',
+                             data={'email': 'test3@gmail.com', 'username': 'test_user3',
+                                   'name': 'Ann3', 'password1': 'Who am I', 'password2': 'Who am I'})
+                client3.post('/authentication/login', data={'email': 'test3@gmail.com', 'password': 'Who am I'})
+                list_client3 = socket_io.test_client(self.app, namespace=chats_list_namespace,
+                                                     flask_test_client=client3)
+                list_client3.get_received(chats_list_namespace)
+                socket_io_client2.emit('put_data', {'message': 'Hi!', 'timestamp_milliseconds': timestamp + 1000},
+                                       namespace=self.events_namespace)
+                self.assertEqual(list_client1.get_received(chats_list_namespace)[0]['args'][0]['preview'], 'Hi!')
+                self.assertEqual(list_client2.get_received(chats_list_namespace)[0]['args'][0]['preview'], 'Hi!')
+                self.assertEqual(list_client3.get_received(chats_list_namespace), [])
+
     def test_enter_leave_room(self):
         with self.app.test_client() as client1, self.app.test_client() as client2:
             self.init_two_clients(client1, client2)
@@ -161,6 +209,44 @@ class SocketIOEventsTestCase(unittest.TestCase):
             self.assertEqual(messages[1].sender_id, 2)
             self.assertEqual(messages[1].receiver_id, 1)
 
+    def test_put_data_is_validated(self):
+        with self.app.test_client() as client1, self.app.test_client() as client2:
+            self.init_two_clients(client1, client2)
+            socket_io_client1, socket_io_client2 = self.get_socket_io_clients(client1, client2)
+            socket_io_client1.emit('enter_room', namespace=self.events_namespace)
+            socket_io_client2.emit('enter_room', namespace=self.events_namespace)
+            socket_io_client1.get_received(self.events_namespace)
+            socket_io_client2.get_received(self.events_namespace)
+
+            now = time.time() * 1000
+            for data in ({'message': None, 'timestamp_milliseconds': now},
+                         {'message': '  ', 'timestamp_milliseconds': now}, {'message': 'Hello!'}, {'message': 'Hello!', 'timestamp_milliseconds': 'now'},
+                         {'message': 'Hello!', 'timestamp_milliseconds': 1e30}, ['Hello!']):
+                socket_io_client1.emit('put_data', data, namespace=self.events_namespace)
+                self.assertEqual(socket_io_client1.get_received(self.events_namespace),
+                                 [{'name': 'status', 'args': [{'message': 'Message is not valid'}],
+                                   'namespace': self.events_namespace}])
+            self.assertEqual(socket_io_client2.get_received(self.events_namespace), [])
+            self.assertEqual(len(Message.query.all()), 0)
+
+    def test_put_data_after_chat_is_deleted(self):
+        with self.app.test_client() as client1, self.app.test_client() as client2:
+            self.init_two_clients(client1, client2)
+            socket_io_client1, = self.get_socket_io_clients(client1)
+            socket_io_client1.emit('enter_room', namespace=self.events_namespace)
+            socket_io_client1.emit('put_data', {'message': 'first', 'timestamp_milliseconds': time.time() * 1000},
+                                   namespace=self.events_namespace)
+            self.assertEqual(User.get_chat_id_by_users_ids(1, 2), 1)
+
+            User.delete_chat(chat_id=1)
+            db.session.commit()
+            socket_io_client1.emit('put_data', {'message': 'second', 'timestamp_milliseconds': time.time() * 1000},
+                                   namespace=self.events_namespace)
+            # the chat is made again instead of writing into the deleted one
+            chat_ids = [row.chat_id for row in db.session.execute(select(chats.c.chat_id))]
+            self.assertEqual(len(chat_ids), 1)
+            self.assertEqual(Message.query.filter_by(text='second').one().chat_id, chat_ids[0])
+
     def test_create_chat_in_put_data_event(self):
         with self.app.test_client() as client1, self.app.test_client() as client2:
             self.init_two_clients(client1, client2)
@@ -173,29 +259,29 @@ class SocketIOEventsTestCase(unittest.TestCase):
             self.assertEqual(len(result.all()), 0)
             result.close()
             self.assertFalse(User.is_chat_between(1, 2))
-            self.assertEqual(User.is_chat_between.cache_info().currsize, 1)
+            self.assertEqual(chat_cache.get('1:2'), 0)
 
             socket_io_client1.emit('put_data',
                                    {'message': 'test_message', 'timestamp_milliseconds': time.time() * 1000},
                                    namespace=self.events_namespace)
-            self.assertEqual(User.is_chat_between.cache_info().currsize, 0)
+            # the cached absence of the chat was invalidated, and the new chat id was cached
+            self.assertEqual(chat_cache.get('1:2'), 1)
             result = db.session.execute(select(chats))
             self.assertEqual(len(result.all()), 1)
             result.close()
             self.assertTrue(User.is_chat_between(1, 2))
             self.assertTrue(User.is_chat_between(2, 1))
-            self.assertEqual(User.is_chat_between.cache_info().currsize, 2)
-            User.is_chat_between.cache_clear()
+            chat_cache.clear()
             self.assertTrue(User.is_chat_between(1, 2))
             socket_io_client2.emit('put_data',
                                    {'message': 'test_message2', 'timestamp_milliseconds': time.time() * 1000},
                                    namespace=self.events_namespace)
-            self.assertEqual(User.is_chat_between.cache_info().currsize, 2)
+            self.assertEqual(chat_cache.stats()['size'], 1)
             result = db.session.execute(select(chats))
             self.assertEqual(len(result.all()), 1)
             result.close()
             self.assertTrue(User.is_chat_between(2, 1))
-            self.assertEqual(User.is_chat_between.cache_info().currsize, 2)
+            self.assertEqual(chat_cache.stats()['misses'], 1)
 
     def test_get_more_messages(self):
         messages_limit = self.app.config['MESSAGES_PER_LOAD_EVENT']
@@ -248,6 +334,143 @@ class SocketIOEventsTestCase(unittest.TestCase):
             for message in received_messages:
                 self.assertFalse(message['is_current_user'])
 
+    def test_get_more_messages_by_cursor(self):
+        messages_limit = self.app.config['MESSAGES_PER_LOAD_EVENT']
+        with self.app.test_client() as client1, self.app.test_client() as client2:
+            self.init_two_clients(client1, client2)
+            socket_io_client1, socket_io_client2 = self.get_socket_io_clients(client1, client2)
+            socket_io_client1.emit('enter_room', namespace=self.events_namespace)
+            socket_io_client2.emit('enter_room', namespace=self.events_namespace)
+
+            # erase status messages
+            socket_io_client1.get_received(namespace=self.events_namespace)
+            socket_io_client2.get_received(namespace=self.events_namespace)
+
+            # there is no chat yet
+            socket_io_client1.emit('get_more_messages', {'cursor': None}, namespace=self.events_namespace)
+            received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+            self.assertEqual(received_data['messages_number'], 0)
+            self.assertIsNone(received_data['next_cursor'])
+
+            User.create_chat(1, 2)
+            number_of_messages = 25
+            # several messages have equal datetime_writing, so message_id must break ties
+            same_datetime = datetime(2021, 5, 1, 12, 0, 0)
+            db.session.add_all(
+                [Message(text=str(figure), sender_id=1 if figure % 2 else 2, receiver_id=2 if figure % 2 else 1,
+                         datetime_writing=same_datetime if 8 <= figure <= 13 else datetime(2021, 5, 1, 11, figure))
+                 for figure in range(number_of_messages)])
+            db.session.commit()
+
+            loaded_texts = []
+            cursor = None
+            while True:
+                socket_io_client1.emit('get_more_messages', {'cursor': cursor}, namespace=self.events_namespace)
+                received1 = socket_io_client1.get_received(self.events_namespace)
+                self.assertEqual(len(socket_io_client2.get_received(self.events_namespace)), 0)
+                self.assertEqual(len(received1), 1)
+                received_data = received1[0]['args'][0]
+                self.assertTrue(received_data['messages_number'] <= messages_limit)
+                for message in received_data['messages']:
+                    self.assertEqual(message['is_current_user'], int(message['message_text']) % 2 == 1)
+                loaded_texts.extend(message['message_text'] for message in received_data['messages'])
+                cursor = received_data['next_cursor']
+                if cursor is None:
+                    break
+                self.assertEqual(cursor['message_id'], received_data['messages'][-1]['message_id'])
+
+            # broken cursors give an empty page instead of an error in the handler
+            for broken_cursor in ({'message_id': 1}, {'datetime_writing': 'yesterday', 'message_id': 1},
+                                  {'datetime_writing': None, 'message_id': 1},
+                                  {'datetime_writing': '2021-05-01T12:00:00', 'message_id': '1'}, [1, 2]):
+                socket_io_client1.emit('get_more_messages', {'cursor': broken_cursor}, namespace=self.events_namespace)
+                received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+                self.assertEqual(received_data['messages_number'], 0)
+                self.assertIsNone(received_data['next_cursor'])
+                self.assertEqual(received_data['error'], 'Cursor is not valid')
+
+            expected_order = sorted(range(number_of_messages),
+                                    key=lambda figure: (datetime(2021, 5, 1, 12) if 8 <= figure <= 13 else
+                                                        datetime(2021, 5, 1, 11, figure), figure), reverse=True)
+            self.assertEqual(loaded_texts, [str(figure) for figure in expected_order])
+
+    def test_sync(self):
+        with self.app.test_client() as client1, self.app.test_client() as client2:
+            self.init_two_clients(client1, client2)
+            socket_io_client1, socket_io_client2 = self.get_socket_io_clients(client1, client2)
+            socket_io_client1.emit('enter_room', namespace=self.events_namespace)
+            socket_io_client1.get_received(self.events_namespace)
+            socket_io_client2.get_received(self.events_namespace)
+
+            # there is no chat yet
+            socket_io_client1.emit('sync', {'last_message_id': None}, namespace=self.events_namespace)
+            received = socket_io_client1.get_received(self.events_namespace)
+            self.assertEqual(len(received), 1)
+            self.assertEqual(received[0]['name'], 'sync_messages')
+            self.assertEqual(received[0]['args'][0], {'too_far_behind': False, 'messages_number': 0, 'messages': [],
+                                                      'last_message_id': 0, 'sync_again_in': None})
+
+            # a broken id is refused
+            for data in ({'last_message_id': '5'}, {'last_message_id': True}, {'last_message_id': -1}, [5]):
+                socket_io_client1.emit('sync', data, namespace=self.events_namespace)
+                received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+                self.assertEqual((received_data['messages_number'], received_data['error']),
+                                 (0, 'Last message id is not valid'))
+
+            User.create_chat(1, 2)
+            db.session.add_all([Message(text=str(figure), sender_id=1 if figure % 2 else 2,
+                                        receiver_id=2 if figure % 2 else 1) for figure in range(5)])
+            db.session.commit()
+            socket_io_client1.emit('sync', {'last_message_id': 2}, namespace=self.events_namespace)
+            received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+            self.assertFalse(received_data['too_far_behind'])
+            self.assertEqual(received_data['messages_number'], 3)
+            self.assertEqual([message['message_id'] for message in received_data['messages']], [3, 4, 5])
+            self.assertEqual([message['message_text'] for message in received_data['messages']], ['2', '3', '4'])
+            self.assertEqual([message['is_current_user'] for message in received_data['messages']],
+                             [False, True, False])
+            self.assertEqual(received_data['last_message_id'], 5)
+            # only the client which has sent the event gets the messages
+            self.assertEqual(socket_io_client2.get_received(self.events_namespace), [])
+
+            socket_io_client1.emit('sync', {'last_message_id': 5}, namespace=self.events_namespace)
+            received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+            self.assertEqual((received_data['messages_number'], received_data['last_message_id']), (0, 5))
+
+            # a client which has missed too many messages is told to reload the history
+            self.app.config['MESSAGES_PER_SYNC_EVENT'] = 2
+            socket_io_client1.emit('sync', {'last_message_id': 2}, namespace=self.events_namespace)
+            received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+            self.assertEqual(received_data, {'too_far_behind': True, 'messages_number': 0, 'messages': [],
+                                             'last_message_id': 2, 'sync_again_in': None})
+            socket_io_client1.emit('sync', {'last_message_id': 3}, namespace=self.events_namespace)
+            received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+            self.assertFalse(received_data['too_far_behind'])
+            self.assertEqual(received_data['messages_number'], 2)
+
+            # messages queued by the write-behind are flushed before reading
+            message_writer.enabled = True
+            try:
+                socket_io_client2.emit('put_data', {'message': 'queued', 'timestamp_milliseconds': time.time() * 1000},
+                                       namespace=self.events_namespace)
+                socket_io_client1.get_received(self.events_namespace)
+                socket_io_client1.emit('sync', {'last_message_id': 5}, namespace=self.events_namespace)
+                received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+                self.assertEqual([message['message_text'] for message in received_data['messages']], ['queued'])
+                self.assertEqual(received_data['last_message_id'], 6)
+                self.assertIsNone(received_data['sync_again_in'])
+
+                # other workers may have not saved their queued messages yet, so the client syncs once more
+                self.app.config['SOCKETIO_MESSAGE_QUEUE'] = 'unix:///tmp/broker.sock'
+                socket_io_client1.emit('sync', {'last_message_id': 6}, namespace=self.events_namespace)
+                received_data = socket_io_client1.get_received(self.events_namespace)[0]['args'][0]
+                self.assertEqual(received_data['sync_again_in'],
+                                 self.app.config['MESSAGES_WRITE_BEHIND_INTERVAL'] * 2)
+            finally:
+                self.app.config['SOCKETIO_MESSAGE_QUEUE'] = None
+                message_writer.stop()
+                message_writer.enabled = False
+
     def test_isolated_clients_chat(self):
         with self.app.test_client() as client1, self.app.test_client() as client2, self.app.test_client() as client3:
             self.init_two_clients(client1, client2)
@@ -12,6 +12,8 @@ from app import make_app
 from app.authentication import User
 from app.authentication.exceptions import UserNotFoundByIndexError
 from app.authentication.models import chats
+from app.authentication.tokens import RevocationList, TokenUser, get_serializer, load_token
+from app.cache import chat_cache, make_cache_backend
 from app.chats.exceptions import ChatAlreadyExistsError, ChatNotFoundByIndexesError
 from app.config import TestConfig
 
@@ -31,13 +33,11 @@ class UserModelTestCase(unittest.TestCase):
         self.app = make_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         db.create_all()
 
     def tearDown(self) -> None:
-        User.is_chat_between.cache_clear()
-        User.get_chat_id_by_users_ids.cache_clear()
+        chat_cache.clear()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
@@ -126,6 +126,56 @@ class UserModelTestCase(unittest.TestCase):
         with self.assertRaises(BadSignature):
             User.get_user_by_reset_password_token(token)
 
+    def test_authentication_token_claims(self):
+        user, = init_users(1)
+        db.session.add(user)
+        db.session.commit()
+        token1 = user.get_authentication_token()
+        token2 = user.get_authentication_token()
+        claims1, header = load_token(token1)
+        claims2, _ = load_token(token2)
+        self.assertEqual(claims1['user_id'], user.user_id)
+        self.assertEqual(claims1['username'], user.username)
+        self.assertNotEqual(claims1['jti'], claims2['jti'])
+        self.assertIn('exp', header)
+        self.assertIs(get_serializer('key', 60), get_serializer('key', 60))
+        token_user = TokenUser(claims1)
+        self.assertEqual(token_user.user_id, user.user_id)
+        self.assertIsNone(token_user._user)
+        self.assertEqual(token_user.email, user.email)
+
+    def test_revocation_list(self):
+        revocation_list = RevocationList()
+        revocation_list.revoke('a', time.time() + 60)
+        revocation_list.revoke('b', time.time() + 0.1)
+        self.assertTrue(revocation_list.is_revoked('a'))
+        self.assertTrue(revocation_list.is_revoked('b'))
+        self.assertFalse(revocation_list.is_revoked('c'))
+        self.assertFalse(revocation_list.is_revoked(None))
+        time.sleep(0.2)
+        # an expired token is forgotten
+        self.assertFalse(revocation_list.is_revoked('b'))
+        self.assertEqual(len(revocation_list), 1)
+
+    def test_revocation_is_published(self):
+        # the lists of two workers, linked like through the message queue
+        worker1, worker2 = RevocationList(), RevocationList()
+        worker1.set_publisher(lambda token_id, expires_at: worker2.revoke(token_id, expires_at, publish=False))
+        worker1.revoke('a', time.time() + 60)
+        self.assertTrue(worker1.is_revoked('a'))
+        self.assertTrue(worker2.is_revoked('a'))
+
+    def test_revocation_is_kept_in_shared_store(self):
+        store = make_cache_backend()
+        worker1, worker2 = RevocationList(), RevocationList()
+        worker1.store = worker2.store = store
+        worker1.revoke('a', time.time() + 60)
+        # worker2 has not received the revocation, e.g. it has been restarted
+        self.assertEqual(len(worker2), 0)
+        self.assertTrue(worker2.is_revoked('a'))
+        self.assertEqual(len(worker2), 1)
+        self.assertFalse(worker2.is_revoked('b'))
+
     def test_users_create_delete_chat(self):
         user1, user2 = init_users(2)
         db.session.add_all([user1, user2, ])
@@ -147,7 +197,7 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(User.is_chat_between(1, 2))
         self.assertTrue(User.is_chat_between(2, 1))
         result = db.session.execute(select(chats))
-        self.assertEqual(result.all()[0], (1, 1, 2))
+        self.assertEqual(result.all()[0][:3], (1, 1, 2))
         result.close()
 
         User.delete_chat(two_users_ids=[1, 2])
@@ -156,7 +206,7 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(User.is_chat_between(1, 2))
         self.assertTrue(User.is_chat_between(2, 1))
         result = db.session.execute(select(chats))
-        self.assertEqual(result.all()[0], (1, 1, 2))
+        self.assertEqual(result.all()[0][:3], (1, 1, 2))
         result.close()
 
         User.delete_chat(chat_id=1)
@@ -7,8 +7,10 @@ from app.authentication.models import User
 from app.chats.models import Message
 from app.chats.utils import get_user_chats_and_last_messages as get_uc
 from app.chats.utils import get_users_unique_room_name as get_rn
-from app.chats.utils import search_for_users_by
+from app.cache import search_cache
+from app.chats.utils import search_for_users_by, search_users_cached, search_users_page
 from app.config import TestConfig
+from app.cursors import encode_cursor
 from tests.test_user_model import init_users
 
 
@@ -124,3 +126,66 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEqual(len(result3), 2)
         self.assertEqual(result3[0][0], 'Maxim Ruslanovich')
         self.assertEqual(result3[1][0], 'Dmitry Andreevich')
+
+    def test_search_for_users_by_rank(self):
+        users = init_users(5)
+        users[0].username, users[0].name = 'annabel', 'Bell'
+        users[1].username, users[1].name = 'joanna', 'Jo'
+        users[2].username, users[2].name = 'ann', 'Anna'
+        users[3].username, users[3].name = 'bob', 'Ann'
+        users[4].username, users[4].name = 'ann_s', 'Sam'
+        db.session.add_all(users)
+        db.session.commit()
+        result = search_for_users_by('Ann').all()
+        # exact matches, then prefix ones, then the others, the newest first among equal ranks
+        self.assertEqual([row.username for row in result], ['bob', 'ann', 'ann_s', 'annabel', 'joanna'])
+        self.assertEqual([row.rank for row in result], [0, 0, 1, 1, 2])
+        # wildcards are searched as they are
+        self.assertEqual([row.username for row in search_for_users_by('n_').all()], ['ann_s'])
+        self.assertEqual(search_for_users_by('%').all(), [])
+
+    def test_search_users_page(self):
+        users = init_users(5)
+        for user in users:
+            user.name = 'Ann'
+        db.session.add_all(users)
+        db.session.commit()
+        self.app.config['SEARCH_RESULTS_LIMIT'] = 3
+        rows, next_cursor = search_users_page('ann', current_user_id=5, limit=100)
+        self.assertEqual([row.user_id for row in rows], [4, 3, 2])
+        rows, next_cursor = search_users_page('ann', current_user_id=5, cursor=next_cursor)
+        self.assertEqual([row.user_id for row in rows], [1])
+        self.assertIsNone(next_cursor)
+        rows, next_cursor = search_users_page('', limit=2)
+        self.assertEqual([row.user_id for row in rows], [5, 4])
+        rows, next_cursor = search_users_page('', cursor=next_cursor, limit=2)
+        self.assertEqual([row.user_id for row in rows], [3, 2])
+        with self.assertRaises(ValueError):
+            search_users_page('ann', cursor='broken')
+        # the values of a forged cursor must have the types of the sort key
+        for key in ({'rank': 'x', 'user_id': 1}, {'rank': 1, 'user_id': True}, {'rank': 1, 'user_id': 1, 'key': 1}):
+            with self.assertRaises(ValueError):
+                search_users_page('ann', cursor=encode_cursor(key))
+
+    def test_search_users_cached(self):
+        users = init_users(3)
+        for user in users:
+            user.name = 'Ann'
+        db.session.add_all(users)
+        db.session.commit()
+        self.assertEqual([row.user_id for row in search_users_cached('ann', 3)], [2, 1])
+        # the entry is shared by other searchers and by equal normalized strings
+        self.assertEqual([row.user_id for row in search_users_cached(' ANN ann', 1)], [3, 2])
+        self.assertEqual([row.user_id for row in search_users_cached('ann', 1, limit=1)], [3])
+        self.assertEqual(search_cache.stats()['hits'], 2)
+
+        user = User(email='new@gmail.com', username='new', name='Ann')
+        user.set_password('12345678')
+        db.session.add(user)
+        db.session.commit()
+        self.assertEqual([row.user_id for row in search_users_cached('ann')], [4, 3, 2, 1])
+
+        user.name = 'Bob'
+        db.session.commit()
+        self.assertEqual([row.user_id for row in search_users_cached('ann')], [3, 2, 1])
+        self.assertEqual(search_cache.stats()['misses'], 3)